@@ -0,0 +1,381 @@
+"""The remote.bench module generates load on a coordinator using simulated
+exporters and clients and reports the latency of its RPCs."""
+import argparse
+import asyncio
+import math
+import os
+import random
+import sys
+import time
+from collections import Counter, defaultdict
+
+import attr
+from autobahn import wamp
+from autobahn.asyncio.wamp import ApplicationRunner, ApplicationSession
+
+from .common import get_serializers
+
+OPERATIONS = ('get_places', 'get_resources', 'acquire', 'reserve')
+
+
+def parse_mix(value):
+    """Parse a mix of client operations like 'get_places=4,acquire=1' into a
+    dict of operation -> weight."""
+    mix = {}
+    for item in value.split(','):
+        name, sep, weight = item.partition('=')
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise ValueError(f"unknown operation {name}, use one of {', '.join(OPERATIONS)}")
+        mix[name] = float(weight) if sep else 1.0
+        if mix[name] < 0:
+            raise ValueError(f"invalid weight {weight} for {name}")
+    if not any(mix.values()):
+        raise ValueError("no operation with a positive weight")
+    return mix
+
+
+def percentile(values, p):
+    """Return the p-th percentile (nearest rank) of the sorted values."""
+    if not values:
+        return None
+    index = max(0, math.ceil(p / 100 * len(values)) - 1)
+    return values[index]
+
+
+@attr.s(eq=False)
+class Stats:
+    """Latencies and errors by operation name."""
+    latencies = attr.ib(default=attr.Factory(lambda: defaultdict(list)), init=False)
+    errors = attr.ib(default=attr.Factory(Counter), init=False)
+
+    def record(self, name, seconds):
+        self.latencies[name].append(seconds)
+
+    def error(self, name):
+        self.errors[name] += 1
+
+    def report(self, duration, file=sys.stdout):
+        names = sorted(set(self.latencies) | set(self.errors))
+        print(
+            f"{'operation':<24} {'count':>8} {'rate/s':>9} {'p50 ms':>9} {'p90 ms':>9} "
+            f"{'p99 ms':>9} {'max ms':>9} {'errors':>7}",
+            file=file,
+        )
+        for name in names:
+            values = sorted(self.latencies[name])
+            columns = [
+                f'{percentile(values, p) * 1000:9.2f}' if values else f"{'-':>9}"
+                for p in (50, 90, 99, 100)
+            ]
+            print(
+                f"{name:<24} {len(values):>8} {len(values) / duration:>9.1f} "
+                f"{' '.join(columns)} {self.errors[name]:>7}",
+                file=file,
+            )
+
+
+class BenchSession(ApplicationSession):
+    """Base for the simulated sessions, resolving the 'joined' future from the
+    extra config once the session has joined."""
+    def onConnect(self):
+        self.stats = self.config.extra['stats']
+        self.join(self.config.realm, authmethods=["ticket"], authid=self.config.extra['authid'])
+
+    def onChallenge(self, challenge):
+        return "dummy-ticket"
+
+    async def onJoin(self, details):
+        self.config.extra['joined'].set_result(self)
+
+    async def timed_call(self, name, *args, **kwargs):
+        """Call the coordinator procedure and record its latency."""
+        start = time.monotonic()
+        try:
+            result = await self.call(f'org.labgrid.coordinator.{name}', *args, **kwargs)
+        except wamp.exception.ApplicationError:
+            self.stats.error(name)
+            raise
+        self.stats.record(name, time.monotonic() - start)
+        return result
+
+
+class SimExporterSession(BenchSession):
+    """Exporter with synthetic NetworkSerialPort resources, which only tracks
+    their acquired state."""
+    async def onJoin(self, details):
+        self.name = self.config.extra['authid'].split('/', 1)[1]
+        self.groups = self.config.extra['groups']
+        prefix = f'org.labgrid.exporter.{self.name}'
+        await self.register(self.acquire, f'{prefix}.acquire')
+        await self.register(self.release, f'{prefix}.release')
+        await self.register(self.version, f'{prefix}.version')
+
+        features = set(await self.call('org.labgrid.coordinator.get_features'))
+        resources = [
+            (group_name, resource_name, data)
+            for group_name, group in self.groups.items()
+            for resource_name, data in group.items()
+        ]
+        if 'set_resources' in features:
+            await self.timed_call('set_resources', resources)
+        else:
+            for resource in resources:
+                await self.timed_call('set_resource', *resource)
+        await super().onJoin(details)
+
+    async def acquire(self, group_name, resource_name, place_name):
+        data = self.groups[group_name][resource_name]
+        data['acquired'] = place_name
+        await self.call(
+            'org.labgrid.coordinator.set_resource', group_name, resource_name, data
+        )
+
+    async def release(self, group_name, resource_name):
+        data = self.groups[group_name][resource_name]
+        data['acquired'] = None
+        await self.call(
+            'org.labgrid.coordinator.set_resource', group_name, resource_name, data
+        )
+
+    async def version(self):
+        return 'bench'
+
+
+class SimClientSession(BenchSession):
+    """Client running a random mix of operations on its own set of places."""
+    reservation_events = None
+
+    async def onJoin(self, details):
+        features = set(await self.call('org.labgrid.coordinator.get_features'))
+        if 'reservation_changed' in features:
+            self.reservation_events = {}
+            await self.subscribe(self.on_reservation_changed,
+                                 'org.labgrid.coordinator.reservation_changed')
+        await super().onJoin(details)
+
+    def on_reservation_changed(self, token, config):
+        event = self.reservation_events.get(token)
+        if event is not None:
+            event.set()
+
+    async def op_get_places(self, rng):
+        await self.timed_call('get_places')
+
+    async def op_get_resources(self, rng):
+        await self.timed_call('get_resources')
+
+    async def op_acquire(self, rng):
+        place = rng.choice(self.places)
+        if await self.timed_call('acquire_place', place):
+            await self.timed_call('release_place', place)
+        else:
+            self.stats.error('acquire_place')
+
+    async def op_reserve(self, rng):
+        place = rng.choice(self.places)
+        start = time.monotonic()
+        res = await self.timed_call('create_reservation', f'name={place}')
+        (token, config), = res.items()
+        deadline = start + 10.0
+        # like the client, wait for the changes and only poll them after an
+        # event, or once a second for an old coordinator
+        event = asyncio.Event()
+        if self.reservation_events is not None:
+            self.reservation_events[token] = event
+        try:
+            while config['state'] == 'waiting':
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(event.wait(), min(timeout, 1.0))
+                except asyncio.TimeoutError:
+                    pass
+                event.clear()
+                config = await self.timed_call('poll_reservation', token)
+        finally:
+            if self.reservation_events is not None:
+                self.reservation_events.pop(token, None)
+        if config['state'] == 'allocated':
+            self.stats.record('reservation_allocated', time.monotonic() - start)
+        else:
+            self.stats.error('reservation_allocated')
+        await self.timed_call('cancel_reservation', token)
+
+    async def run(self, places, mix, deadline, rng):
+        self.places = places
+        operations = [getattr(self, f'op_{name}') for name in mix]
+        weights = list(mix.values())
+        while time.monotonic() < deadline:
+            operation = rng.choices(operations, weights)[0]
+            try:
+                await operation(rng)
+            except wamp.exception.ApplicationError:
+                pass  # already counted
+
+
+class SimMonitorSession(BenchSession):
+    """Client which only counts the events published by the coordinator."""
+    async def onJoin(self, details):
+        self.events = Counter()
+        for topic in ('place_changed', 'resource_changed', 'resources_changed',
+                      'reservation_changed'):
+            await self.subscribe(
+                lambda *args, topic=topic: self.events.update([topic]),
+                f'org.labgrid.coordinator.{topic}',
+            )
+        await super().onJoin(details)
+
+
+@attr.s(eq=False)
+class Bench:
+    url = attr.ib()
+    realm = attr.ib()
+    exporters = attr.ib(default=10)
+    resources = attr.ib(default=20)
+    group_size = attr.ib(default=2)
+    clients = attr.ib(default=10)
+    monitors = attr.ib(default=1)
+    duration = attr.ib(default=30.0)
+    mix = attr.ib(default=attr.Factory(lambda: parse_mix('get_places=4,get_resources=2,acquire=2,reserve=1')))
+    seed = attr.ib(default=None)
+    serializer = attr.ib(default=None)
+    stats = attr.ib(default=attr.Factory(Stats), init=False)
+
+    async def connect(self, cls, authid, **extra):
+        loop = asyncio.get_event_loop()
+        joined = loop.create_future()
+        extra.update(authid=authid, joined=joined, stats=self.stats)
+        runner = ApplicationRunner(
+            self.url, realm=self.realm, extra=extra, serializers=get_serializers(self.serializer)
+        )
+        await runner.run(cls, start_loop=False)
+        return await asyncio.wait_for(joined, timeout=60.0)
+
+    def make_groups(self):
+        groups = {}
+        for j in range(self.resources):
+            group = groups.setdefault(f'group-{j // self.group_size}', {})
+            group[f'port-{j % self.group_size}'] = {
+                'cls': 'NetworkSerialPort',
+                'params': {'host': 'localhost', 'port': 10000 + j},
+                'acquired': None,
+                'avail': True,
+            }
+        return groups
+
+    async def setup_places(self, session, exporters):
+        places = []
+        for exporter in exporters:
+            for group_name in exporter.groups:
+                place = f'{exporter.name}-{group_name}'
+                await session.timed_call('add_place', place)
+                await session.timed_call('add_place_match', place, f'{exporter.name}/{group_name}/*')
+                await session.timed_call('set_place_tags', place, {'board': 'bench'})
+                places.append(place)
+        return places
+
+    async def run(self, file=sys.stdout):
+        rng = random.Random(self.seed)
+        start = time.monotonic()
+        exporters = await asyncio.gather(*[
+            self.connect(SimExporterSession, f'exporter/bench-{i}', groups=self.make_groups())
+            for i in range(self.exporters)
+        ])
+        print(f"started {len(exporters)} exporters in {time.monotonic() - start:.2f}s", file=file)
+
+        monitors = await asyncio.gather(*[
+            self.connect(SimMonitorSession, f'client/bench/monitor-{i}')
+            for i in range(self.monitors)
+        ])
+        clients = await asyncio.gather(*[
+            self.connect(SimClientSession, f'client/bench/client-{i}')
+            for i in range(self.clients)
+        ])
+        places = await self.setup_places(clients[0], exporters)
+        print(f"created {len(places)} places", file=file)
+
+        # each client uses its own places, so they only compete for the
+        # coordinator
+        self.stats = Stats()
+        for session in exporters + monitors + clients:
+            session.stats = self.stats
+        start = time.monotonic()
+        deadline = start + self.duration
+        await asyncio.gather(*[
+            client.run(places[i::len(clients)] or places, self.mix, deadline,
+                       random.Random(rng.random()))
+            for i, client in enumerate(clients)
+        ])
+        duration = time.monotonic() - start
+
+        print(f"ran {len(clients)} clients for {duration:.2f}s", file=file)
+        self.stats.report(duration, file=file)
+        for monitor in monitors:
+            events = ', '.join(f'{topic}={count}' for topic, count in sorted(monitor.events.items()))
+            print(f"events received by {monitor.config.extra['authid']}: {events or 'none'}", file=file)
+
+        for place in places:
+            await clients[0].call('org.labgrid.coordinator.del_place', place)
+        for session in exporters + monitors + clients:
+            session.leave()
+        await asyncio.sleep(0.5)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="generate load on a coordinator with simulated exporters and clients"
+    )
+    parser.add_argument(
+        '-x',
+        '--crossbar',
+        metavar='URL',
+        type=str,
+        default=os.environ.get("LG_CROSSBAR", "ws://127.0.0.1:20408/ws"),
+        help="crossbar websocket URL"
+    )
+    parser.add_argument('--exporters', type=int, default=10, help="number of exporters")
+    parser.add_argument('--resources', type=int, default=20, help="resources per exporter")
+    parser.add_argument('--group-size', type=int, default=2,
+                        help="resources per group (one place is created for each group)")
+    parser.add_argument('--clients', type=int, default=10, help="number of clients")
+    parser.add_argument('--monitors', type=int, default=1,
+                        help="number of clients which only receive events")
+    parser.add_argument('--duration', type=float, default=30.0, help="duration in seconds")
+    parser.add_argument(
+        '--mix',
+        type=parse_mix,
+        default='get_places=4,get_resources=2,acquire=2,reserve=1',
+        help=f"weights of the client operations ({', '.join(OPERATIONS)})"
+    )
+    parser.add_argument('--seed', type=int, default=None, help="random seed")
+    parser.add_argument(
+        '--serializer',
+        type=str,
+        default=None,
+        help="WAMP serializers to offer, in order of preference (json, msgpack, cbor)"
+    )
+
+    args = parser.parse_args()
+    if args.exporters < 1 or args.resources < 1 or args.clients < 1 or args.group_size < 1:
+        parser.error("the number of exporters, resources and clients must be positive")
+
+    bench = Bench(
+        url=args.crossbar,
+        realm=os.environ.get("LG_CROSSBAR_REALM", "realm1"),
+        exporters=args.exporters,
+        resources=args.resources,
+        group_size=args.group_size,
+        clients=args.clients,
+        monitors=args.monitors,
+        duration=args.duration,
+        mix=args.mix,
+        seed=args.seed,
+        serializer=args.serializer,
+    )
+    asyncio.get_event_loop().run_until_complete(bench.run())
+
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,7 @@ import argparse
 import asyncio
 import contextlib
 import enum
+import hashlib
 import os
 import subprocess
 import traceback
@@ -20,10 +21,11 @@ from datetime import datetime
 from pprint import pformat
 import txaio
 txaio.use_asyncio()
+from autobahn import wamp
 from autobahn.asyncio.wamp import ApplicationSession
 
 from .common import (ResourceEntry, ResourceMatch, Place, Reservation, ReservationState, TAG_KEY,
-                     TAG_VAL, enable_tcp_nodelay)
+                     TAG_VAL, enable_tcp_nodelay, get_serializers)
 from .. import Environment, Target, target_factory
 from ..exceptions import NoDriverFoundError, NoResourceFoundError, InvalidConfigError
 from ..resource.remote import RemotePlaceManager, RemotePlace
@@ -76,23 +78,105 @@ class ClientSession(ApplicationSession):
         return "dummy-ticket"
 
     async def onJoin(self, details):
+        try:
+            self.features = set(await self.call('org.labgrid.coordinator.get_features'))
+        except wamp.exception.ApplicationError as e:
+            if e.error != "wamp.error.no_such_procedure":
+                raise
+            self.features = set()  # old coordinator
+
         # FIXME race condition?
-        resources = await self.call('org.labgrid.coordinator.get_resources')
+        if 'changes' in self.features:
+            resources, places = await self._sync_state()
+        else:
+            resources = await self.call('org.labgrid.coordinator.get_resources')
+            places = await self.call('org.labgrid.coordinator.get_places')
+
         self.resources = {}
         for exporter, groups in resources.items():
             for group_name, group in sorted(groups.items()):
                 for resource_name, resource in sorted(group.items()):
                     await self.on_resource_changed(exporter, group_name, resource_name, resource)
 
-        places = await self.call('org.labgrid.coordinator.get_places')
         self.places = {}
         for placename, config in places.items():
             await self.on_place_changed(placename, config)
 
-        await self.subscribe(self.on_resource_changed, 'org.labgrid.coordinator.resource_changed')
+        # the allocations per group are needed for '+TOKEN:GROUP'
+        self.reservations = {}
+        pattern = getattr(self.args, 'place', None)
+        if pattern and pattern.startswith('+') and ':' in pattern:
+            self.reservations = await self.call('org.labgrid.coordinator.get_reservations')
+
+        if 'resources_changed' in self.features:
+            await self.subscribe(self.on_resources_changed,
+                                 'org.labgrid.coordinator.resources_changed')
+        else:
+            await self.subscribe(self.on_resource_changed,
+                                 'org.labgrid.coordinator.resource_changed')
         await self.subscribe(self.on_place_changed, 'org.labgrid.coordinator.place_changed')
+        self.reservation_events = {}
+        if 'reservation_changed' in self.features:
+            await self.subscribe(self.on_reservation_changed,
+                                 'org.labgrid.coordinator.reservation_changed')
         await self.connected(self)
 
+    async def _sync_state(self):
+        """Return the resources and places from the coordinator.
+
+        The state is cached between invocations, so that usually only the
+        changes since the cached revision need to be transferred.
+        """
+        cache_file = self.config.extra.get('state_cache')
+        cache = {}
+        if cache_file:
+            try:
+                with open(cache_file, 'r') as f:
+                    cache = json.load(f)
+            except (OSError, ValueError):
+                pass
+
+        changes = await self.call('org.labgrid.coordinator.get_changes',
+                                  cache.get('revision', 0), cache.get('epoch'))
+        if changes['full']:
+            resources = changes['resources']
+            places = changes['places']
+        else:
+            resources = cache['resources']
+            places = cache['places']
+            for name, config in changes['places'].items():
+                if config:
+                    places[name] = config
+                else:
+                    places.pop(name, None)
+            for exporter, group_name, resource_name, resource in changes['resources']:
+                groups = resources.setdefault(exporter, {})
+                group = groups.setdefault(group_name, {})
+                if resource:
+                    group[resource_name] = resource
+                else:
+                    group.pop(resource_name, None)
+                if not group:
+                    del groups[group_name]
+                if not groups:
+                    del resources[exporter]
+
+        if cache_file and (changes['epoch'], changes['revision']) != \
+                (cache.get('epoch'), cache.get('revision')):
+            cache = {
+                'epoch': changes['epoch'],
+                'revision': changes['revision'],
+                'resources': resources,
+                'places': places,
+            }
+            try:
+                os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+                atomic_replace(cache_file, json.dumps(cache).encode())
+            except OSError as e:
+                logging.debug("failed to write state cache %s: %s", cache_file, e)
+
+        return resources, places
+
     async def on_resource_changed(self, exporter, group_name, resource_name, resource):
         group = self.resources.setdefault(exporter,
                                           {}).setdefault(group_name, {})
@@ -114,6 +198,10 @@ class ClientSession(ApplicationSession):
             else:
                 print(f"Resource {exporter}/{group_name}/{resource_name} deleted")
 
+    async def on_resources_changed(self, changes):
+        for exporter, group_name, resource_name, resource in changes:
+            await self.on_resource_changed(exporter, group_name, resource_name, resource)
+
     async def on_place_changed(self, name, config):
         if not config:
             del self.places[name]
@@ -139,6 +227,11 @@ class ClientSession(ApplicationSession):
                 for k, v_old, v_new in diff_dict(old, new):
                     print(f"  {k}: {v_old} -> {v_new}")
 
+    async def on_reservation_changed(self, token, config):
+        event = self.reservation_events.get(token)
+        if event is not None:
+            event.set()
+
     async def do_monitor(self):
         self.monitor = True
         while True:
@@ -290,14 +383,22 @@ class ClientSession(ApplicationSession):
         """
         result = set()
 
-        # reservation token lookup
+        # reservation token lookup, optionally for a single filter group
         token = None
         if pattern.startswith('+'):
-            token = pattern[1:]
+            token, _, group = pattern[1:].partition(':')
             if not token:
                 token = os.environ.get('LG_TOKEN', None)
             if not token:
                 return []
+            if group:
+                config = self.reservations.get(token)
+                if config is None:
+                    raise UserError(f"reservation token {token} matches nothing")
+                names = config.get('allocations', {}).get(group)
+                if not names:
+                    raise UserError(f"reservation token {token} has no places for group {group}")
+                return [name for name in names if name in self.places]
             for name, place in self.places.items():
                 if place.reservation == token:
                     result.add(name)
@@ -347,6 +448,17 @@ class ClientSession(ApplicationSession):
             raise UserError(f"pattern {pattern} matches multiple places ({', '.join(places)})")
         return self.places[places[0]]
 
+    def get_places(self, place=None):
+        """Like get_place(), but return all places of a reservation token
+        (or of one of its groups)"""
+        pattern = place or self.args.place
+        if pattern is None or not pattern.startswith('+'):
+            return [self.get_place(place)]
+        places = self._match_places(pattern)
+        if not places:
+            raise UserError(f"place pattern {pattern} matches nothing")
+        return [self.places[name] for name in sorted(places)]
+
     def get_idle_place(self, place=None):
         place = self.get_place(place)
         if place.acquired:
@@ -538,8 +650,12 @@ class ClientSession(ApplicationSession):
             raise UserError(f"Match {match} has no matching remote resource")
 
     async def acquire(self):
-        """Acquire a place, marking it unavailable for other clients"""
-        place = self.get_place()
+        """Acquire a place (or all places of a reservation), marking it
+        unavailable for other clients"""
+        for place in self.get_places():
+            await self._acquire_place(place)
+
+    async def _acquire_place(self, place):
         if place.acquired:
             raise UserError(f"place {place.name} is already acquired by {place.acquired}")
 
@@ -570,8 +686,12 @@ class ClientSession(ApplicationSession):
         raise ServerError(f"failed to acquire place {place.name}")
 
     async def release(self):
-        """Release a previously acquired place"""
-        place = self.get_place()
+        """Release a previously acquired place (or all places of a
+        reservation)"""
+        for place in self.get_places():
+            await self._release_place(place)
+
+    async def _release_place(self, place):
         if not place.acquired:
             raise UserError(f"place {place.name} is not acquired")
         _, user = place.acquired.split('/')
@@ -1163,7 +1283,21 @@ class ClientSession(ApplicationSession):
     async def create_reservation(self):
         filters = ' '.join(self.args.filters)
         prio = self.args.prio
-        res = await self.call('org.labgrid.coordinator.create_reservation', filters, prio=prio)
+        kwargs = {}
+        if self.args.counts:
+            counts = {}
+            for item in self.args.counts:
+                try:
+                    group, count = item.split('=')
+                    counts[group] = int(count)
+                except ValueError:
+                    raise UserError(f"invalid count {item}, expected GROUP=COUNT")
+            kwargs['counts'] = counts
+        if kwargs or any(':' in f.split('=', 1)[0] for f in self.args.filters):
+            if 'filter_groups' not in self.features:
+                raise UserError("the coordinator does not support multiple filter groups or counts")
+        res = await self.call('org.labgrid.coordinator.create_reservation', filters, prio=prio,
+                              **kwargs)
         if res is None:
             raise ServerError("failed to create reservation")
         ((token, config),) = res.items()  # we get a one-item dict
@@ -1186,18 +1320,37 @@ class ClientSession(ApplicationSession):
             raise ServerError(f"failed to cancel reservation {token}")
 
     async def _wait_reservation(self, token, verbose=True):
-        while True:
-            config = await self.call('org.labgrid.coordinator.poll_reservation', token)
-            if config is None:
-                raise ServerError("reservation not found")
-            config = filter_dict(config, Reservation, warn=True)
-            res = Reservation(token=token, **config)
-            if verbose:
-                res.show()
-            if res.state is ReservationState.waiting:
-                await asyncio.sleep(1.0)
-            else:
-                break
+        if 'reservation_changed' not in self.features:
+            # old coordinator, poll once a second
+            event = None
+            kwargs = {}
+        else:
+            # wait for changes, the poll only keeps the reservation alive
+            event = self.reservation_events.setdefault(token, asyncio.Event())
+            kwargs = {'timeout': 300}
+        try:
+            while True:
+                if event is not None:
+                    event.clear()
+                config = await self.call('org.labgrid.coordinator.poll_reservation', token,
+                                         **kwargs)
+                if config is None:
+                    raise ServerError("reservation not found")
+                config = filter_dict(config, Reservation, warn=True)
+                res = Reservation(token=token, **config)
+                if verbose:
+                    res.show()
+                if res.state is not ReservationState.waiting:
+                    break
+                if event is None:
+                    await asyncio.sleep(1.0)
+                    continue
+                try:
+                    await asyncio.wait_for(event.wait(), 100.0)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self.reservation_events.pop(token, None)
 
     async def wait_reservation(self):
         token = self.args.token
@@ -1240,7 +1393,14 @@ class ClientSession(ApplicationSession):
     export.needs_target = True
 
 
-def start_session(url, realm, extra):
+def get_state_cache(url, realm):
+    """Return the file name used to cache the coordinator state for the given URL and realm"""
+    cache_dir = os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+    key = hashlib.sha256(f"{url} {realm}".encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, 'labgrid', f'coordinator-{key}.json')
+
+
+def start_session(url, realm, extra, serializers=None):
     from autobahn.asyncio.wamp import ApplicationRunner
 
     loop = asyncio.get_event_loop()
@@ -1253,6 +1413,7 @@ def start_session(url, realm, extra):
         extra = {}
     extra['loop'] = loop
     extra['connected'] = connected
+    extra.setdefault('state_cache', get_state_cache(url, realm))
 
     session = [None]
 
@@ -1263,7 +1424,9 @@ def start_session(url, realm, extra):
 
     url = proxymanager.get_url(url, default_port=20408)
 
-    runner = ApplicationRunner(url, realm=realm, extra=extra)
+    if serializers is None:
+        serializers = get_serializers()
+    runner = ApplicationRunner(url, realm=realm, extra=extra, serializers=serializers)
     coro = runner.run(make, start_loop=False)
 
     _, protocol = loop.run_until_complete(coro)
@@ -1686,8 +1849,10 @@ def main():
                            help="format output as shell variables")
     subparser.add_argument('--prio', type=float, default=0.0,
                            help="priority relative to other reservations (default 0)")
-    subparser.add_argument('filters', metavar='KEY=VALUE', nargs='+',
-                           help="required tags")
+    subparser.add_argument('--count', dest='counts', metavar='GROUP=COUNT', action='append',
+                           help="number of places needed for a filter group (default 1)")
+    subparser.add_argument('filters', metavar='[GROUP:]KEY=VALUE', nargs='+',
+                           help="required tags, optionally for a named filter group (default main)")
     subparser.set_defaults(func=ClientSession.create_reservation)
 
     subparser = subparsers.add_parser('cancel-reservation', help="cancel a reservation")
@@ -1,3 +1,4 @@
+import os
 import socket
 import time
 import enum
@@ -5,7 +6,7 @@ import random
 import re
 import string
 from datetime import datetime
-from fnmatch import fnmatchcase
+from fnmatch import translate
 
 import attr
 
@@ -18,12 +19,21 @@ __all__ = [
     'ReservationState',
     'Reservation',
     'enable_tcp_nodelay',
+    'get_serializers',
+    'is_literal',
 ]
 
 TAG_KEY = re.compile(r"[a-z][a-z0-9_]+")
 TAG_VAL = re.compile(r"[a-z0-9_]?")
 
 
+def _translate(pattern):
+    """Translate a glob pattern to a regex without the end anchor."""
+    regex = translate(pattern)
+    assert regex[-2:] in (r'\Z', r'\z')
+    return regex[:-2]
+
+
 @attr.s(eq=False)
 class ResourceEntry:
     data = attr.ib()  # cls, params
@@ -115,6 +125,29 @@ class ResourceMatch:
             result += " -> " + self.rename
         return result
 
+    def __attrs_post_init__(self):
+        self._compile()
+
+    def _compile(self):
+        """Precompile the patterns, so that ismatch() is cheap.
+
+        Literal exporter, group and cls segments are compared directly, which
+        rejects most resources early. Any glob segments are checked together
+        with one regex on the NUL-separated path.
+        """
+        patterns = (self.exporter, self.group, self.cls)
+        self._literals = tuple(
+            (i, pattern) for i, pattern in enumerate(patterns) if is_literal(pattern)
+        )
+        if len(self._literals) == len(patterns):
+            self._regex = None
+        else:
+            self._regex = re.compile('\0'.join(_translate(pattern) for pattern in patterns) + r'\Z')
+        if self.name is None or is_literal(self.name):
+            self._name_regex = None
+        else:
+            self._name_regex = re.compile(translate(self.name))
+
     def ismatch(self, resource_path):
         """Return True if this matches the given resource"""
         try:
@@ -123,14 +156,15 @@ class ResourceMatch:
             exporter, group, cls = resource_path
             name = None
 
-        if not fnmatchcase(exporter, self.exporter):
-            return False
-        if not fnmatchcase(group, self.group):
-            return False
-        if not fnmatchcase(cls, self.cls):
-            return False
-        if name and self.name and not fnmatchcase(name, self.name):
+        for i, literal in self._literals:
+            if resource_path[i] != literal:
+                return False
+        if self._regex is not None and not self._regex.match(f"{exporter}\0{group}\0{cls}"):
             return False
+        if name and self.name:
+            if self._name_regex is None:
+                return name == self.name
+            return self._name_regex.match(name) is not None
 
         return True
 
@@ -161,7 +195,7 @@ class Place:
         return {
             'aliases': list(self.aliases),
             'comment': self.comment,
-            'tags': self.tags,
+            'tags': dict(self.tags),
             'matches': [attr.asdict(x) for x in self.matches],
             'acquired': self.acquired,
             'acquired_resources': acquired_resources,
@@ -268,17 +302,32 @@ class Reservation:
     allocations = attr.ib(default=attr.Factory(dict), validator=attr.validators.instance_of(dict))
     created = attr.ib(default=attr.Factory(time.time))
     timeout = attr.ib(default=attr.Factory(lambda: time.time() + 60))
+    # a dictionary of name -> number of places, if more than one
+    counts = attr.ib(default=attr.Factory(dict), validator=attr.validators.instance_of(dict))
+    # position in the queue of waiting reservations
+    rank = attr.ib(default=None)
 
     def asdict(self):
-        return {
+        result = {
             'owner': self.owner,
             'state': self.state.name,
             'prio': self.prio,
-            'filters': self.filters,
-            'allocations': self.allocations,
+            'filters': {name: dict(filter_) for name, filter_ in self.filters.items()},
+            'allocations': {name: list(places) for name, places in self.allocations.items()},
             'created': self.created,
             'timeout': self.timeout,
         }
+        # avoid warnings in older clients
+        if self.counts:
+            result['counts'] = dict(self.counts)
+        if self.rank is not None:
+            result['rank'] = self.rank
+        return result
+
+    @property
+    def gang(self):
+        """True if the reservation needs more than one place"""
+        return len(self.filters) > 1 or any(count > 1 for count in self.counts.values())
 
     def refresh(self, delta=60):
         self.timeout = max(self.timeout, time.time() + delta)
@@ -294,9 +343,12 @@ class Reservation:
         print(indent + f"state: {self.state.name}")
         if self.prio:
             print(indent + f"prio: {self.prio}")
+        if self.rank is not None:
+            print(indent + f"rank: {self.rank}")
         print(indent + "filters:")
         for name, fltr in self.filters.items():
-            print(indent + f"  {name}: {' '.join([(k + '=' + v) for k, v in fltr.items()])}")
+            count = f" ({self.counts[name]} places)" if name in self.counts else ""
+            print(indent + f"  {name}: {' '.join([(k + '=' + v) for k, v in fltr.items()])}{count}")
         if self.allocations:
             print(indent + "allocations:")
             for name, allocation in self.allocations.items():
@@ -305,6 +357,11 @@ class Reservation:
         print(indent + f"timeout: {datetime.fromtimestamp(self.timeout)}")
 
 
+def is_literal(pattern):
+    """Return True if the pattern contains no glob characters."""
+    return not any(c in pattern for c in '*?[')
+
+
 def enable_tcp_nodelay(session):
     """
     asyncio/autobahn does not set TCP_NODELAY by default, so we need to do it
@@ -312,3 +369,46 @@ def enable_tcp_nodelay(session):
     """
     s = session._transport.transport.get_extra_info('socket')
     s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, True)
+
+
+SERIALIZERS = {
+    'json': 'JsonSerializer',
+    'msgpack': 'MsgPackSerializer',
+    'cbor': 'CBORSerializer',
+}
+
+
+def get_serializers(names=None):
+    """
+    Return the WAMP serializers to offer to the router, in order of
+    preference.
+
+    The names are a comma separated list of the SERIALIZERS keys, by default
+    taken from LG_CROSSBAR_SERIALIZER. Without any names, None is returned to
+    keep autobahn's default negotiation, which offers all serializers with an
+    installed backend. JSON is always offered last, so that the connection
+    still works with a router which does not support the others. Each session
+    negotiates its serializer separately and the router translates between
+    them, so components with different settings can be mixed.
+    """
+    if names is None:
+        names = os.environ.get('LG_CROSSBAR_SERIALIZER')
+    if not names or not names.strip():
+        return None
+
+    import autobahn.asyncio  # pylint: disable=unused-import,import-outside-toplevel
+    from autobahn.wamp import serializer  # pylint: disable=import-outside-toplevel
+
+    names = [name.strip() for name in names.split(',') if name.strip()]
+    if 'json' not in names:
+        names.append('json')
+    result = []
+    for name in names:
+        if name not in SERIALIZERS:
+            raise ValueError(f"unknown serializer {name}, use one of {', '.join(SERIALIZERS)}")
+        # autobahn only defines the serializers with an available backend
+        cls = getattr(serializer, SERIALIZERS[name], None)
+        if cls is None:
+            raise ValueError(f"serializer {name} is not available, install the labgrid[{name}] extra")
+        result.append(cls())
+    return result
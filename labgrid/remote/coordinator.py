@@ -1,12 +1,18 @@
 """The coordinator module coordinates exported resources and clients accessing them."""
 # pylint: disable=no-member,unused-argument
 import asyncio
-import traceback
-from collections import defaultdict
+import contextlib
+import logging
+import random
+import string
+import time
+import weakref
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from os import environ
-from pprint import pprint
 from enum import Enum
 from functools import wraps
+from itertools import groupby
 
 import attr
 from autobahn import wamp
@@ -14,8 +20,11 @@ from autobahn.asyncio.wamp import ApplicationRunner, ApplicationSession
 from autobahn.wamp.types import RegisterOptions
 
 from .common import *  # pylint: disable=wildcard-import
-from .scheduler import TagSet, schedule
-from ..util import atomic_replace, yaml
+from .journal import Journal
+from .log import setup_logging
+from .metrics import Metrics, MetricsServer, TimedLock, parse_address
+from .scheduler import SCHEDULERS, FairShare, TagIndex, TagSet, schedule, schedule_all
+from ..util import yaml
 
 
 class Action(Enum):
@@ -48,6 +57,8 @@ class ExporterSession(RemoteSession):
     """An ExporterSession is opened for each Exporter connecting to the
     coordinator, allowing the Exporter to get and set resources"""
     groups = attr.ib(default=attr.Factory(dict), init=False)
+    # round trip time of the last version probe in seconds
+    rtt = attr.ib(default=None, init=False)
 
     def set_resource(self, groupname, resourcename, resourcedata):
         group = self.groups.setdefault(groupname, {})
@@ -67,9 +78,8 @@ class ExporterSession(RemoteSession):
             assert not resourcedata and not old
             new = None
 
-        self.coordinator.publish(
-            'org.labgrid.coordinator.resource_changed', self.name,
-            groupname, resourcename, new.asdict() if new else {}
+        self.coordinator._publish_resource_changed(
+            self.name, groupname, resourcename, new.asdict() if new else {}
         )
 
         if old and new:
@@ -106,6 +116,61 @@ class ResourceImport(ResourceEntry):
     path = attr.ib(kw_only=True, validator=attr.validators.instance_of(tuple))
 
 
+@attr.s(eq=False)
+class MatchIndex:
+    """Index from resource paths to the names of places with a matching
+    ResourceMatch.
+
+    Each match is stored in a bucket for its first literal exporter, group or
+    cls segment (in that order), or in the wildcard bucket if all of them
+    contain glob patterns. A lookup only needs to check the matches from the
+    buckets for the segments of the resource path.
+    """
+    buckets = attr.ib(default=attr.Factory(dict), init=False)
+
+    @staticmethod
+    def _key(match):
+        for field in ('exporter', 'group', 'cls'):
+            pattern = getattr(match, field)
+            if is_literal(pattern):
+                return (field, pattern)
+        return None
+
+    def add(self, placename, match):
+        bucket = self.buckets.setdefault(self._key(match), {})
+        bucket.setdefault(placename, []).append(match)
+
+    def remove(self, placename, match):
+        key = self._key(match)
+        bucket = self.buckets[key]
+        bucket[placename].remove(match)
+        if not bucket[placename]:
+            del bucket[placename]
+        if not bucket:
+            del self.buckets[key]
+
+    def add_place(self, place):
+        for match in place.matches:
+            self.add(place.name, match)
+
+    def remove_place(self, place):
+        for match in place.matches:
+            self.remove(place.name, match)
+
+    def places(self, resource_path):
+        """Return the set of place names matching the resource path
+        (exporter, group, cls, name)."""
+        exporter, group, cls = resource_path[:3]
+        result = set()
+        for key in (('exporter', exporter), ('group', group), ('cls', cls), None):
+            for placename, matches in self.buckets.get(key, {}).items():
+                if placename in result:
+                    continue
+                if any(match.ismatch(resource_path) for match in matches):
+                    result.add(placename)
+        return result
+
+
 def locked(func):
     @wraps(func)
     async def wrapper(self, *args, **kwargs):
@@ -113,10 +178,39 @@ def locked(func):
             return await func(self, *args, **kwargs)
     return wrapper
 
+
+def place_locked(func):
+    """Serialise calls for the place named by the first argument, without
+    blocking calls for other places."""
+    @wraps(func)
+    async def wrapper(self, name, *args, **kwargs):
+        async with self._place_lock(name):
+            return await func(self, name, *args, **kwargs)
+    return wrapper
+
 class CoordinatorComponent(ApplicationSession):
+    # Locking: A place lock is held while a place is modified, including any
+    # exporter calls needed for that. The global lock is only held for short
+    # cross-place sections (such as scheduling the reservations) and during
+    # startup and shutdown. When both are needed, the place locks (in sorted
+    # order) must be taken first. Read-only calls return the published
+    # snapshots and need no lock.
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.lock = asyncio.Lock()
+        self.log = logging.getLogger('Coordinator')
+        self.metrics = Metrics()
+        self.metrics.describe('rpc_calls_total', 'Number of handled RPC calls')
+        self.metrics.describe('rpc_duration_seconds', 'Time spent handling RPC calls')
+        self.metrics.describe('lock_wait_seconds', 'Time spent waiting for a lock')
+        self.metrics.describe('lock_hold_seconds', 'Time a lock was held')
+        self.metrics.describe('save_duration_seconds', 'Time spent writing the journal')
+        self.metrics.describe('save_latency_seconds', 'Time from a change until it was saved')
+        self.metrics.describe('schedule_duration_seconds', 'Time spent scheduling reservations')
+        self.metrics.describe('exporter_probe_seconds', 'Round trip time of exporter probes')
+        self.metrics.describe('exporter_rtt_seconds', 'Round trip time of the last exporter probe')
+        self.metrics_server = None
+        self.lock = TimedLock(self.metrics, 'global')
+        self.place_locks = weakref.WeakValueDictionary()
 
     @locked
     async def onConnect(self):
@@ -125,9 +219,42 @@ class CoordinatorComponent(ApplicationSession):
         self.reservations = {}
         self.poll_task = None
         self.save_scheduled = False
+        # changes are coalesced for this many seconds before being saved
+        self.save_interval = float(environ.get('LG_COORDINATOR_SAVE_INTERVAL', '1.0'))
+        self.save_requested = None
+        self.save_lock = asyncio.Lock()
+        # a single thread keeps the writes in order
+        self.save_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='save')
+        self.journal = Journal()
+        self.resource_changes = {}
+        self.scheduler = environ.get('LG_SCHEDULER', 'greedy')
+        if self.scheduler not in SCHEDULERS:
+            raise ValueError(f"unknown scheduler {self.scheduler}, use one of {', '.join(SCHEDULERS)}")
+        # optional fair-share policy, see FairShare for the options
+        self.policy = None
+        policy_file = environ.get('LG_SCHEDULER_POLICY')
+        if policy_file:
+            with open(policy_file, 'r') as f:
+                self.policy = FairShare(**(yaml.load(f.read()) or {}))
+        # new reservations to be considered by the next scheduler run
+        self.schedule_tokens = set()
+        # reservations which were not scheduled because of the policy caps
+        self.schedule_capped = set()
+        self.place_reservations = {}
+        self.resources_snapshot = None
+        # clients can detect a restarted coordinator by the changed epoch
+        self.epoch = ''.join(random.choice(string.ascii_uppercase+string.digits) for i in range(10))
+        self.revision = 0
+        self.changes = deque(maxlen=10000)
 
         self.load()
-        self.save_later()
+        # exporters register their resources again after a restart, so start
+        # with a fresh snapshot without any resources
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(
+            self.save_executor, self.journal.write_snapshot, self._get_places(), {},
+            self._get_reservation_data()
+        )
 
         enable_tcp_nodelay(self)
         self.join(self.config.realm, ["ticket"], "coordinator")
@@ -141,94 +268,119 @@ class CoordinatorComponent(ApplicationSession):
         await self.subscribe(
             self.on_session_leave, 'wamp.session.on_leave'
         )
-        await self.register(
+        await self._register(
             self.attach,
             'org.labgrid.coordinator.attach',
             options=RegisterOptions(details_arg='details')
         )
 
         # resources
-        await self.register(
+        await self._register(
             self.set_resource,
             'org.labgrid.coordinator.set_resource',
             options=RegisterOptions(details_arg='details')
         )
-        await self.register(
+        await self._register(
+            self.set_resources,
+            'org.labgrid.coordinator.set_resources',
+            options=RegisterOptions(details_arg='details')
+        )
+        await self._register(
             self.get_resources,
             'org.labgrid.coordinator.get_resources'
         )
 
+        # optional features for newer clients
+        await self._register(
+            self.get_features,
+            'org.labgrid.coordinator.get_features'
+        )
+        await self._register(
+            self.get_metrics,
+            'org.labgrid.coordinator.get_metrics'
+        )
+
         # places
-        await self.register(
+        await self._register(
             self.add_place, 'org.labgrid.coordinator.add_place'
         )
-        await self.register(
+        await self._register(
             self.del_place, 'org.labgrid.coordinator.del_place'
         )
-        await self.register(
+        await self._register(
             self.add_place_alias, 'org.labgrid.coordinator.add_place_alias'
         )
-        await self.register(
+        await self._register(
             self.del_place_alias, 'org.labgrid.coordinator.del_place_alias'
         )
-        await self.register(
+        await self._register(
             self.set_place_tags, 'org.labgrid.coordinator.set_place_tags'
         )
-        await self.register(
+        await self._register(
             self.set_place_comment, 'org.labgrid.coordinator.set_place_comment'
         )
-        await self.register(
+        await self._register(
             self.add_place_match, 'org.labgrid.coordinator.add_place_match'
         )
-        await self.register(
+        await self._register(
             self.del_place_match, 'org.labgrid.coordinator.del_place_match'
         )
-        await self.register(
+        await self._register(
             self.acquire_place,
             'org.labgrid.coordinator.acquire_place',
             options=RegisterOptions(details_arg='details')
         )
-        await self.register(
+        await self._register(
             self.release_place,
             'org.labgrid.coordinator.release_place',
             options=RegisterOptions(details_arg='details')
         )
-        await self.register(
+        await self._register(
             self.release_place_from,
             'org.labgrid.coordinator.release_place_from',
             options=RegisterOptions(details_arg='details')
         )
-        await self.register(
+        await self._register(
             self.allow_place,
             'org.labgrid.coordinator.allow_place',
             options=RegisterOptions(details_arg='details')
         )
-        await self.register(
+        await self._register(
             self.get_places, 'org.labgrid.coordinator.get_places'
         )
+        await self._register(
+            self.get_changes, 'org.labgrid.coordinator.get_changes'
+        )
 
         # reservations
-        await self.register(
+        await self._register(
             self.create_reservation,
             'org.labgrid.coordinator.create_reservation',
             options=RegisterOptions(details_arg='details'),
         )
-        await self.register(
+        await self._register(
             self.cancel_reservation,
             'org.labgrid.coordinator.cancel_reservation',
         )
-        await self.register(
+        await self._register(
             self.poll_reservation,
             'org.labgrid.coordinator.poll_reservation',
         )
-        await self.register(
+        await self._register(
             self.get_reservations,
             'org.labgrid.coordinator.get_reservations',
         )
 
         self.poll_task = asyncio.get_event_loop().create_task(self.poll())
 
-        print("Coordinator ready.")
+        address = environ.get('LG_COORDINATOR_METRICS')
+        if address and self.metrics_server is None:
+            host, port = parse_address(address)
+            self.metrics_server = MetricsServer(self.render_metrics, host, port)
+            await self.metrics_server.start()
+            self.log.info("Metrics available at http://%s:%s/metrics", host, port)
+
+        self.log.info("Coordinator ready.")
 
     @locked
     async def onLeave(self, details):
@@ -241,42 +393,95 @@ class CoordinatorComponent(ApplicationSession):
     @locked
     async def onDisconnect(self):
         await self.save()
+        if self.metrics_server:
+            await self.metrics_server.stop()
+            self.metrics_server = None
         if self.poll_task:
             self.poll_task.cancel()
             await asyncio.wait([self.poll_task])
             await asyncio.sleep(0.5) # give others a chance to clean up
 
+    async def _register(self, endpoint, procedure, options=None):
+        """Register the endpoint, recording the number of calls and their
+        duration."""
+        name = endpoint.__name__
+
+        @wraps(endpoint)
+        async def wrapper(*args, **kwargs):
+            start = time.monotonic()
+            status = 'error'
+            try:
+                result = await endpoint(*args, **kwargs)
+                status = 'ok'
+                return result
+            finally:
+                self.metrics.inc('rpc_calls_total', procedure=name, status=status)
+                self.metrics.observe(
+                    'rpc_duration_seconds', time.monotonic() - start, procedure=name
+                )
+
+        return await self.register(wrapper, procedure, options=options)
+
+    async def _poll_exporter(self, session):
+        start = time.monotonic()
+        try:
+            session.version = await self.call(
+                f'org.labgrid.exporter.{session.name}.version'
+            )
+        except wamp.exception.ApplicationError as e:
+            if e.error == "wamp.error.no_such_procedure":
+                pass # old client
+            elif e.error == "wamp.error.canceled":
+                pass # disconnected
+            elif e.error == "wamp.error.no_such_session":
+                pass # client has already disconnected
+            else:
+                raise
+        session.rtt = time.monotonic() - start
+        self.metrics.observe('exporter_probe_seconds', session.rtt)
+
+    async def _kick_exporter(self, session):
+        fields = {'session': session.key, 'exporter': session.name}
+        try:
+            self.log.warning("kicking exporter", extra={'fields': fields})
+            await self.call('wamp.session.kill', session.key, message="timeout detected by coordinator")
+            self.log.info("cleaning up exporter", extra={'fields': fields})
+            await self.on_session_leave(session.key)
+            self.log.info("removed exporter", extra={'fields': fields})
+        except Exception:  # pylint: disable=broad-except
+            self.log.exception("failed to kick exporter", extra={'fields': fields})
+
+    async def _poll_exporters(self, timeout):
+        """Probe all exporters concurrently, kicking those which do not answer
+        within the common timeout."""
+        tasks = {}
+        for session in list(self.sessions.values()):
+            if isinstance(session, ExporterSession):
+                tasks[asyncio.ensure_future(self._poll_exporter(session))] = session
+        if not tasks:
+            return
+
+        done, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in done:
+            try:
+                task.result()
+            except Exception:  # pylint: disable=broad-except
+                self.log.exception("failed to poll exporter",
+                                   extra={'fields': {'exporter': tasks[task].name}})
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.wait(pending)
+            await asyncio.gather(*[self._kick_exporter(tasks[task]) for task in pending])
+
     async def _poll_step(self):
         # save changes
         if self.save_scheduled:
             await self.save()
         # poll exporters
-        for session in list(self.sessions.values()):
-            if isinstance(session, ExporterSession):
-                fut = self.call(
-                    f'org.labgrid.exporter.{session.name}.version'
-                )
-                done, _ = await asyncio.wait([fut], timeout=5)
-                if not done:
-                    print(f'kicking exporter ({session.key}/{session.name})')
-                    await self.call('wamp.session.kill', session.key, message="timeout detected by coordinator")
-                    print(f'cleaning up exporter ({session.key}/{session.name})')
-                    await self.on_session_leave(session.key)
-                    print(f'removed exporter ({session.key}/{session.name})')
-                    continue
-                try:
-                    session.version = done.pop().result()
-                except wamp.exception.ApplicationError as e:
-                    if e.error == "wamp.error.no_such_procedure":
-                        pass # old client
-                    elif e.error == "wamp.error.canceled":
-                        pass # disconnected
-                    elif e.error == "wamp.error.no_such_session":
-                        pass # client has already disconnected
-                    else:
-                        raise
+        await self._poll_exporters(timeout=5.0)
         # update reservations
-        self.schedule_reservations()
+        await self._schedule_reservations()
 
     async def poll(self):
         loop = asyncio.get_event_loop()
@@ -287,46 +492,84 @@ class CoordinatorComponent(ApplicationSession):
             except asyncio.CancelledError:
                 break
             except Exception:  # pylint: disable=broad-except
-                traceback.print_exc()
+                self.log.exception("poll step failed")
 
     def save_later(self):
+        """Save the changes once the save interval has passed, together with
+        all further changes until then."""
+        if self.save_scheduled:
+            return
         self.save_scheduled = True
+        self.save_requested = time.monotonic()
+        asyncio.get_event_loop().call_later(self.save_interval, self._save_scheduled)
 
-    async def save(self):
-        self.save_scheduled = False
-
-        resources = self._get_resources()
-        resources = yaml.dump(resources)
-        resources = resources.encode()
-        places = self._get_places()
-        places = yaml.dump(places)
-        places = places.encode()
+    def _save_scheduled(self):
+        if self.save_scheduled:
+            asyncio.ensure_future(self.save())
 
-        loop = asyncio.get_event_loop()
-        await loop.run_in_executor(None, atomic_replace, 'resources.yaml', resources)
-        await loop.run_in_executor(None, atomic_replace, 'places.yaml', places)
+    async def save(self):
+        async with self.save_lock:
+            self.save_scheduled = False
+            requested, self.save_requested = self.save_requested, None
+
+            # only the dirty records are taken here, they are serialized and
+            # written in the save thread. The snapshots are updated from the
+            # files once the journal has grown large enough.
+            start = time.monotonic()
+            records = self.journal.take()
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(self.save_executor, self.journal.write, records)
+            if self.journal.needs_compaction:
+                await loop.run_in_executor(self.save_executor, self.journal.compact)
+            now = time.monotonic()
+            self.metrics.observe('save_duration_seconds', now - start)
+            if requested is not None:
+                self.metrics.observe('save_latency_seconds', now - requested)
 
     def load(self):
-        try:
-            self.place = {}
-            with open('places.yaml', 'r') as f:
-                self.places = yaml.load(f.read())
-            for placename, config in self.places.items():
-                config['name'] = placename
-                # FIXME maybe recover previously acquired places here?
-                if 'acquired' in config:
-                    del config['acquired']
-                if 'acquired_resources' in config:
-                    del config['acquired_resources']
-                if 'allowed' in config:
-                    del config['allowed']
-                if 'reservation' in config:
-                    del config['reservation']
-                config['matches'] = [ResourceMatch(**match) for match in config['matches']]
-                place = Place(**config)
-                self.places[placename] = place
-        except FileNotFoundError:
-            pass
+        places, _, reservations = self.journal.read()
+        self.places = {}
+        self.place_data = {}
+        self.places_snapshot = None
+        self.match_index = MatchIndex()
+        self.tag_index = TagIndex()
+        # places to be considered by the next scheduler run
+        self.schedule_places = set()
+        for placename, config in places.items():
+            config['name'] = placename
+            # the resources are acquired again when the exporters reconnect,
+            # see _update_locked_places()
+            if 'acquired_resources' in config:
+                del config['acquired_resources']
+            # the reservations are restored below
+            if 'reservation' in config:
+                del config['reservation']
+            config['matches'] = [ResourceMatch(**match) for match in config['matches']]
+            place = Place(**config)
+            self.places[placename] = place
+            self.match_index.add_place(place)
+            self._update_place_tags(place)
+
+        # Restore the reservations, so that queued clients don't need to
+        # create them again. The clients may have been unable to refresh them
+        # while the coordinator was down, so they get a new timeout.
+        self.reservations = {}
+        for token, config in reservations.items():
+            config.pop('rank', None)
+            res = Reservation(token=token, **config)
+            if res.state is ReservationState.expired:
+                continue
+            res.refresh(300)
+            self.reservations[token] = res
+            if res.state is ReservationState.waiting:
+                self.schedule_tokens.add(token)
+            for group in res.allocations.values():
+                for name in group:
+                    if name in self.places:
+                        self.places[name].reservation = token
+                        self.place_reservations[name] = token
+        for placename, place in self.places.items():
+            self.place_data[placename] = place.asdict()
 
     def _add_default_place(self, name):
         if name in self.places:
@@ -334,56 +577,165 @@ class CoordinatorComponent(ApplicationSession):
         if not name.isdigit():
             return
         place = Place(name)
-        print(place)
+        self.log.info("created default place", extra={'fields': {'place': name}})
         place.matches.append(ResourceMatch(exporter="*", group=name, cls="*"))
         self.places[name] = place
+        self.match_index.add_place(place)
+        self._update_place_tags(place)
+        self._publish_place(place)
 
-    async def _update_acquired_places(self, action, resource, callback=True):
-        """Update acquired places when resources are added or removed."""
-        if action not in [Action.ADD, Action.DEL]:
-            return  # currently nothing needed for Action.UPD
-
-        # collect affected places
-        places = []
-        for place in self.places.values():
-            if not place.acquired:
-                continue
-            if not place.hasmatch(resource.path):
-                continue
-            places.append(place)
-
-        if action is Action.ADD:
-            # only add if there is no conflict
-            if len(places) != 1:
-                return
-            place = places[0]
-            await self._acquire_resources(place, [resource])
-            self._publish_place(place)
+    def _place_lock(self, name):
+        lock = self.place_locks.get(name)
+        if lock is None:
+            lock = self.place_locks[name] = TimedLock(self.metrics, 'place')
+        return lock
+
+    @contextlib.asynccontextmanager
+    async def _lock_places(self, names):
+        """Hold the locks for multiple places, taken in sorted order to avoid
+        deadlocks."""
+        async with contextlib.AsyncExitStack() as stack:
+            for name in sorted(names):
+                await stack.enter_async_context(self._place_lock(name))
+            yield
+
+    def _update_place_tags(self, place):
+        """Update the tags used for scheduling and consider the place in the
+        next scheduler run."""
+        tags = set(place.tags.items())
+        # support place names
+        tags |= {('name', place.name)}
+        self.tag_index.add(place.name, tags)
+        self.schedule_places.add(place.name)
+
+    async def _update_acquired_places(self, changes, callback=True):
+        """Update acquired places when resources are added or removed.
+
+        The changes are a list of (action, resource) tuples, so that the
+        affected places are only updated and published once.
+        """
+        # currently nothing needed for Action.UPD
+        changes = [change for change in changes if change[0] in (Action.ADD, Action.DEL)]
+        locked_names = set()
+        for _, resource in changes:
+            locked_names |= self.match_index.places(resource.path)
+        async with self._lock_places(locked_names):
+            await self._update_locked_places(changes, locked_names, callback)
+
+    async def _update_locked_places(self, changes, locked_names, callback):
+        added = defaultdict(list)
+        removed = defaultdict(list)
+        adopted = defaultdict(list)
+        stale = []
+        for action, resource in changes:
+            # collect affected places, ignoring those which started to match
+            # while waiting for the locks
+            places = []
+            for name in sorted(self.match_index.places(resource.path) & locked_names):
+                place = self.places[name]
+                if not place.acquired:
+                    continue
+                places.append(place)
+
+            if action is Action.ADD and resource.acquired:
+                # The exporter still has the resource acquired, for example
+                # after the coordinator was restarted. Keep it for the place
+                # it was acquired for, release it if that place is no longer
+                # acquired or doesn't match anymore. Broken resources
+                # ('<broken>') and unknown places are left alone.
+                owner = self.places.get(resource.acquired)
+                if owner is None:
+                    continue
+                if owner in places:
+                    adopted[owner.name].append(resource)
+                elif not owner.acquired or owner.name not in self.match_index.places(resource.path):
+                    stale.append(resource)
+            elif action is Action.ADD:
+                # only add if there is no conflict
+                if len(places) != 1:
+                    continue
+                added[places[0].name].append(resource)
+            else:
+                for place in places:
+                    removed[place.name].append(resource)
+
+        tasks = []
+        for name, resources in removed.items():
+            tasks.append(self._release_resources(self.places[name], resources, callback=callback))
+        for name, resources in added.items():
+            # each resource is acquired separately, a failure only affects
+            # that resource
+            place = self.places[name]
+            tasks.extend(self._acquire_resources(place, [resource]) for resource in resources)
+        for name, resources in adopted.items():
+            self.places[name].acquired_resources.extend(resources)
+        tasks.extend(self._release_resource(resource) for resource in stale)
+        await asyncio.gather(*tasks)
+
+        for name in sorted(removed.keys() | added.keys() | adopted.keys()):
+            self._publish_place(self.places[name])
+
+    def _record_change(self, kind, key, data):
+        """Bump the revision and add the change to the log for get_changes()."""
+        self.revision += 1
+        self.changes.append((self.revision, kind, key, data))
+
+    def _publish_place_data(self, name, data):
+        """Notify the clients about a changed or deleted (if data is empty)
+        place and record it in the journal."""
+        self.publish(
+            'org.labgrid.coordinator.place_changed', name, data
+        )
+        if data:
+            self.place_data[name] = data
         else:
-            for place in places:
-                await self._release_resources(place, [resource], callback=callback)
-                self._publish_place(place)
+            self.place_data.pop(name, None)
+        self.places_snapshot = None
+        self.journal.set_place(name, data)
+        self._record_change('place', name, data)
 
     def _publish_place(self, place):
+        self._publish_place_data(place.name, place.asdict())
+
+    def _publish_resource_changed(self, exporter, group_name, resource_name, data):
+        """Notify the clients about a changed resource and record it in the journal.
+
+        Besides the event per resource for older clients, the changes are
+        collected for a short time and published as one batch.
+        """
         self.publish(
-            'org.labgrid.coordinator.place_changed', place.name, place.asdict()
+            'org.labgrid.coordinator.resource_changed',
+            exporter, group_name, resource_name, data
         )
+        self.journal.set_resource(exporter, group_name, resource_name, data)
+        self._record_change('resource', (exporter, group_name, resource_name), data)
+        self.resources_snapshot = None
+        if not self.resource_changes:
+            loop = asyncio.get_event_loop()
+            loop.call_later(0.1, self._publish_resource_changes)
+        # only the latest state of each resource is needed
+        self.resource_changes[(exporter, group_name, resource_name)] = data
+
+    def _publish_resource_changes(self):
+        changes = [[*path, data] for path, data in self.resource_changes.items()]
+        self.resource_changes = {}
+        self.publish('org.labgrid.coordinator.resources_changed', changes)
 
     def _publish_resource(self, resource):
-        self.publish(
-            'org.labgrid.coordinator.resource_changed',
+        self._publish_resource_changed(
             resource.path[0], # exporter name
             resource.path[1], # group name
             resource.path[3], # resource name
             resource.asdict(),
         )
 
-    @locked
     async def on_session_join(self, session_details):
-        print('join')
-        pprint(session_details)
         session = session_details['session']
         authid = session_details['authid']
+        self.log.debug(
+            "session joined",
+            extra={'fields': {'source': 'join', 'session': session, 'authid': authid}}
+        )
         if authid.startswith('client/'):
             session = ClientSession(self, session, authid)
         elif authid.startswith('exporter/'):
@@ -391,19 +743,22 @@ class CoordinatorComponent(ApplicationSession):
         else:
             return
         self.sessions[session.key] = session
+        self.resources_snapshot = None
 
-    @locked
+    # not @locked, as the place locks are taken while updating the places
     async def on_session_leave(self, session_id):
-        print(f'leave ({session_id})')
+        self.log.debug("session left", extra={'fields': {'source': 'leave', 'session': session_id}})
         try:
             session = self.sessions.pop(session_id)
         except KeyError:
             return
         if isinstance(session, ExporterSession):
+            self.resources_snapshot = None
+            changes = []
             for groupname, group in session.groups.items():
                 for resourcename in group.copy():
-                    action, resource = session.set_resource(groupname, resourcename, {})
-                    await self._update_acquired_places(action, resource, callback=False)
+                    changes.append(session.set_resource(groupname, resourcename, {}))
+            await self._update_acquired_places(changes, callback=False)
         self.save_later()
 
     @locked
@@ -426,29 +781,106 @@ class CoordinatorComponent(ApplicationSession):
         groupname = str(groupname)
         resourcename = str(resourcename)
         # TODO check if acquired
-        print(details)
-        pprint(resourcedata)
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug("set resource %s/%s: %s", groupname, resourcename, resourcedata,
+                           extra={'fields': {'source': session.name}})
         action, resource = session.set_resource(groupname, resourcename, resourcedata)
         if action is Action.ADD:
-            async with self.lock:
-                self._add_default_place(groupname)
+            self._add_default_place(groupname)
         if action in (Action.ADD, Action.DEL):
-            async with self.lock:
-                await self._update_acquired_places(action, resource)
+            await self._update_acquired_places([(action, resource)])
+        self.save_later()
+
+    # not @locked for the same reason as set_resource
+    async def set_resources(self, resources, details=None):
+        """Called by exporter to create/update/remove multiple resources.
+
+        The resources are a list of (groupname, resourcename, resourcedata).
+        """
+        session = self.sessions.get(details.caller)
+        if session is None:
+            return
+        assert isinstance(session, ExporterSession)
+
+        self.log.debug("set %d resources", len(resources),
+                       extra={'fields': {'source': session.name}})
+        changes = []
+        for groupname, resourcename, resourcedata in resources:
+            change = session.set_resource(str(groupname), str(resourcename), resourcedata)
+            if change is None:
+                continue  # removal of an unknown resource
+            if change[0] in (Action.ADD, Action.DEL):
+                changes.append(change)
+        if changes:
+            for action, resource in changes:
+                if action is Action.ADD:
+                    self._add_default_place(resource.path[1])
+            await self._update_acquired_places(changes)
         self.save_later()
 
+    async def get_features(self, details=None):
+        """Return the optional features supported by this coordinator.
+
+        Older coordinators do not provide this procedure at all.
+        """
+        return [
+            'changes',
+            'filter_groups',
+            'metrics',
+            'reservation_changed',
+            'resources_changed',
+            'set_resources',
+        ]
+
     def _get_resources(self):
-        result = {}
-        for session in self.sessions.values():
-            if isinstance(session, ExporterSession):
-                result[session.name] = session.get_resources()
-        return result
+        # the snapshot is replaced instead of modified on changes, so it can
+        # be returned without holding any lock
+        if self.resources_snapshot is None:
+            result = {}
+            for session in self.sessions.values():
+                if isinstance(session, ExporterSession):
+                    result[session.name] = session.get_resources()
+            self.resources_snapshot = result
+        return self.resources_snapshot
 
-    @locked
     async def get_resources(self, details=None):
         return self._get_resources()
 
-    @locked
+    def _update_metrics(self):
+        """Set the gauges for the current state."""
+        self.metrics.clear_gauges()
+        sessions = defaultdict(int)
+        resources = 0
+        for session in self.sessions.values():
+            if isinstance(session, ExporterSession):
+                sessions['exporter'] += 1
+                resources += sum(len(group) for group in session.groups.values())
+                if session.rtt is not None:
+                    self.metrics.set('exporter_rtt_seconds', session.rtt, exporter=session.name)
+            else:
+                sessions['client'] += 1
+        for kind in ('client', 'exporter'):
+            self.metrics.set('sessions', sessions[kind], type=kind)
+        self.metrics.set('places', len(self.places))
+        self.metrics.set('places_acquired', sum(1 for p in self.places.values() if p.acquired))
+        self.metrics.set('resources', resources)
+        states = defaultdict(int)
+        for res in self.reservations.values():
+            states[res.state.name] += 1
+        for state in ReservationState:
+            self.metrics.set('reservations', states[state.name], state=state.name)
+        self.metrics.set('revision', self.revision)
+
+    def render_metrics(self):
+        """Return the metrics in the Prometheus text format."""
+        self._update_metrics()
+        return self.metrics.render()
+
+    async def get_metrics(self, details=None):
+        self._update_metrics()
+        return self.metrics.asdict()
+
+    @place_locked
     async def add_place(self, name, details=None):
         if not name or not isinstance(name, str):
             return False
@@ -456,24 +888,25 @@ class CoordinatorComponent(ApplicationSession):
             return False
         place = Place(name)
         self.places[name] = place
+        self._update_place_tags(place)
         self._publish_place(place)
         self.save_later()
         return True
 
-    @locked
+    @place_locked
     async def del_place(self, name, details=None):
         if not name or not isinstance(name, str):
             return False
         if name not in self.places:
             return False
+        self.match_index.remove_place(self.places[name])
+        self.tag_index.remove(name)
         del self.places[name]
-        self.publish(
-            'org.labgrid.coordinator.place_changed', name, {}
-        )
+        self._publish_place_data(name, {})
         self.save_later()
         return True
 
-    @locked
+    @place_locked
     async def add_place_alias(self, placename, alias, details=None):
         try:
             place = self.places[placename]
@@ -485,7 +918,7 @@ class CoordinatorComponent(ApplicationSession):
         self.save_later()
         return True
 
-    @locked
+    @place_locked
     async def del_place_alias(self, placename, alias, details=None):
         try:
             place = self.places[placename]
@@ -500,7 +933,7 @@ class CoordinatorComponent(ApplicationSession):
         self.save_later()
         return True
 
-    @locked
+    @place_locked
     async def set_place_tags(self, placename, tags, details=None):
         try:
             place = self.places[placename]
@@ -522,12 +955,13 @@ class CoordinatorComponent(ApplicationSession):
                     pass
             else:
                 place.tags[k] = v
+        self._update_place_tags(place)
         place.touch()
         self._publish_place(place)
         self.save_later()
         return True
 
-    @locked
+    @place_locked
     async def set_place_comment(self, placename, comment, details=None):
         try:
             place = self.places[placename]
@@ -539,7 +973,7 @@ class CoordinatorComponent(ApplicationSession):
         self.save_later()
         return True
 
-    @locked
+    @place_locked
     async def add_place_match(self, placename, pattern, rename=None, details=None):
         try:
             place = self.places[placename]
@@ -549,12 +983,13 @@ class CoordinatorComponent(ApplicationSession):
         if match in place.matches:
             return False
         place.matches.append(match)
+        self.match_index.add(place.name, match)
         place.touch()
         self._publish_place(place)
         self.save_later()
         return True
 
-    @locked
+    @place_locked
     async def del_place_match(self, placename, pattern, rename=None, details=None):
         try:
             place = self.places[placename]
@@ -565,11 +1000,22 @@ class CoordinatorComponent(ApplicationSession):
             place.matches.remove(match)
         except ValueError:
             return False
+        self.match_index.remove(place.name, match)
         place.touch()
         self._publish_place(place)
         self.save_later()
         return True
 
+    async def _acquire_resource(self, place, resource):
+        try:
+            # this triggers an update from the exporter which is published
+            # to the clients
+            await self.call(f'org.labgrid.exporter.{resource.path[0]}.acquire',
+                            resource.path[1], resource.path[3], place.name)
+        except:
+            self.log.error("failed to acquire %s", resource.path)
+            raise
+
     async def _acquire_resources(self, place, resources):
         resources = resources.copy() # we may modify the list
         # all resources need to be free
@@ -577,17 +1023,17 @@ class CoordinatorComponent(ApplicationSession):
             if resource.acquired:
                 return False
 
-        # acquire resources
-        acquired = []
-        try:
-            for resource in resources:
-                # this triggers an update from the exporter which is published
-                # to the clients
-                await self.call(f'org.labgrid.exporter.{resource.path[0]}.acquire',
-                                resource.path[1], resource.path[3], place.name)
-                acquired.append(resource)
-        except:
-            print(f"failed to acquire {resource}")
+        # acquire resources, the calls for all exporters are issued
+        # concurrently and pipelined for each exporter
+        results = await asyncio.gather(
+            *[self._acquire_resource(place, resource) for resource in resources],
+            return_exceptions=True,
+        )
+        acquired = [
+            resource for resource, result in zip(resources, results)
+            if not isinstance(result, BaseException)
+        ]
+        if len(acquired) != len(resources):
             # cleanup
             await self._release_resources(place, acquired)
             return False
@@ -597,6 +1043,20 @@ class CoordinatorComponent(ApplicationSession):
 
         return True
 
+    async def _release_resource(self, resource):
+        try:
+            # this triggers an update from the exporter which is published
+            # to the clients
+            await self.call(f'org.labgrid.exporter.{resource.path[0]}.release',
+                            resource.path[1], resource.path[3])
+        except:
+            self.log.error("failed to release %s", resource.path)
+            # at leaset try to notify the clients
+            try:
+                self._publish_resource(resource)
+            except:
+                pass
+
     async def _release_resources(self, place, resources, callback=True):
         resources = resources.copy() # we may modify the list
 
@@ -606,24 +1066,35 @@ class CoordinatorComponent(ApplicationSession):
             except ValueError:
                 pass
 
-        for resource in resources:
-            try:
-                # this triggers an update from the exporter which is published
-                # to the clients
-                if callback:
-                    await self.call(f'org.labgrid.exporter.{resource.path[0]}.release',
-                                    resource.path[1], resource.path[3])
-            except:
-                print(f"failed to release {resource}")
-                # at leaset try to notify the clients
-                try:
-                    self._publish_resource(resource)
-                except:
-                    pass
+        if callback:
+            await asyncio.gather(*[self._release_resource(resource) for resource in resources])
 
-    @locked
+    def _get_place_resources(self, place):
+        """Return the resources matching the place.
+
+        Literal exporter and group names in the matches are looked up directly
+        instead of checking all resources.
+        """
+        resources = {}
+        for key, session in self.sessions.items():
+            if not isinstance(session, ExporterSession):
+                continue
+            for match in place.matches:
+                if is_literal(match.exporter) and match.exporter != session.name:
+                    continue
+                if is_literal(match.group):
+                    groups = [(match.group, session.groups.get(match.group, {}))]
+                else:
+                    groups = session.groups.items()
+                for group_name, group in groups:
+                    for resource_name, resource in group.items():
+                        if match.ismatch(resource.path):
+                            resources[(key, group_name, resource_name)] = resource
+        return [resource for _, resource in sorted(resources.items())]
+
+    @place_locked
     async def acquire_place(self, name, details=None):
-        print(details)
+        self.log.debug("acquire place", extra={'fields': {'place': name, 'caller': details.caller}})
         try:
             place = self.places[name]
         except KeyError:
@@ -636,30 +1107,21 @@ class CoordinatorComponent(ApplicationSession):
                 return False
         # FIXME use the session object instead? or something else which
         # survives disconnecting clients?
-        place.acquired = self.sessions[details.caller].name
-        resources = []
-        for _, session in sorted(self.sessions.items()):
-            if not isinstance(session, ExporterSession):
-                continue
-            for _, group in sorted(session.groups.items()):
-                for _, resource in sorted(group.items()):
-                    if not place.hasmatch(resource.path):
-                        continue
-                    resources.append(resource)
+        acquired = self.sessions[details.caller].name
+        resources = self._get_place_resources(place)
         if not await self._acquire_resources(place, resources):
-            # revert earlier change
-            place.acquired = None
             return False
+        place.acquired = acquired
         place.touch()
         self._publish_place(place)
         self.save_later()
-        self.schedule_reservations()
-        print(f"{place.name}: place acquired by {place.acquired}")
+        await self._schedule_reservations()
+        self.log.info("place acquired", extra={'fields': {'place': place.name, 'by': place.acquired}})
         return True
 
-    @locked
+    @place_locked
     async def release_place(self, name, details=None):
-        print(details)
+        self.log.debug("release place", extra={'fields': {'place': name, 'caller': details.caller}})
         try:
             place = self.places[name]
         except KeyError:
@@ -671,14 +1133,15 @@ class CoordinatorComponent(ApplicationSession):
 
         place.acquired = None
         place.allowed = set()
+        self.schedule_places.add(place.name)
         place.touch()
         self._publish_place(place)
         self.save_later()
-        self.schedule_reservations()
-        print(f"{place.name}: place released")
+        await self._schedule_reservations()
+        self.log.info("place released", extra={'fields': {'place': place.name}})
         return True
 
-    @locked
+    @place_locked
     async def release_place_from(self, name, acquired, details=None):
         """
         Release a place, but only if acquired by a specific user
@@ -708,13 +1171,14 @@ class CoordinatorComponent(ApplicationSession):
 
         place.acquired = None
         place.allowed = set()
+        self.schedule_places.add(place.name)
         place.touch()
         self._publish_place(place)
         self.save_later()
-        self.schedule_reservations()
+        await self._schedule_reservations()
         return True
 
-    @locked
+    @place_locked
     async def allow_place(self, name, user, details=None):
         try:
             place = self.places[name]
@@ -731,16 +1195,177 @@ class CoordinatorComponent(ApplicationSession):
         return True
 
     def _get_places(self):
-        return {k: v.asdict() for k, v in self.places.items()}
+        # only published changes are included, so that the intermediate state
+        # of a place during acquire_place() or release_place() is not visible
+        if self.places_snapshot is None:
+            self.places_snapshot = dict(self.place_data)
+        return self.places_snapshot
 
-    @locked
     async def get_places(self, details=None):
         return self._get_places()
 
+    async def get_changes(self, since_revision, epoch=None, details=None):
+        """Return the places and resources changed after since_revision.
+
+        If the change log no longer covers the requested revision or the
+        epoch does not match (because the coordinator was restarted), a full
+        snapshot is returned instead, with 'full' set to True and 'places' and
+        'resources' in the format of get_places() and get_resources().
+        Otherwise, 'places' maps changed place names to their data and
+        'resources' is a list of (exporter, group, name, data). Empty data
+        means that the place or resource was deleted.
+        """
+        result = {
+            'epoch': self.epoch,
+            'revision': self.revision,
+        }
+        oldest = self.changes[0][0] if self.changes else self.revision + 1
+        if epoch != self.epoch or not oldest - 1 <= since_revision <= self.revision:
+            result['full'] = True
+            result['places'] = self._get_places()
+            result['resources'] = self._get_resources()
+            return result
+
+        places = {}
+        resources = {}
+        # newest first, only the latest state is needed
+        for revision, kind, key, data in reversed(self.changes):
+            if revision <= since_revision:
+                break
+            if kind == 'place':
+                places.setdefault(key, data)
+            else:
+                resources.setdefault(key, data)
+        result['full'] = False
+        result['places'] = places
+        result['resources'] = [[*path, data] for path, data in resources.items()]
+        return result
+
+    async def _schedule_reservations(self):
+        async with self.lock:
+            start = time.monotonic()
+            self.schedule_reservations()
+            self._update_ranks()
+            self.metrics.observe('schedule_duration_seconds', time.monotonic() - start)
+
+    def _log_reservation(self, res, msg="reservation state changed"):
+        self.log.info(msg, extra={'fields': {
+            'owner': res.owner, 'token': res.token, 'state': res.state.name,
+        }})
+
+    def _get_reservation_data(self):
+        return {token: res.asdict() for token, res in self.reservations.items()}
+
+    def _save_reservation(self, token, data):
+        """Record a changed or deleted (if data is empty) reservation in the
+        journal."""
+        data = {k: v for k, v in data.items() if k != 'rank'}
+        self.journal.set_reservation(token, data)
+        self.save_later()
+
+    def _publish_reservation(self, token, data):
+        """Notify the clients about a changed or deleted (if data is empty)
+        reservation and record it in the journal."""
+        self.publish(
+            'org.labgrid.coordinator.reservation_changed', token, data
+        )
+        self._save_reservation(token, data)
+
+    def _get_active_reservations(self):
+        return [
+            res for res in self.reservations.values()
+            if res.state in (ReservationState.allocated, ReservationState.acquired)
+        ]
+
+    def _get_prio(self, res, now):
+        if self.policy is None:
+            return res.prio
+        return self.policy.level(res, now)
+
+    def _order_reservations(self, reservations):
+        """Return the waiting reservations in the order in which they should
+        be allocated."""
+        if self.policy is None:
+            return sorted(reservations, key=lambda x: (-x.prio, x.created))
+        return self.policy.order(reservations, self._get_active_reservations(), time.time())
+
+    def _update_ranks(self):
+        """Update the positions of the waiting reservations in the queue,
+        which are only reported with a fair-share policy."""
+        if self.policy is None:
+            return
+        waiting = []
+        for res in self.reservations.values():
+            if res.state is ReservationState.waiting:
+                waiting.append(res)
+            else:
+                res.rank = None
+        for rank, res in enumerate(self._order_reservations(waiting), 1):
+            res.rank = rank
+
+    def _allocate(self, reservations, available_places):
+        """Return the new allocations (name -> place names) by token for the
+        reservations, which are ordered by priority and age.
+
+        Gang reservations (with several filter groups or counts) only get
+        allocated if there is a place for each of them. Within each priority,
+        they are handled first, as they would be starved by the other
+        reservations otherwise.
+        """
+        places = {name: TagSet(name, self.tag_index.tags[name]) for name in available_places}
+        now = time.time()
+        result = {}
+        if any(res.gang for res in reservations):
+            tiers = [
+                list(tier) for _, tier in groupby(reservations, key=lambda x: self._get_prio(x, now))
+            ]
+        else:
+            tiers = [reservations]
+        for tier in tiers:
+            for res in tier:
+                if not res.gang:
+                    continue
+                filters = []
+                for group, filter_ in res.filters.items():
+                    for i in range(res.counts.get(group, 1)):
+                        filters.append(TagSet(f'{group}/{i}', set(filter_.items())))
+                allocation = schedule_all(list(places.values()), filters)
+                if not allocation:
+                    continue
+                result[res.token] = {group: [] for group in res.filters}
+                for f in filters:
+                    place_name = allocation[f.name]
+                    result[res.token][f.name.rsplit('/', 1)[0]].append(place_name)
+                    del places[place_name]
+                for group in result[res.token].values():
+                    group.sort()
+
+            filters = []
+            for res in tier:
+                if res.gang:
+                    continue
+                (filter_,) = res.filters.values()
+                prio = float(self._get_prio(res, now))
+                filters.append(TagSet(res.token, set(filter_.items()), prio=prio))
+            if not filters:
+                continue
+            allocation = schedule(list(places.values()), filters, mode=self.scheduler)
+            for token, place_name in allocation.items():
+                (group,) = self.reservations[token].filters
+                result[token] = {group: [place_name]}
+                del places[place_name]
+        return result
+
     def schedule_reservations(self):
         # The primary information is stored in the reservations and the places
         # only have a copy for convenience.
 
+        # clients waiting for a reservation are notified about changes of the
+        # state or the allocations
+        old_states = {
+            token: (res.state, dict(res.allocations)) for token, res in self.reservations.items()
+        }
+
         # expire reservations
         for res in list(self.reservations.values()):
             if res.state is ReservationState.acquired:
@@ -752,10 +1377,10 @@ class CoordinatorComponent(ApplicationSession):
                 res.state = ReservationState.expired
                 res.allocations.clear()
                 res.refresh()
-                print(f'reservation ({res.owner}/{res.token}) is now {res.state.name}')
+                self._log_reservation(res)
             else:
                 del self.reservations[res.token]
-                print(f'removed {res.state.name} reservation ({res.owner}/{res.token})')
+                self._log_reservation(res, "removed reservation")
 
         # check which places are already allocated and handle state transitions
         allocated_places = set()
@@ -769,7 +1394,8 @@ class CoordinatorComponent(ApplicationSession):
                         res.state = ReservationState.invalid
                         res.allocations.clear()
                         res.refresh(300)
-                        print(f'reservation ({res.owner}/{res.token}) is now {res.state.name}')
+                        self._log_reservation(res)
+                        continue
                     if place.acquired is not None:
                         acquired_places.add(name)
                     assert name not in allocated_places, "conflicting allocation"
@@ -778,74 +1404,113 @@ class CoordinatorComponent(ApplicationSession):
                 # an allocated place was acquired
                 res.state = ReservationState.acquired
                 res.refresh()
-                print(f'reservation ({res.owner}/{res.token}) is now {res.state.name}')
+                self._log_reservation(res)
             if not acquired_places and res.state is ReservationState.acquired:
                 # all allocated places were released
                 res.state = ReservationState.allocated
                 res.refresh()
-                print(f'reservation ({res.owner}/{res.token}) is now {res.state.name}')
+                self._log_reservation(res)
 
-        # check which places are available for allocation
-        available_places = set()
-        for name, place in self.places.items():
-            if place.acquired is None and place.reservation is None:
-                available_places.add(name)
-        assert not (available_places & allocated_places), "inconsistent allocation"
-        available_places -= allocated_places
+        def is_available(name):
+            place = self.places.get(name)
+            if place is None or place.acquired is not None or place.reservation is not None:
+                return False
+            assert name not in allocated_places, "inconsistent allocation"
+            return True
 
-        # check which reservations should be handled, ordered by priority and age
+        # The previous run allocated all possible combinations of available
+        # places and waiting reservations, so only places which became
+        # available or changed their tags and new reservations can lead to
+        # new allocations. Other places can't match any of the reservations
+        # relevant for this run.
+        # This also holds for gang reservations, as long as all available
+        # places matching any of their filter groups are considered.
+        changed_places = {name for name in self.schedule_places if is_available(name)}
+        changed_tags = [self.tag_index.tags[name] for name in changed_places]
+        # reservations which were held back by a cap need to be checked again
+        self.schedule_tokens |= self.schedule_capped
+        available_places = set(changed_places)
         pending_reservations = []
-        for res in sorted(self.reservations.values(), key=lambda x: (-x.prio, x.created)):
+        for res in self.reservations.values():
             if res.state is not ReservationState.waiting:
                 continue
-            pending_reservations.append(res)
-
-        # run scheduler
-        place_tagsets = []
-        for name in available_places:
-            tags = set(self.places[name].tags.items())
-            # support place names
-            tags |= {('name', name)}
-            # support place aliases
-            place_tagsets.append(TagSet(name, tags))
-        filter_tagsets = []
-        for res in pending_reservations:
-            filter_tagsets.append(TagSet(res.token, set(res.filters['main'].items())))
-        allocation = schedule(place_tagsets, filter_tagsets)
+            groups = [set(filter_.items()) for filter_ in res.filters.values()]
+            if res.token not in self.schedule_tokens and not any(
+                    tags <= place_tags for tags in groups for place_tags in changed_tags):
+                continue
+            matches = set()
+            for tags in groups:
+                matches |= {name for name in self.tag_index.match(tags) if is_available(name)}
+            if matches:
+                available_places |= matches
+                pending_reservations.append(res)
+        self.schedule_places = set()
+        self.schedule_tokens = set()
+
+        # run scheduler, the reservations are ordered by priority and age or
+        # by the policy
+        pending_reservations = self._order_reservations(pending_reservations)
+        if self.policy is not None:
+            pending_reservations, capped = self.policy.limit(
+                pending_reservations, self._get_active_reservations()
+            )
+            self.schedule_capped = {res.token for res in capped}
+        allocations = self._allocate(pending_reservations, available_places)
 
         # apply allocations
-        for res_token, place_name in allocation.items():
+        for res_token, allocation in allocations.items():
             res = self.reservations[res_token]
-            res.allocations = {'main': [place_name]}
+            res.allocations = allocation
             res.state = ReservationState.allocated
             res.refresh()
-            print(f'reservation ({res.owner}/{res.token}) is now {res.state.name}')
+            self._log_reservation(res)
 
-        # update reservation property of each place and notify
-        old_map = {}
-        for place in self.places.values():
-            old_map[place.name] = place.reservation
-            place.reservation = None
+        # update reservation property of the changed places and notify
+        old_map = self.place_reservations
         new_map = {}
         for res in self.reservations.values():
             if not res.allocations:
                 continue
-            assert len(res.allocations) == 1, "only one filter group is implemented"
             for group in res.allocations.values():
                 for name in group:
                     assert name not in new_map, "conflicting allocation"
                     new_map[name] = res.token
-                    place = self.places.get(name)
-                    assert place is not None, "invalid allocation"
-                    place.reservation = res.token
+                    assert name in self.places, "invalid allocation"
+        self.place_reservations = new_map
         for name in old_map.keys() | new_map.keys():
-            if old_map.get(name) != new_map.get(name):
-                self._publish_place(place)
+            if old_map.get(name) == new_map.get(name):
+                continue
+            place = self.places.get(name)
+            if place is None:
+                continue  # deleted
+            place.reservation = new_map.get(name)
+            if place.reservation is None:
+                # available again in the next run
+                self.schedule_places.add(name)
+            self._publish_place(place)
 
-    @locked
-    async def create_reservation(self, spec, prio=0.0, details=None):
-        filter_ = {}
+        for token, old_state in old_states.items():
+            res = self.reservations.get(token)
+            if res is None:
+                self._publish_reservation(token, {})
+            elif old_state != (res.state, res.allocations):
+                self._publish_reservation(token, res.asdict())
+
+    async def create_reservation(self, spec, prio=0.0, counts=None, details=None):
+        """Create a reservation for the filters in spec.
+
+        The spec consists of KEY=VALUE pairs, each optionally prefixed with
+        the name of a filter group ("GROUP:KEY=VALUE", default "main"). The
+        counts specify how many places are needed for a group, if more than
+        one.
+        """
+        filters = {}
         for pair in spec.split():
+            group = 'main'
+            if ':' in pair.split('=', 1)[0]:
+                group, pair = pair.split(':', 1)
+            if not TAG_KEY.match(group):
+                return None
             try:
                 k, v = pair.split('=')
             except ValueError:
@@ -854,42 +1519,66 @@ class CoordinatorComponent(ApplicationSession):
                 return None
             if not TAG_VAL.match(v):
                 return None
-            filter_[k] = v
+            filters.setdefault(group, {})[k] = v
+        if not filters:
+            filters['main'] = {}
 
-        filters = {'main': filter_} # currently, only one group is implemented
+        counts = counts or {}
+        if not isinstance(counts, dict):
+            return None
+        for group, count in counts.items():
+            if group not in filters or not isinstance(count, int) or count < 1:
+                return None
+        counts = {group: count for group, count in counts.items() if count > 1}
 
         owner = self.sessions[details.caller].name
-        res = Reservation(owner=owner, prio=prio, filters=filters)
+        res = Reservation(owner=owner, prio=prio, filters=filters, counts=counts)
         self.reservations[res.token] = res
-        self.schedule_reservations()
+        self._save_reservation(res.token, res.asdict())
+        self.schedule_tokens.add(res.token)
+        await self._schedule_reservations()
         return {res.token: res.asdict()}
 
-    @locked
     async def cancel_reservation(self, token, details=None):
         if not isinstance(token, str):
             return False
         if token not in self.reservations:
             return False
         del self.reservations[token]
-        self.schedule_reservations()
+        self._publish_reservation(token, {})
+        await self._schedule_reservations()
         return True
 
-    @locked
-    async def poll_reservation(self, token, details=None):
+    # the reservations are only modified synchronously, so no lock is needed
+    # to read them
+    async def poll_reservation(self, token, timeout=60, details=None):
+        """Refresh the reservation and return it.
+
+        Clients waiting for the reservation_changed event can keep a waiting
+        reservation alive for a longer timeout (in seconds, at most 5
+        minutes) instead of polling often.
+        """
         try:
             res = self.reservations[token]
         except KeyError:
             return None
-        res.refresh()
+        if res.state is ReservationState.waiting:
+            res.refresh(min(timeout, 300))
+        else:
+            res.refresh()
         return res.asdict()
 
-    @locked
     async def get_reservations(self, details=None):
         return {k: v.asdict() for k, v in self.reservations.items()}
 
 if __name__ == '__main__':
+    setup_logging(
+        level=environ.get('LG_COORDINATOR_LOGLEVEL', 'INFO').upper(),
+        rate=float(environ.get('LG_COORDINATOR_LOGRATE', '10')),
+    )
     runner = ApplicationRunner(
         url=environ.get("WS", "ws://127.0.0.1:20408/ws"),
         realm="realm1",
+        serializers=get_serializers(),
     )
     runner.run(CoordinatorComponent)
@@ -2,6 +2,7 @@
 them available to other clients on the same coordinator"""
 import argparse
 import asyncio
+import functools
 import logging
 import sys
 import os
@@ -15,10 +16,12 @@ from pathlib import Path
 from typing import Dict, Type
 from socket import gethostname, getfqdn
 import attr
+from autobahn import wamp
 from autobahn.asyncio.wamp import ApplicationRunner, ApplicationSession
 
 from .config import ResourceConfig
-from .common import ResourceEntry, enable_tcp_nodelay
+from .common import ResourceEntry, enable_tcp_nodelay, get_serializers
+from .serialserver import PROTOCOLS, PortGate, SerialServer
 from ..util import get_free_port
 
 try:
@@ -50,6 +53,15 @@ def log_subprocess_kernel_stack(logger, child):
         return
     logger.info("current kernel stack of %s is:\n%s", child.args, stack)
 
+@functools.lru_cache(maxsize=None)
+def get_ser2net_version(ser2net_bin):
+    """Return the version of the ser2net binary as a tuple of ints, which is
+    only checked once per exporter."""
+    output = subprocess.check_output([ser2net_bin, '-v'], universal_newlines=True)
+    version = output.split()[-1]
+    return tuple(int(x) for x in version.split('.') if x.isdigit())
+
+
 @attr.s(eq=False)
 class ResourceExport(ResourceEntry):
     """Represents a local resource exported via a specific protocol.
@@ -62,6 +74,8 @@ class ResourceExport(ResourceEntry):
     local = attr.ib(init=False)
     local_params = attr.ib(init=False)
     start_params = attr.ib(init=False)
+    # keep the local resource started while it is not acquired
+    warm = False
 
     def __attrs_post_init__(self):
         super().__attrs_post_init__()
@@ -133,7 +147,7 @@ class ResourceExport(ResourceEntry):
 
         if self.broken:
             pass  # don't touch broken resources
-        elif self.local.avail and self.acquired:
+        elif self.local.avail and (self.acquired or self.warm):
             start_params = self._get_start_params()
             if self.start_params is None:
                 self.start()
@@ -175,10 +189,21 @@ class ResourceExport(ResourceEntry):
         super().release(*args, **kwargs)
         self.poll()
 
+    async def settle(self):
+        """Wait until a start or stop of the local resource has completed,
+        without blocking the event loop"""
+        pass
+
 
 @attr.s(eq=False)
 class SerialPortExport(ResourceExport):
-    """ResourceExport for a USB or Raw SerialPort"""
+    """ResourceExport for a USB or Raw SerialPort
+
+    With warm, ser2net is already started while the port is available and
+    listens on a local port. The published port is a PortGate, which only
+    forwards connections while the resource is acquired.
+    """
+    warm = attr.ib(default=False, validator=attr.validators.instance_of(bool))
 
     def __attrs_post_init__(self):
         super().__attrs_post_init__()
@@ -191,24 +216,52 @@ class SerialPortExport(ResourceExport):
         self.data['cls'] = "NetworkSerialPort"
         self.child = None
         self.port = None
-        self.ser2net_bin = shutil.which("ser2net")
-        if self.ser2net_bin is None:
+        self.settle_deadline = None
+        self.stopping = set()
+        self.gate = None
+        self.ser2net_bin = self._find_ser2net()
+
+    def _find_ser2net(self):  # pylint: disable=no-self-use
+        ser2net_bin = shutil.which("ser2net")
+        if ser2net_bin is None:
             if os.path.isfile("/usr/sbin/ser2net"):
-                self.ser2net_bin = "/usr/sbin/ser2net"
+                ser2net_bin = "/usr/sbin/ser2net"
 
-            if self.ser2net_bin is None:
+            if ser2net_bin is None:
                 warnings.warn("ser2net binary not found, falling back to /usr/bin/ser2net")
-                self.ser2net_bin = "/usr/bin/ser2net"
+                ser2net_bin = "/usr/bin/ser2net"
+        return ser2net_bin
 
     def __del__(self):
         if self.child is not None:
             self.stop()
+        if self.gate is not None:
+            self.gate.close()
 
     def _get_start_params(self):
         return {
             'path': self.local.port,
         }
 
+    def poll(self):
+        dirty = super().poll()
+        self._allow(bool(self.acquired))
+        return dirty
+
+    def _allow(self, allowed):
+        """Only allow connections while acquired"""
+        if self.gate is not None and self.gate.allowed != allowed:
+            self.gate.allow(allowed)
+
+    def _open_gate(self):
+        """Open the gate on first use, returning its stable port"""
+        if self.gate is None:
+            gate = PortGate(logger=self.logger)
+            gate.open()
+            self.gate = gate
+            asyncio.ensure_future(gate.start())
+        return self.gate.port
+
     def _get_params(self):
         """Helper function to return parameters"""
         return {
@@ -221,21 +274,28 @@ class SerialPortExport(ResourceExport):
         }
 
     def _start(self, start_params):
-        """Start ``ser2net`` subprocess"""
+        """Start ``ser2net`` subprocess, settle() waits until it is ready"""
         assert self.local.avail
         assert self.child is None
         assert start_params['path'].startswith('/dev/')
         self.port = get_free_port()
+        address = f'{self.port}'
+        if self.warm:
+            # only reachable through the gate
+            address = f'127.0.0.1,{self.port}'
+            target_port = self.port
+            self.port = self._open_gate()
+            self.gate.target_port = target_port
 
         # Ser2net has switched to using YAML format at version 4.0.0.
-        _, _, version = str(subprocess.check_output([self.ser2net_bin,'-v'])).split(' ')
-        major_version = version.split('.')[0]
-        if int(major_version) >= 4:
+        if get_ser2net_version(self.ser2net_bin) >= (4,):
+            if self.warm:
+                address = f'tcp,{address}'
             cmd = [
                 self.ser2net_bin,
                 '-d',
                 '-n',
-                '-Y', f'connection: &con01#  accepter: telnet(rfc2217,mode=server),{self.port}',
+                '-Y', f'connection: &con01#  accepter: telnet(rfc2217,mode=server),{address}',
                 '-Y', f'  connector: serialdev(nouucplock=true),{start_params["path"]},{self.local.speed}n81,local',  # pylint: disable=line-too-long
                 '-Y', '  options:',
                 '-Y', '    max-connections: 10',
@@ -247,39 +307,161 @@ class SerialPortExport(ResourceExport):
                 '-n',
                 '-u',
                 '-C',
-                f'{self.port}:telnet:0:{start_params["path"]}:{self.local.speed} NONE 8DATABITS 1STOPBIT LOCAL',  # pylint: disable=line-too-long
+                f'{address}:telnet:0:{start_params["path"]}:{self.local.speed} NONE 8DATABITS 1STOPBIT LOCAL',  # pylint: disable=line-too-long
             ]
         self.logger.info("Starting ser2net with: %s", " ".join(cmd))
         self.child = subprocess.Popen(cmd)
-        try:
-            self.child.wait(timeout=0.5)
-            raise ExporterError(f"ser2net for {start_params['path']} exited immediately")
-        except subprocess.TimeoutExpired:
-            # good, ser2net didn't exit immediately
-            pass
-        self.logger.info("started ser2net for %s on port %d", start_params['path'], self.port)
+        # ser2net should not exit during the first 0.5 seconds
+        self.settle_deadline = time.monotonic() + 0.5
 
     def _stop(self, start_params):
-        """Stop ``ser2net`` subprocess"""
+        """Stop ``ser2net`` subprocess, settle() waits until it has exited"""
         assert self.child
         child = self.child
         self.child = None
         port = self.port
         self.port = None
+        self.settle_deadline = None
+        if self.gate is not None:
+            # ser2net listens on the local target port, not the gate's port
+            port = self.gate.target_port
+            self.gate.target_port = None
         child.terminate()
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._wait_stopped(child, start_params['path'], port)
+            return
+        task = loop.create_task(self._wait_stopped_async(child, start_params['path'], port))
+        self.stopping.add(task)
+        task.add_done_callback(self.stopping.discard)
+
+    def _wait_stopped(self, child, path, port):
         try:
             child.wait(2.0)  # ser2net takes about a second to react
         except subprocess.TimeoutExpired:
-            self.logger.warning("ser2net for %s still running after SIGTERM", start_params['path'])
+            self.logger.warning("ser2net for %s still running after SIGTERM", path)
             log_subprocess_kernel_stack(self.logger, child)
             child.kill()
             child.wait(1.0)
-        self.logger.info("stopped ser2net for %s on port %d", start_params['path'], port)
+        self.logger.info("stopped ser2net for %s on port %d", path, port)
+
+    async def _wait_stopped_async(self, child, path, port):
+        deadline = time.monotonic() + 2.0  # ser2net takes about a second to react
+        while child.poll() is None and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if child.poll() is None:
+            self.logger.warning("ser2net for %s still running after SIGTERM", path)
+            log_subprocess_kernel_stack(self.logger, child)
+            child.kill()
+            deadline = time.monotonic() + 1.0
+            while child.poll() is None and time.monotonic() < deadline:
+                await asyncio.sleep(0.05)
+        self.logger.info("stopped ser2net for %s on port %d", path, port)
+
+    async def settle(self):
+        if self.stopping:
+            await asyncio.wait(list(self.stopping))
+        while self.child is not None and self.settle_deadline is not None:
+            if self.child.poll() is not None:
+                path = self.start_params['path']
+                self.child = None
+                self.port = None
+                self.start_params = None
+                self.settle_deadline = None
+                self.broken = "start failed"
+                self.poll()
+                raise ExporterError(f"ser2net for {path} exited immediately")
+            if time.monotonic() >= self.settle_deadline:
+                self.settle_deadline = None
+                self.logger.info("started ser2net for %s on port %d",
+                                 self.start_params['path'], self.port)
+                break
+            await asyncio.sleep(0.05)
 
 
 exports["USBSerialPort"] = SerialPortExport
 exports["RawSerialPort"] = SerialPortExport
 
+
+@attr.s(eq=False)
+class SerialServerExport(SerialPortExport):
+    """SerialPortExport served from the exporter's event loop instead of by
+    ser2net
+
+    With warm, the server keeps its port and refuses connections while the
+    resource is not acquired.
+    """
+    protocol = attr.ib(default='rfc2217', validator=attr.validators.in_(PROTOCOLS))
+
+    def __attrs_post_init__(self):
+        super().__attrs_post_init__()
+        self.server = None
+        self.starting = None
+        self.warm_port = 0
+
+    def _allow(self, allowed):
+        if self.warm and self.server is not None and self.server.allowed != allowed:
+            self.server.allow(allowed)
+
+    def _find_ser2net(self):
+        return None
+
+    def __del__(self):
+        if self.server is not None:
+            self.server.close()
+
+    def _get_params(self):
+        """Helper function to return parameters"""
+        params = super()._get_params()
+        params['protocol'] = self.protocol
+        return params
+
+    def _start(self, start_params):
+        """Open the serial port and start serving it"""
+        assert self.local.avail
+        assert self.server is None
+        assert start_params['path'].startswith('/dev/')
+        server = SerialServer(start_params['path'], self.local.speed, protocol=self.protocol,
+                              port=self.warm_port, logger=self.logger)
+        if self.warm:
+            server.allowed = bool(self.acquired)
+        self.port = server.open()
+        if self.warm:
+            self.warm_port = self.port
+        self.server = server
+        self.starting = asyncio.ensure_future(server.start())
+
+    def _stop(self, start_params):
+        """Stop serving the serial port"""
+        assert self.server
+        server = self.server
+        self.server = None
+        self.port = None
+        if self.starting is not None:
+            self.starting.cancel()
+            self.starting = None
+        server.close()
+        stats = server.stats()
+        self.logger.info(
+            "stopped serving %s on port %d: %d bytes (%.1f/s) received, %d bytes (%.1f/s) sent, %d connections",  # pylint: disable=line-too-long
+            start_params['path'], server.port, stats['rx_bytes'], stats['rx_rate'],
+            stats['tx_bytes'], stats['tx_rate'], stats['total_connections'],
+        )
+
+    async def settle(self):
+        starting = self.starting
+        if starting is None:
+            return
+        try:
+            await starting
+        except asyncio.CancelledError:
+            return  # stopped meanwhile
+        if self.starting is starting:
+            self.starting = None
+            self.logger.info("serving %s with %s on port %d",
+                             self.start_params['path'], self.protocol, self.port)
+
 @attr.s(eq=False)
 class NetworkInterfaceExport(ResourceExport):
     """ResourceExport for a network interface"""
@@ -701,6 +883,8 @@ class AndroidNetFastbootExport(ResourceExport):
 exports["AndroidNetFastboot"] = AndroidNetFastbootExport
 
 class ExporterSession(ApplicationSession):
+    logger = logging.getLogger('ExporterSession')
+
     def onConnect(self):
         """Set up internal datastructures on successful connection:
         - Setup loop, name, authid and address
@@ -709,11 +893,19 @@ class ExporterSession(ApplicationSession):
         self.name = self.config.extra['name']
         self.hostname = self.config.extra['hostname']
         self.isolated = self.config.extra['isolated']
+        self.serial_server = self.config.extra.get('serial_server', 'ser2net')
+        self.warm_serial = self.config.extra.get('warm_serial', False)
         self.address = self._transport.transport.get_extra_info('sockname')[0]
         self.checkpoint = time.monotonic()
         self.poll_task = None
+        self.sweep_interval = float(os.environ.get('LG_EXPORTER_SWEEP_INTERVAL', 10.0))
+        self.watched = {}
+        self.polled = []
+        self.changed = set()
+        self.wakeup = asyncio.Event()
 
         self.groups = {}
+        self.features = set()
 
         enable_tcp_nodelay(self)
         self.join(self.config.realm, authmethods=["ticket"], authid=f"exporter/{self.name}")
@@ -736,6 +928,13 @@ class ExporterSession(ApplicationSession):
             await self.register(self.release, f'{prefix}.release')
             await self.register(self.version, f'{prefix}.version')
 
+            try:
+                self.features = set(await self.call('org.labgrid.coordinator.get_features'))
+            except wamp.exception.ApplicationError as e:
+                if e.error != "wamp.error.no_such_procedure":
+                    raise
+                self.features = set()  # old coordinator
+
             config_template_env = {
                 'env': os.environ,
                 'isolated': self.isolated,
@@ -745,6 +944,7 @@ class ExporterSession(ApplicationSession):
             resource_config = ResourceConfig(
                 self.config.extra['resources'], config_template_env
             )
+            added = []
             for group_name, group in resource_config.data.items():
                 group_name = str(group_name)
                 for resource_name, params in group.items():
@@ -755,11 +955,12 @@ class ExporterSession(ApplicationSession):
                         continue
                     cls = params.pop('cls', resource_name)
 
-                    # this may call back to acquire the resource immediately
-                    await self.add_resource(
-                        group_name, resource_name, cls, params
-                    )
-                    self.checkpoint = time.monotonic()
+                    self.add_resource(group_name, resource_name, cls, params)
+                    added.append((group_name, resource_name))
+
+            # this may call back to acquire the resources immediately
+            await self.update_resources(added)
+            self.checkpoint = time.monotonic()
 
         except Exception:  # pylint: disable=broad-except
             traceback.print_exc()
@@ -788,7 +989,13 @@ class ExporterSession(ApplicationSession):
     async def acquire(self, group_name, resource_name, place_name):
         resource = self.groups[group_name][resource_name]
         try:
+            start = time.monotonic()
             resource.acquire(place_name)
+            if isinstance(resource, ResourceExport):
+                await resource.settle()
+                resource.logger.info("acquired for %s in %.1f ms%s", place_name,
+                                     (time.monotonic() - start) * 1000,
+                                     " (warm)" if resource.warm else "")
         finally:
             await self.update_resource(group_name, resource_name)
 
@@ -796,6 +1003,8 @@ class ExporterSession(ApplicationSession):
         resource = self.groups[group_name][resource_name]
         try:
             resource.release()
+            if isinstance(resource, ResourceExport):
+                await resource.settle()
         finally:
             await self.update_resource(group_name, resource_name)
 
@@ -803,28 +1012,97 @@ class ExporterSession(ApplicationSession):
         self.checkpoint = time.monotonic()
         return __version__
 
-    async def _poll_step(self):
+    def _watch_resources(self):
+        """Register the event sources of the resource managers.
+
+        The resources of managers with an event source are only polled after
+        the manager reported a change, the resources of managers without one
+        are polled in each step. All resources are polled by the periodic
+        full sweep.
+        """
+        self.watched = {}
+        self.polled = []
         for group_name, group in self.groups.items():
             for resource_name, resource in group.items():
                 if not isinstance(resource, ResourceExport):
                     continue
-                try:
-                    changed = resource.poll()
-                except Exception:  # pylint: disable=broad-except
-                    print(f"Exception while polling {resource}", file=sys.stderr)
-                    traceback.print_exc()
-                    continue
-                if changed:
-                    await self.update_resource(group_name, resource_name)
-                else:
-                    # let other tasks run, see https://github.com/python/asyncio/issues/284
-                    await asyncio.sleep(0)
+                parent = resource.local.get_managed_parent()
+                if parent is None:
+                    continue  # nothing changes outside of acquire/release
+                self.watched.setdefault(parent.manager, []).append((group_name, resource_name))
+        for manager in list(self.watched):
+            if not manager.register_events(self.loop, self._manager_changed):
+                self.polled.extend(self.watched.pop(manager))
+
+    def _manager_changed(self, manager):
+        self.changed.add(manager)
+        self.wakeup.set()
+
+    def _take_changed(self):
+        keys = list(self.polled)
+        for manager in self.changed:
+            keys.extend(self.watched.get(manager, []))
+        self.changed.clear()
+        return keys
+
+    async def _poll_step(self, keys=None):
+        """Poll the given (group_name, resource_name) resources, or all of
+        them, and update the changed ones on the coordinator"""
+        if keys is None:
+            keys = [
+                (group_name, resource_name)
+                for group_name, group in self.groups.items()
+                for resource_name in group
+            ]
+        dirty = []
+        for group_name, resource_name in keys:
+            resource = self.groups[group_name][resource_name]
+            if not isinstance(resource, ResourceExport):
+                continue
+            try:
+                changed = resource.poll()
+            except Exception:  # pylint: disable=broad-except
+                print(f"Exception while polling {resource}", file=sys.stderr)
+                traceback.print_exc()
+                continue
+            if changed:
+                dirty.append((group_name, resource_name))
+        if not dirty:
+            return
+        # wait for the started and stopped resources concurrently
+        results = await asyncio.gather(
+            *(self.groups[group_name][resource_name].settle() for group_name, resource_name in dirty),
+            return_exceptions=True,
+        )
+        for (group_name, resource_name), result in zip(dirty, results):
+            if isinstance(result, Exception):
+                self.logger.error("failed to start %s/%s: %s", group_name, resource_name, result)
+        # publish all changes of this step together
+        await self.update_resources(dirty)
+
+    async def _wait_for_changes(self, deadline):
+        """Wait until a manager reports a change or the deadline is reached"""
+        if self.polled or self.changed:
+            return
+        self.wakeup.clear()
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), max(0.0, deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            pass
 
     async def poll(self):
+        self._watch_resources()
+        next_sweep = 0.0
         while True:
             try:
                 await asyncio.sleep(0.25)
-                await self._poll_step()
+                if time.monotonic() >= next_sweep:
+                    next_sweep = time.monotonic() + self.sweep_interval
+                    self.changed.clear()
+                    await self._poll_step()
+                else:
+                    await self._poll_step(self._take_changed())
+                await self._wait_for_changes(next_sweep)
             except asyncio.CancelledError:
                 break
             except Exception:  # pylint: disable=broad-except
@@ -834,11 +1112,10 @@ class ExporterSession(ApplicationSession):
                 print(f"missed checkpoint, exiting (last was {age} seconds ago)")
                 self.disconnect()
 
-    async def add_resource(self, group_name, resource_name, cls, params):
-        """Add a resource to the exporter and update status on the coordinator"""
-        print(
-            f"add resource {group_name}/{resource_name}: {cls}/{params}"
-        )
+    def add_resource(self, group_name, resource_name, cls, params):
+        """Add a resource to the exporter, use update_resources() to update
+        the status on the coordinator"""
+        self.logger.debug("add resource %s/%s: %s/%s", group_name, resource_name, cls, params)
         group = self.groups.setdefault(group_name, {})
         assert resource_name not in group
         export_cls = exports.get(cls, ResourceEntry)
@@ -848,7 +1125,15 @@ class ExporterSession(ApplicationSession):
             'params': params,
         }
         proxy_req = self.isolated
-        if issubclass(export_cls, ResourceExport):
+        if export_cls is SerialPortExport and self.serial_server != 'ser2net':
+            group[resource_name] = SerialServerExport(config, host=self.hostname, proxy=getfqdn(),
+                                                      proxy_required=proxy_req,
+                                                      protocol=self.serial_server,
+                                                      warm=self.warm_serial)
+        elif export_cls is SerialPortExport:
+            group[resource_name] = export_cls(config, host=self.hostname, proxy=getfqdn(),
+                                              proxy_required=proxy_req, warm=self.warm_serial)
+        elif issubclass(export_cls, ResourceExport):
             group[resource_name] = export_cls(config, host=self.hostname, proxy=getfqdn(),
                                               proxy_required=proxy_req)
         else:
@@ -857,18 +1142,34 @@ class ExporterSession(ApplicationSession):
                 'proxy_required': proxy_req,
             }
             group[resource_name] = export_cls(config)
-        await self.update_resource(group_name, resource_name)
 
     async def update_resource(self, group_name, resource_name):
         """Update status on the coordinator"""
         resource = self.groups[group_name][resource_name]
         data = resource.asdict()
-        print(data)
+        self.logger.debug("update resource %s/%s: %s", group_name, resource_name, data)
         await self.call(
             'org.labgrid.coordinator.set_resource', group_name, resource_name,
             data
         )
 
+    async def update_resources(self, resources):
+        """Update status of multiple (group_name, resource_name) resources on
+        the coordinator with a single call"""
+        if 'set_resources' not in self.features:
+            # old coordinator, send the updates without waiting for each one
+            await asyncio.gather(*(
+                self.update_resource(group_name, resource_name)
+                for group_name, resource_name in resources
+            ))
+            return
+        data = []
+        for group_name, resource_name in resources:
+            resource = self.groups[group_name][resource_name]
+            data.append((group_name, resource_name, resource.asdict()))
+            self.logger.debug("update resource %s/%s: %s", *data[-1])
+        await self.call('org.labgrid.coordinator.set_resources', data)
+
 
 def main():
     parser = argparse.ArgumentParser()
@@ -909,6 +1210,18 @@ def main():
         default=False,
         help="enable isolated mode (always request SSH forwards)"
     )
+    parser.add_argument(
+        '--warm-serial',
+        action='store_true',
+        default=bool(os.environ.get('LG_EXPORTER_WARM_SERIAL')),
+        help="keep serial ports served while they are not acquired, refusing connections until then"  # pylint: disable=line-too-long
+    )
+    parser.add_argument(
+        '--serial-server',
+        choices=('ser2net',) + PROTOCOLS,
+        default=os.environ.get('LG_EXPORTER_SERIAL_SERVER', 'ser2net'),
+        help="serve serial ports with ser2net or from the exporter itself with RFC2217 or as raw TCP (default: %(default)s)"  # pylint: disable=line-too-long
+    )
     parser.add_argument(
         'resources',
         metavar='RESOURCES',
@@ -924,7 +1237,9 @@ def main():
         'name': args.name or gethostname(),
         'hostname': args.hostname or gethostname(),
         'resources': args.resources,
-        'isolated': args.isolated
+        'isolated': args.isolated,
+        'serial_server': args.serial_server,
+        'warm_serial': args.warm_serial,
     }
 
     crossbar_url = args.crossbar
@@ -939,7 +1254,9 @@ def main():
     extra['loop'] = loop = asyncio.get_event_loop()
     if args.debug:
         loop.set_debug(True)
-    runner = ApplicationRunner(url=crossbar_url, realm=crossbar_realm, extra=extra)
+    runner = ApplicationRunner(
+        url=crossbar_url, realm=crossbar_realm, extra=extra, serializers=get_serializers()
+    )
     runner.run(ExporterSession, log_level=level)
     if reexec:
         exit(100)
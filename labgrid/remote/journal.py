@@ -0,0 +1,167 @@
+"""The remote.journal module persists the coordinator state as YAML snapshots
+plus an append-only journal of changes."""
+import json
+import os
+
+import attr
+
+from ..util import atomic_replace, yaml
+
+
+@attr.s(eq=False)
+class Journal:
+    """Append-only journal of place, resource and reservation changes on top
+    of the ``places.yaml``, ``resources.yaml`` and ``reservations.yaml``
+    snapshots.
+
+    Each change is recorded as one compact JSON line, so persisting a change
+    costs time proportional to the size of that change instead of the size of
+    the lab. The set_*() methods only mark the place, resource or reservation
+    as dirty with its latest state, so repeated changes between two saves are
+    written once. take() returns the dirty records, which must not be modified
+    afterwards, and write() serializes and appends them. Like compact(), it
+    only touches the files and can run in a worker thread. An empty data dict
+    marks a deletion, as in the WAMP events.
+    """
+    directory = attr.ib(default='.', validator=attr.validators.instance_of(str))
+    compact_size = attr.ib(default=4*1024*1024, validator=attr.validators.instance_of(int))
+
+    def __attrs_post_init__(self):
+        self.dirty = {}
+        try:
+            self.size = os.path.getsize(self.journal_file)
+        except FileNotFoundError:
+            self.size = 0
+
+    @property
+    def places_file(self):
+        return os.path.join(self.directory, 'places.yaml')
+
+    @property
+    def resources_file(self):
+        return os.path.join(self.directory, 'resources.yaml')
+
+    @property
+    def reservations_file(self):
+        return os.path.join(self.directory, 'reservations.yaml')
+
+    @property
+    def journal_file(self):
+        return os.path.join(self.directory, 'coordinator.journal')
+
+    @property
+    def needs_compaction(self):
+        return self.size >= self.compact_size
+
+    def _mark(self, key, record):
+        # replace an older record for the same key, each record contains the
+        # complete state
+        self.dirty.pop(key, None)
+        self.dirty[key] = record
+
+    def set_place(self, name, data):
+        """Record the new state of a place, or its deletion if data is empty."""
+        self._mark(('place', name), {'op': 'place', 'name': name, 'data': data})
+
+    def set_resource(self, exporter, group_name, resource_name, data):
+        """Record the new state of a resource, or its deletion if data is empty."""
+        self._mark(('resource', exporter, group_name, resource_name), {
+            'op': 'resource',
+            'path': [exporter, group_name, resource_name],
+            'data': data,
+        })
+
+    def set_reservation(self, token, data):
+        """Record the new state of a reservation, or its deletion if data is
+        empty."""
+        self._mark(('reservation', token), {'op': 'reservation', 'token': token, 'data': data})
+
+    def take(self):
+        """Return and clear the dirty records, to be passed to write()."""
+        records = list(self.dirty.values())
+        self.dirty = {}
+        return records
+
+    def write(self, records):
+        """Append the records returned by take() to the journal file."""
+        if not records:
+            return
+        data = b''.join(
+            json.dumps(record, separators=(',', ':')).encode() + b'\n' for record in records
+        )
+        with open(self.journal_file, 'ab') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        self.size += len(data)
+
+    @staticmethod
+    def _load_snapshot(filename):
+        try:
+            with open(filename, 'r') as f:
+                return yaml.load(f.read()) or {}
+        except FileNotFoundError:
+            return {}
+
+    @staticmethod
+    def _apply(places, resources, reservations, record):
+        if record['op'] == 'place':
+            if record['data']:
+                places[record['name']] = record['data']
+            else:
+                places.pop(record['name'], None)
+        elif record['op'] == 'resource':
+            exporter, group_name, resource_name = record['path']
+            groups = resources.setdefault(exporter, {})
+            group = groups.setdefault(group_name, {})
+            if record['data']:
+                group[resource_name] = record['data']
+            else:
+                group.pop(resource_name, None)
+            if not group:
+                del groups[group_name]
+            if not groups:
+                del resources[exporter]
+        elif record['op'] == 'reservation':
+            if record['data']:
+                reservations[record['token']] = record['data']
+            else:
+                reservations.pop(record['token'], None)
+        else:
+            raise ValueError(f"unknown journal record {record['op']}")
+
+    def read(self):
+        """Return the places, resources and reservations from the snapshots
+        with all journal records replayed on top."""
+        places = self._load_snapshot(self.places_file)
+        resources = self._load_snapshot(self.resources_file)
+        reservations = self._load_snapshot(self.reservations_file)
+        try:
+            with open(self.journal_file, 'rb') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # a partial record from an interrupted write can only
+                        # be at the end
+                        break
+                    self._apply(places, resources, reservations, record)
+        except FileNotFoundError:
+            pass
+        return places, resources, reservations
+
+    def write_snapshot(self, places, resources, reservations):
+        """Replace the snapshots and discard the journal.
+
+        As all records contain the complete state of a place or resource,
+        replaying them again after an interruption here is harmless.
+        """
+        atomic_replace(self.reservations_file, yaml.dump(reservations).encode())
+        atomic_replace(self.resources_file, yaml.dump(resources).encode())
+        atomic_replace(self.places_file, yaml.dump(places).encode())
+        atomic_replace(self.journal_file, b'')
+        self.size = 0
+
+    def compact(self):
+        """Merge the journal into the snapshots."""
+        self.write_snapshot(*self.read())
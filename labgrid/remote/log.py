@@ -0,0 +1,105 @@
+"""The remote.log module provides rate-limited logging through a queue, so that
+writing log messages never blocks the event loop."""
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+
+
+class FieldFormatter(logging.Formatter):
+    """Formatter appending the structured fields passed as extra={'fields':
+    {...}} as key=value pairs."""
+    def format(self, record):
+        result = super().format(record)
+        fields = getattr(record, 'fields', None)
+        if fields:
+            result += ' ' + ' '.join(f'{key}={value}' for key, value in fields.items())
+        return result
+
+
+class RateLimitFilter(logging.Filter):
+    """Token bucket per source, dropping records which exceed the rate.
+
+    The source is the 'source' field of the record if given, otherwise the
+    logger name and message template. Records at WARNING or above are never
+    dropped. The number of dropped records is added to the next record passed
+    for the source.
+    """
+    def __init__(self, rate=10.0, burst=20, clock=time.monotonic):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.buckets = {}
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        fields = getattr(record, 'fields', None) or {}
+        key = (record.name, fields.get('source', record.msg))
+        now = self.clock()
+        tokens, last, suppressed = self.buckets.get(key, (self.burst, now, 0))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        if tokens < 1:
+            self.buckets[key] = (tokens, now, suppressed + 1)
+            return False
+        if suppressed:
+            record.fields = {**fields, 'suppressed': suppressed}
+        self.buckets[key] = (tokens - 1, now, 0)
+        return True
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler which drops records instead of blocking when the queue is
+    full and leaves the formatting to the listener thread.
+
+    The number of dropped records is reported by a warning once the queue has
+    room again.
+    """
+    def __init__(self, queue_):
+        super().__init__(queue_)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # merge the arguments now, as they may be modified later, but leave
+        # the rest of the formatting to the listener
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            if self.dropped:
+                self.queue.put_nowait(logging.makeLogRecord({
+                    'name': __name__,
+                    'levelno': logging.WARNING,
+                    'levelname': logging.getLevelName(logging.WARNING),
+                    'msg': f"dropped {self.dropped} log records",
+                }))
+                self.dropped = 0
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging(level=logging.INFO, rate=10.0, burst=20, stream=None, maxsize=10000):
+    """Send the log records of the root logger through a rate-limited,
+    non-blocking queue to a stream handler running in a separate thread.
+
+    Returns the started QueueListener.
+    """
+    handler = logging.StreamHandler(stream or sys.stdout)
+    handler.setFormatter(FieldFormatter('%(asctime)s %(levelname)-7s %(name)s: %(message)s'))
+    queue_ = queue.Queue(maxsize)
+    queue_handler = NonBlockingQueueHandler(queue_)
+    queue_handler.addFilter(RateLimitFilter(rate=rate, burst=burst))
+    root = logging.getLogger()
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+    listener = logging.handlers.QueueListener(queue_, handler, respect_handler_level=True)
+    listener.start()
+    return listener
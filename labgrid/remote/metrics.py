@@ -0,0 +1,220 @@
+"""The remote.metrics module collects coordinator metrics and exposes them in
+the Prometheus text format."""
+import asyncio
+import bisect
+import time
+
+import attr
+
+DEFAULT_BUCKETS = (
+    0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+
+def _format_labels(labels, extra=()):
+    items = [*labels, *extra]
+    if not items:
+        return ''
+    escaped = (
+        (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for k, v in items
+    )
+    return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+@attr.s(eq=False)
+class Histogram:
+    """Cumulative histogram of observed values, like a Prometheus histogram."""
+    buckets = attr.ib(default=DEFAULT_BUCKETS)
+    counts = attr.ib(init=False)
+    count = attr.ib(default=0, init=False)
+    sum = attr.ib(default=0.0, init=False)
+
+    def __attrs_post_init__(self):
+        self.counts = [0] * len(self.buckets)
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """Return a list of (upper bound, cumulative count) tuples."""
+        result = []
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            result.append((bound, total))
+        result.append((float('inf'), self.count))
+        return result
+
+
+@attr.s(eq=False)
+class Metrics:
+    """Registry for counters, gauges and histograms.
+
+    Each metric is identified by its name and a set of labels, passed as
+    keyword arguments. Gauges are usually set right before the metrics are
+    rendered, so clear_gauges() removes the values of vanished sessions.
+    """
+    prefix = attr.ib(default='labgrid_coordinator_', validator=attr.validators.instance_of(str))
+    help = attr.ib(default=attr.Factory(dict), init=False)
+    counters = attr.ib(default=attr.Factory(dict), init=False)
+    gauges = attr.ib(default=attr.Factory(dict), init=False)
+    histograms = attr.ib(default=attr.Factory(dict), init=False)
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        metric = self.counters.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        metric[key] = metric.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        self.gauges.setdefault(name, {})[tuple(sorted(labels.items()))] = value
+
+    def clear_gauges(self):
+        self.gauges.clear()
+
+    def observe(self, name, value, **labels):
+        metric = self.histograms.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        histogram = metric.get(key)
+        if histogram is None:
+            histogram = metric[key] = Histogram()
+        histogram.observe(value)
+
+    def render(self):
+        """Return the metrics in the Prometheus text exposition format."""
+        lines = []
+
+        def header(name, kind):
+            if name in self.help:
+                lines.append(f'# HELP {self.prefix}{name} {self.help[name]}')
+            lines.append(f'# TYPE {self.prefix}{name} {kind}')
+
+        for name, metric in sorted(self.counters.items()):
+            header(name, 'counter')
+            for labels, value in sorted(metric.items()):
+                lines.append(f'{self.prefix}{name}{_format_labels(labels)} {_format_value(value)}')
+        for name, metric in sorted(self.gauges.items()):
+            header(name, 'gauge')
+            for labels, value in sorted(metric.items()):
+                lines.append(f'{self.prefix}{name}{_format_labels(labels)} {_format_value(value)}')
+        for name, metric in sorted(self.histograms.items()):
+            header(name, 'histogram')
+            for labels, histogram in sorted(metric.items(), key=lambda x: x[0]):
+                for bound, count in histogram.cumulative():
+                    le = _format_labels(labels, [('le', _format_value(bound))])
+                    lines.append(f'{self.prefix}{name}_bucket{le} {count}')
+                lines.append(
+                    f'{self.prefix}{name}_sum{_format_labels(labels)} {_format_value(histogram.sum)}'
+                )
+                lines.append(f'{self.prefix}{name}_count{_format_labels(labels)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+    def asdict(self):
+        """Return the metrics as a dict of name -> list of samples, usable over
+        WAMP."""
+        result = {}
+        for metric in (self.counters, self.gauges):
+            for name, values in metric.items():
+                result[name] = [
+                    {'labels': dict(labels), 'value': value} for labels, value in values.items()
+                ]
+        for name, values in self.histograms.items():
+            result[name] = [{
+                'labels': dict(labels),
+                'count': histogram.count,
+                'sum': histogram.sum,
+                'buckets': [[bound, count] for bound, count in histogram.cumulative()[:-1]],
+            } for labels, histogram in values.items()]
+        return result
+
+
+class TimedLock:
+    """asyncio.Lock which records the time spent waiting for and holding it."""
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+        self._lock = asyncio.Lock()
+        self._acquired = None
+
+    def locked(self):
+        return self._lock.locked()
+
+    async def __aenter__(self):
+        start = time.monotonic()
+        await self._lock.acquire()
+        self._acquired = time.monotonic()
+        self.metrics.observe('lock_wait_seconds', self._acquired - start, lock=self.name)
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.metrics.observe('lock_hold_seconds', time.monotonic() - self._acquired, lock=self.name)
+        self._lock.release()
+
+
+class MetricsServer:
+    """Minimal HTTP server providing the metrics for Prometheus at /metrics.
+
+    The render callback is called for each request and returns the text.
+    """
+    def __init__(self, render, host='127.0.0.1', port=9180):
+        self.render = render
+        self.host = host
+        self.port = port
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+
+    async def stop(self):
+        if self.server is None:
+            return
+        self.server.close()
+        await self.server.wait_closed()
+        self.server = None
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), timeout=10.0)
+            # skip the headers
+            while True:
+                line = await asyncio.wait_for(reader.readline(), timeout=10.0)
+                if line in (b'\r\n', b'\n', b''):
+                    break
+            parts = request.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                status = '200 OK'
+                body = self.render().encode()
+                content_type = 'text/plain; version=0.0.4; charset=utf-8'
+            else:
+                status = '404 Not Found'
+                body = b'not found\n'
+                content_type = 'text/plain; charset=utf-8'
+            writer.write(
+                f'HTTP/1.0 {status}\r\nContent-Type: {content_type}\r\n'
+                f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+def parse_address(value, default_host='127.0.0.1'):
+    """Parse a [HOST:]PORT string."""
+    host, sep, port = value.rpartition(':')
+    if not sep:
+        host = default_host
+    return host, int(port)
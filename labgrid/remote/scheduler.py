@@ -1,4 +1,6 @@
-from collections import defaultdict
+from collections import Counter, defaultdict, deque
+from fnmatch import fnmatchcase
+from itertools import groupby
 
 import attr
 
@@ -7,45 +9,295 @@ import attr
 class TagSet:
     name = attr.ib(validator=attr.validators.instance_of(str))
     tags = attr.ib(validator=attr.validators.instance_of(set))
+    # only used for filters by the matching scheduler
+    prio = attr.ib(default=0.0, validator=attr.validators.instance_of(float))
 
 
-def schedule_step(places, filters):
-    "Find the filters that can be directly allocated without overlap."
-    interest = defaultdict(list)
-    for f in filters:
-        for place in places:
-            if f.tags.issubset(place.tags):
-                interest[place].append(f)
+@attr.s(eq=False)
+class TagIndex:
+    """Inverted index from tags to the keys of the tag sets containing them.
 
-    if not interest:
-        return {}
+    Finding the tag sets matching a filter is an intersection of the sets
+    for its tags instead of a subset check for each tag set.
+    """
+    tags = attr.ib(default=attr.Factory(dict), init=False)
+    keys = attr.ib(default=attr.Factory(dict), init=False)
 
-    limit = min(map(len, interest.values()))
-    allocation = {}
-    for interest_place, interest_filters in interest.items():
-        if len(interest_filters) == limit:
-            allocation[interest_filters.pop(0)] = interest_place
+    def add(self, key, tags):
+        """Add or replace the tags for the key."""
+        self.remove(key)
+        self.tags[key] = set(tags)
+        for tag in tags:
+            self.keys.setdefault(tag, set()).add(key)
 
-    return allocation
+    def remove(self, key):
+        for tag in self.tags.pop(key, ()):
+            keys = self.keys[tag]
+            keys.discard(key)
+            if not keys:
+                del self.keys[tag]
+
+    def match(self, tags):
+        """Return the set of keys whose tags contain all of the given tags."""
+        if not tags:
+            return set(self.tags)
+        candidates = sorted((self.keys.get(tag, set()) for tag in tags), key=len)
+        return candidates[0].intersection(*candidates[1:])
+
+
+@attr.s(eq=False)
+class FairShare:
+    """Fair-share policy for the order in which waiting reservations are
+    allocated.
+
+    The reservations are grouped into shares by their owner (key 'owner') or
+    by the value of a tag in their filters (key 'tag:NAME'). Weights and caps
+    are looked up by the first matching fnmatch pattern for the share.
+
+    Between reservations of the same effective priority, the shares take
+    turns in proportion to their weight, taking the reservations which are
+    already allocated or acquired into account. A share with a cap gets no
+    further allocations while this many of its reservations are allocated or
+    acquired. With aging, each full period of waiting (in seconds) raises the
+    effective priority by one, so that no reservation waits forever.
+    """
+    key = attr.ib(default='owner', validator=attr.validators.instance_of(str))
+    weights = attr.ib(default=attr.Factory(dict), validator=attr.validators.instance_of(dict))
+    caps = attr.ib(default=attr.Factory(dict), validator=attr.validators.instance_of(dict))
+    aging = attr.ib(
+        default=None,
+        validator=attr.validators.optional(attr.validators.instance_of((int, float)))
+    )
+
+    def __attrs_post_init__(self):
+        if self.key != 'owner' and not self.key.startswith('tag:'):
+            raise ValueError(f"invalid fair-share key {self.key}, use 'owner' or 'tag:NAME'")
+        for pattern, weight in self.weights.items():
+            if not weight > 0:
+                raise ValueError(f"invalid weight {weight} for {pattern}")
+
+    @staticmethod
+    def _lookup(table, share, default):
+        for pattern, value in table.items():
+            if fnmatchcase(share, pattern):
+                return value
+        return default
+
+    def share(self, res):
+        if self.key == 'owner':
+            return res.owner
+        tag = self.key[len('tag:'):]
+        for filter_ in res.filters.values():
+            if tag in filter_:
+                return filter_[tag]
+        return ''
+
+    def weight(self, share):
+        return self._lookup(self.weights, share, 1)
+
+    def cap(self, share):
+        return self._lookup(self.caps, share, None)
+
+    def level(self, res, now):
+        """Return the effective priority of the reservation."""
+        if not self.aging:
+            return res.prio
+        return res.prio + (now - res.created) // self.aging
+
+    def order(self, reservations, active, now):
+        """Return the waiting reservations in the order in which they should
+        be allocated.
+
+        The active reservations are allocated or acquired and count against
+        the share of their owner (or tag).
+        """
+        active = Counter(self.share(res) for res in active)
+        shares = defaultdict(list)
+        for res in sorted(reservations, key=lambda x: (-self.level(x, now), x.created)):
+            shares[self.share(res)].append(res)
+        keys = {}
+        for share, queue in shares.items():
+            weight = self.weight(share)
+            for n, res in enumerate(queue, active[share] + 1):
+                keys[res] = (-self.level(res, now), n / weight, res.created)
+        return sorted(reservations, key=keys.__getitem__)
+
+    def limit(self, reservations, active):
+        """Split the ordered waiting reservations into those which may be
+        allocated and those which would exceed the cap of their share."""
+        active = Counter(self.share(res) for res in active)
+        allowed = []
+        capped = []
+        for res in reservations:
+            share = self.share(res)
+            cap = self.cap(share)
+            if cap is not None and active[share] >= cap:
+                capped.append(res)
+                continue
+            active[share] += 1
+            allowed.append(res)
+        return allowed, capped
 
 
 def schedule_overlaps(places, filters):
-    "Iterate schedule_step until no more allocations are found."
-    places = places[:]
-    filters = filters[:]
+    """Allocate places to filters until no more allocations are found.
+
+    In each step, the places with the fewest matching filters are allocated
+    to their first matching filter. If a filter is the first one for several
+    of these places, the last place wins. The matches are only computed once
+    and updated after each step.
+    """
+    index = TagIndex()
+    for i, place in enumerate(places):
+        index.add(i, place.tags)
+    # the indices of the matching places for each filter and of the matching
+    # filters for each place, in order
+    candidates = {}
+    interest = defaultdict(list)
+    for j, f in enumerate(filters):
+        candidates[j] = index.match(f.tags)
+        for i in candidates[j]:
+            interest[i].append(j)
+
     allocation = {}
-    while True:
-        new = schedule_step(places, filters)
-        if not new:
-            break
-        for f, place in new.items():
-            assert f not in allocation
-            places.remove(place)
-            filters.remove(f)
-            allocation[f] = place
+    while interest:
+        limit = min(map(len, interest.values()))
+        new = {}
+        for i, interest_filters in interest.items():
+            if len(interest_filters) == limit:
+                j = interest_filters[0]
+                new[j] = max(new.get(j, i), i)
+
+        for j, i in new.items():
+            assert filters[j] not in allocation
+            allocation[filters[j]] = places[i]
+            for other in interest.pop(i):
+                candidates[other].discard(i)
+            for other in candidates.pop(j):
+                interest[other].remove(j)
+                if not interest[other]:
+                    del interest[other]
     return allocation
 
 
-def schedule(places, filters):
-    allocation = schedule_overlaps(places, filters)
+def _augment(candidates, active, match_filter, match_place):
+    """Extend the matching with vertex-disjoint shortest augmenting paths from
+    the unmatched active filters until no more are found (Hopcroft-Karp).
+
+    Filters which are matched already stay matched, even if they are moved to
+    another place.
+    """
+    while True:
+        # breadth-first search for the layers of alternating paths, up to
+        # the first layer with an unmatched place
+        dist = {}
+        queue = deque()
+        for j in active:
+            if j not in match_filter:
+                dist[j] = 0
+                queue.append(j)
+        limit = None
+        while queue:
+            j = queue.popleft()
+            if limit is not None and dist[j] >= limit:
+                break
+            for i in candidates[j]:
+                k = match_place.get(i)
+                if k is None:
+                    limit = dist[j]
+                elif k not in dist:
+                    dist[k] = dist[j] + 1
+                    queue.append(k)
+        if limit is None:
+            return
+
+        # depth-first search along the layers, starting with the earlier
+        # filters
+        position = dict.fromkeys(dist, 0)
+        for root in active:
+            if root in match_filter or dist.get(root) != 0:
+                continue
+            stack = [root]
+            while stack:
+                j = stack[-1]
+                if position[j] >= len(candidates[j]):
+                    dist[j] = None  # no path from here
+                    stack.pop()
+                    continue
+                i = candidates[j][position[j]]
+                position[j] += 1
+                k = match_place.get(i)
+                if k is None:
+                    if dist[j] != limit:
+                        continue
+                    # swap the matches along the path
+                    for j in stack:
+                        i = candidates[j][position[j] - 1]
+                        match_filter[j] = i
+                        match_place[i] = j
+                        dist[j] = None
+                    break
+                if dist.get(k) is not None and dist[k] == dist[j] + 1:
+                    stack.append(k)
+
+
+def schedule_matching(places, filters):
+    """Allocate places to filters using a maximum bipartite matching.
+
+    In contrast to schedule_overlaps(), a filter which could use several
+    places can't prevent the allocation of another filter. The filters with
+    higher prio are matched first, so they are never displaced by filters with
+    lower prio. Between filters with the same prio, the earlier ones are
+    preferred when not all of them can be allocated.
+    """
+    index = TagIndex()
+    for i, place in enumerate(places):
+        index.add(i, place.tags)
+    candidates = [sorted(index.match(f.tags)) for f in filters]
+
+    match_filter = {}
+    match_place = {}
+    active = []
+    order = sorted(range(len(filters)), key=lambda j: -filters[j].prio)
+    for _, tier in groupby(order, key=lambda j: filters[j].prio):
+        active.extend(tier)
+        # prefer the earlier filters for the initial matching
+        for j in active:
+            if j in match_filter:
+                continue
+            for i in candidates[j]:
+                if i not in match_place:
+                    match_filter[j] = i
+                    match_place[i] = j
+                    break
+        _augment(candidates, active, match_filter, match_place)
+
+    return {filters[j]: places[i] for j, i in sorted(match_filter.items())}
+
+
+def schedule_all(places, filters):
+    """Allocate a place to each of the filters, or none at all.
+
+    Returns a dict of filter names to place names like schedule().
+    """
+    allocation = schedule_matching(places, filters)
+    if len(allocation) != len(filters):
+        return {}
+    return {f.name: p.name for f, p in allocation.items()}
+
+
+SCHEDULERS = {
+    'greedy': schedule_overlaps,
+    'matching': schedule_matching,
+}
+
+
+def schedule(places, filters, mode='greedy'):
+    """Allocate places to filters, returning a dict of filter names to place
+    names.
+
+    The filters are expected in the order of their priority. The mode selects
+    the scheduler from SCHEDULERS.
+    """
+    allocation = SCHEDULERS[mode](places, filters)
     return {f.name: p.name for f, p in allocation.items()}
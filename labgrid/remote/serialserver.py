@@ -0,0 +1,343 @@
+"""The remote.serialserver module serves local serial ports over TCP from the
+exporter's event loop, as an alternative to running ser2net for each port."""
+import asyncio
+import logging
+import os
+import socket
+import time
+
+import serial
+import serial.rfc2217
+
+PROTOCOLS = ('rfc2217', 'raw')
+
+
+def listen(host, port, backlog):
+    """Return a non-blocking listening socket, on a free port if port is 0"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host or '', port))
+        sock.listen(backlog)
+    except OSError:
+        sock.close()
+        raise
+    sock.setblocking(False)
+    return sock
+
+
+class SerialConnection(asyncio.Protocol):
+    """Network connection of a SerialServer"""
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.manager = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if not self.server.allowed:
+            transport.close()
+            return
+        if len(self.server.connections) >= self.server.max_connections:
+            self.server.logger.warning("too many connections for %s", self.server.path)
+            transport.close()
+            return
+        transport.set_write_buffer_limits(high=self.server.buffer_size)
+        self.server.connections.add(self)
+        self.server.total_connections += 1
+        if self.server.input_paused:
+            transport.pause_reading()
+        if self.server.protocol == 'rfc2217':
+            # sends the initial telnet negotiation via write()
+            self.manager = serial.rfc2217.PortManager(self.server.serial, self)
+
+    def connection_lost(self, exc):
+        self.server.connections.discard(self)
+        self.server.paused.discard(self)
+        self.server._update_reader()
+
+    def write(self, data):
+        """Called by the PortManager for telnet replies"""
+        self.transport.write(data)
+
+    def send(self, data):
+        """Send data read from the serial port"""
+        if self.manager is not None:
+            data = data.replace(serial.rfc2217.IAC, serial.rfc2217.IAC + serial.rfc2217.IAC)
+        self.transport.write(data)
+
+    def data_received(self, data):
+        manager = self.manager
+        if manager is not None:
+            # only run the byte-wise telnet state machine when needed
+            if (manager.mode != serial.rfc2217.M_NORMAL or manager.suboption is not None
+                    or serial.rfc2217.IAC in data):
+                data = b''.join(manager.filter(data))
+        if data:
+            self.server.write_serial(data)
+
+    def pause_writing(self):
+        self.server.paused.add(self)
+        self.server._update_reader()
+
+    def resume_writing(self):
+        self.server.paused.discard(self)
+        self.server._update_reader()
+
+
+class SerialServer:
+    """Serves a local serial port with RFC2217 or as raw TCP to multiple
+    clients.
+
+    The data read from the serial port is sent to all connected clients.
+    Reading from the serial port is paused while a client can't keep up, and
+    reading from the clients is paused while the data for the serial port
+    can't be written fast enough. The bytes transferred in both directions
+    are counted.
+    """
+    def __init__(self, path, speed, protocol='rfc2217', host=None, port=0,
+                 max_connections=10, buffer_size=64*1024, logger=None):
+        if protocol not in PROTOCOLS:
+            raise ValueError(f"invalid protocol {protocol}, use one of {', '.join(PROTOCOLS)}")
+        self.path = path
+        self.speed = speed
+        self.protocol = protocol
+        self.host = host
+        self.port = port
+        self.max_connections = max_connections
+        self.buffer_size = buffer_size
+        self.logger = logger or logging.getLogger('SerialServer')
+        self.loop = None
+        self.serial = None
+        self.sock = None
+        self.server = None
+        self.connections = set()
+        self.allowed = True
+        self.paused = set()
+        self.reading = False
+        self.failed = False  # stop reading after EOF or a read error
+        self.output = bytearray()
+        self.input_paused = False
+        self.started = None
+        self.rx_bytes = 0  # from the serial port to the network
+        self.tx_bytes = 0  # from the network to the serial port
+        self.total_connections = 0
+
+    def open(self, loop=None):
+        """Open the serial port and the listening socket, which already queues
+        new connections until start() has completed.
+
+        Returns the TCP port.
+        """
+        self.loop = loop or asyncio.get_event_loop()
+        self.serial = serial.Serial(self.path, self.speed, timeout=0, write_timeout=0)
+        try:
+            self.sock = listen(self.host, self.port, self.max_connections)
+        except OSError:
+            self.serial.close()
+            self.serial = None
+            raise
+        self.port = self.sock.getsockname()[1]
+        self.started = time.monotonic()
+        self._update_reader()
+        return self.port
+
+    async def start(self):
+        """Start accepting connections on the socket from open()"""
+        self.server = await self.loop.create_server(
+            lambda: SerialConnection(self), sock=self.sock,
+        )
+
+    def allow(self, allowed):
+        """Allow or refuse connections, closing the existing ones when they
+        are no longer allowed"""
+        self.allowed = allowed
+        if not allowed:
+            for connection in list(self.connections):
+                connection.transport.abort()
+
+    def close(self):
+        """Close the server, all connections and the serial port"""
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+        elif self.sock is not None:
+            self.sock.close()
+        self.sock = None
+        for connection in list(self.connections):
+            connection.transport.abort()
+        self.connections.clear()
+        self.paused.clear()
+        if self.serial is not None:
+            fd = self.serial.fileno()
+            if self.reading:
+                self.loop.remove_reader(fd)
+                self.reading = False
+            if self.output:
+                self.loop.remove_writer(fd)
+                self.output.clear()
+            self.input_paused = False
+            self.serial.close()
+            self.serial = None
+
+    def stats(self):
+        """Return the counters and the average throughput since open()"""
+        duration = time.monotonic() - self.started if self.started else 0.0
+        return {
+            'rx_bytes': self.rx_bytes,
+            'tx_bytes': self.tx_bytes,
+            'rx_rate': self.rx_bytes / duration if duration else 0.0,
+            'tx_rate': self.tx_bytes / duration if duration else 0.0,
+            'connections': len(self.connections),
+            'total_connections': self.total_connections,
+        }
+
+    def _update_reader(self):
+        if self.serial is None:
+            return
+        reading = not self.paused and not self.failed
+        if reading == self.reading:
+            return
+        if reading:
+            self.loop.add_reader(self.serial.fileno(), self._read_serial)
+        else:
+            self.loop.remove_reader(self.serial.fileno())
+        self.reading = reading
+
+    def _read_serial(self):
+        try:
+            data = os.read(self.serial.fileno(), 4096)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self.logger.warning("failed to read from %s: %s", self.path, e)
+            self.failed = True
+            self._update_reader()
+            return
+        if not data:
+            self.logger.warning("end of file on %s", self.path)
+            self.failed = True
+            self._update_reader()
+            return
+        self.rx_bytes += len(data)
+        for connection in list(self.connections):
+            connection.send(data)
+
+    def write_serial(self, data):
+        """Write data to the serial port, buffering what can't be written
+        immediately"""
+        if self.serial is None:
+            return
+        pending = bool(self.output)
+        self.output += data
+        if not pending:
+            self._write_serial()
+        if len(self.output) > self.buffer_size and not self.input_paused:
+            self.input_paused = True
+            for connection in self.connections:
+                connection.transport.pause_reading()
+
+    def _write_serial(self):
+        fd = self.serial.fileno()
+        try:
+            written = os.write(fd, self.output)
+        except BlockingIOError:
+            written = 0
+        except OSError as e:
+            self.logger.warning("failed to write to %s: %s", self.path, e)
+            written = len(self.output)
+        self.tx_bytes += written
+        del self.output[:written]
+        if self.output:
+            self.loop.add_writer(fd, self._write_serial)
+            return
+        self.loop.remove_writer(fd)
+        if self.input_paused:
+            self.input_paused = False
+            for connection in self.connections:
+                connection.transport.resume_reading()
+
+
+class PortGate:
+    """Listening socket on a stable port, which forwards the connections to
+    a local target port only while they are allowed.
+
+    This keeps a warm ser2net on a local port inaccessible until the
+    resource is acquired.
+    """
+    def __init__(self, host=None, port=0, logger=None):
+        self.host = host
+        self.port = port
+        self.logger = logger or logging.getLogger('PortGate')
+        self.loop = None
+        self.sock = None
+        self.server = None
+        self.target_port = None
+        self.allowed = False
+        self.writers = set()
+
+    def open(self, loop=None):
+        """Open the listening socket, returning the port"""
+        self.loop = loop or asyncio.get_event_loop()
+        self.sock = listen(self.host, self.port, 10)
+        self.port = self.sock.getsockname()[1]
+        return self.port
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, sock=self.sock)
+
+    def allow(self, allowed):
+        """Allow or refuse connections, closing the existing ones when they
+        are no longer allowed"""
+        self.allowed = allowed
+        if not allowed:
+            for writer in list(self.writers):
+                writer.transport.abort()
+            self.writers.clear()
+
+    def close(self):
+        self.allow(False)
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+        elif self.sock is not None:
+            self.sock.close()
+        self.sock = None
+
+    async def _handle(self, reader, writer):
+        if not self.allowed or self.target_port is None:
+            writer.transport.abort()
+            return
+        try:
+            target_reader, target_writer = await asyncio.open_connection('127.0.0.1', self.target_port)
+        except OSError as e:
+            self.logger.warning("failed to connect to local port %d: %s", self.target_port, e)
+            writer.transport.abort()
+            return
+        if not self.allowed:
+            target_writer.transport.abort()
+            writer.transport.abort()
+            return
+        self.writers.update((writer, target_writer))
+        try:
+            await asyncio.gather(
+                self._forward(reader, target_writer),
+                self._forward(target_reader, writer),
+            )
+        finally:
+            self.writers.discard(writer)
+            self.writers.discard(target_writer)
+
+    @staticmethod
+    async def _forward(reader, writer):
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                writer.write(data)
+                await writer.drain()  # backpressure
+        except ConnectionError:
+            pass
+        finally:
+            writer.transport.abort()
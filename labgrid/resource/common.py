@@ -1,5 +1,5 @@
 import shlex
-from typing import Dict, Type, List
+from typing import Dict, Type, List, Optional
 import attr
 
 from ..binding import BindingMixin
@@ -101,6 +101,9 @@ class NetworkResource(Resource):
 @attr.s(eq=False)
 class ResourceManager:
     instances: 'Dict[Type[ResourceManager], ResourceManager]' = {}
+    # interval for the timer used by register_events(), for managers without
+    # an event source of their own
+    poll_interval: Optional[float] = None
 
     @classmethod
     def get(cls) -> 'ResourceManager':
@@ -123,6 +126,25 @@ class ResourceManager:
     def poll(self):
         pass
 
+    def register_events(self, loop, callback):
+        """Arrange for callback(manager) to be called from the asyncio loop
+        when the state of the resources may have changed, so that poll() only
+        needs to be called then.
+
+        The default implementation uses a timer with poll_interval, if set.
+        Returns False if the manager has no event source, in which case the
+        resources need to be polled continuously.
+        """
+        if self.poll_interval is None:
+            return False
+
+        def tick():
+            callback(self)
+            loop.call_later(self.poll_interval, tick)
+
+        loop.call_later(self.poll_interval, tick)
+        return True
+
 
 @attr.s(eq=False)
 class ManagedResource(Resource):
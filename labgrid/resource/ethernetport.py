@@ -180,6 +180,8 @@ class SNMPSwitch:
 @attr.s
 class EthernetPortManager(ResourceManager):
     """The EthernetPortManager periodically polls the switch for new updates."""
+    poll_interval = 1.0
+
     def __attrs_post_init__(self):
         super().__attrs_post_init__()
         self.logger = logging.getLogger(f"{self}")
@@ -15,11 +15,17 @@ class MQTTManager(ResourceManager):
     _topics = attr.ib(default=attr.Factory(list), validator=attr.validators.instance_of(list))
     _topic_lock = attr.ib(default=threading.Lock())
     _last = attr.ib(default=0.0, validator=attr.validators.instance_of(float))
+    _changed = attr.ib(default=False, validator=attr.validators.instance_of(bool))
+    _notify = attr.ib(default=None)
 
     def __attrs_post_init__(self):
         super().__attrs_post_init__()
         self.log = logging.getLogger('MQTTManager')
 
+    def register_events(self, loop, callback):
+        self._notify = lambda: loop.call_soon_threadsafe(callback, self)
+        return True
+
     def _create_mqtt_connection(self, host):
         import paho.mqtt.client as mqtt
         client = mqtt.Client()
@@ -40,15 +46,22 @@ class MQTTManager(ResourceManager):
         if payload.lower() == "online":
             with self._avail_lock:
                 self._available.add(topic)
+                self._changed = True
         elif payload.lower() == "offline":
             with self._avail_lock:
                 self._available.discard(topic)
+                self._changed = True
+        else:
+            return
+        if self._notify:
+            self._notify()
 
     def poll(self):
-        if monotonic()-self._last < 2:
+        if not self._changed and monotonic()-self._last < 2:
             return  # ratelimit requests
         self._last = monotonic()
         with self._avail_lock:
+            self._changed = False
             for resource in self.resources:
                 resource.avail = resource.avail_topic in self._available
 
@@ -37,6 +37,19 @@ class UdevManager(ResourceManager):
     def _insert_into_queue(self, device):
         self.queue.put(device)
 
+    def register_events(self, loop, callback):
+        # read the netlink socket from the loop instead of the observer thread
+        if self._observer.is_alive():
+            self._observer.stop()
+
+        def read():
+            for device in iter(lambda: self._monitor.poll(timeout=0), None):
+                self._insert_into_queue(device)
+            callback(self)
+
+        loop.add_reader(self._monitor.fileno(), read)
+        return True
+
     def poll(self):
         timeout = Timeout(0.1)
         while not timeout.expired:
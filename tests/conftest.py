@@ -1,3 +1,4 @@
+import asyncio
 import logging
 from signal import SIGTERM
 import sys
@@ -62,6 +63,14 @@ class Prefixer:
         return getattr(self.__wrapped, name)
 
 
+@pytest.fixture(autouse=True)
+def reset_event_loop_policy():
+    """asyncio.run() leaves no current event loop behind, so reset the policy
+    for later tests using asyncio.get_event_loop()"""
+    yield
+    asyncio.set_event_loop_policy(None)
+
+
 @pytest.fixture(scope='function')
 def target():
     return Target('Test')
@@ -189,6 +198,8 @@ def pytest_addoption(parser):
                      help="Run SSHManager tests against localhost")
     parser.addoption("--ssh-username", default=None,
                      help="SSH username to use for SSHDriver testing")
+    parser.addoption("--benchmark", action="store_true",
+                     help="Run benchmarks")
 
 def pytest_configure(config):
     # register an additional marker
@@ -198,6 +209,8 @@ def pytest_configure(config):
                             "localsshmanager: test SSHManager against Localhost")
     config.addinivalue_line("markers",
                             "sshusername: test SSHDriver against Localhost")
+    config.addinivalue_line("markers",
+                            "benchmark: performance benchmark")
 
 def pytest_runtest_setup(item):
     envmarker = item.get_closest_marker("sigrokusb")
@@ -212,3 +225,7 @@ def pytest_runtest_setup(item):
     if envmarker is not None:
         if item.config.getoption("--ssh-username") is None:
             pytest.skip("SSHDriver tests against localhost not enabled (enable with --ssh-username <username>)")
+    envmarker = item.get_closest_marker("benchmark")
+    if envmarker is not None:
+        if item.config.getoption("--benchmark") is False:
+            pytest.skip("benchmarks not enabled (enable with --benchmark)")
@@ -0,0 +1,171 @@
+import random
+import time
+from fnmatch import fnmatchcase
+
+import pytest
+
+from labgrid.remote.common import Place, ResourceMatch
+from labgrid.remote.scheduler import TagSet, schedule
+
+from test_sched import reference_schedule
+
+pytestmark = pytest.mark.benchmark
+
+
+def fnmatch_ismatch(match, resource_path):
+    """Reference implementation of ResourceMatch.ismatch() without precompiled patterns"""
+    exporter, group, cls, name = resource_path
+    if not fnmatchcase(exporter, match.exporter):
+        return False
+    if not fnmatchcase(group, match.group):
+        return False
+    if not fnmatchcase(cls, match.cls):
+        return False
+    if name and match.name and not fnmatchcase(name, match.name):
+        return False
+    return True
+
+
+def make_resource_paths(count):
+    classes = ['NetworkSerialPort', 'NetworkPowerPort', 'NetworkUSBMassStorage', 'NetworkService']
+    return [
+        (f'exporter{i % 100}', f'board{i // 25}', classes[i % len(classes)], f'resource{i % 25}')
+        for i in range(count)
+    ]
+
+
+def make_places(count):
+    places = []
+    for i in range(count):
+        if i % 4 == 0:
+            matches = [ResourceMatch('*', f'board{i}', '*')]
+        elif i % 4 == 1:
+            matches = [ResourceMatch(f'exporter{i % 100}', f'board{i}', 'NetworkSerialPort')]
+        elif i % 4 == 2:
+            matches = [ResourceMatch('exporter*', f'board{i}', 'Network*', 'resource1?')]
+        else:
+            matches = [
+                ResourceMatch(f'exporter{i % 100}', '*', 'NetworkPowerPort', f'resource{i % 25}'),
+                ResourceMatch('*', f'board{i}', 'NetworkService'),
+            ]
+        places.append(Place(f'place{i}', matches=matches))
+    return places
+
+
+def test_resourcematch():
+    resource_paths = make_resource_paths(50000)
+    places = make_places(2000)
+
+    start = time.monotonic()
+    matched = 0
+    for resource_path in resource_paths:
+        for place in places:
+            if place.hasmatch(resource_path):
+                matched += 1
+    duration = time.monotonic() - start
+    checks = len(resource_paths) * len(places)
+    print(f"ResourceMatch: {matched} matches in {checks} checks, {duration:.2f}s"
+          f" ({duration / checks * 1e9:.0f}ns per check)")
+
+    # compare with the uncompiled reference on a sample
+    sample = resource_paths[::50]
+    start = time.monotonic()
+    reference = [[any(fnmatch_ismatch(m, path) for m in place.matches) for place in places]
+                 for path in sample]
+    reference_duration = time.monotonic() - start
+    start = time.monotonic()
+    compiled = [[place.hasmatch(path) for place in places] for path in sample]
+    compiled_duration = time.monotonic() - start
+    print(f"sample: fnmatch {reference_duration:.2f}s, compiled {compiled_duration:.2f}s")
+
+    assert compiled == reference
+    assert compiled_duration < reference_duration
+
+
+def test_scheduler():
+    rng = random.Random(0)
+    places = []
+    for i in range(1500):
+        tags = {('name', f'place{i}'), ('board', f'board{i % 60}'), ('lab', f'lab{i % 3}')}
+        places.append(TagSet(f'place{i}', tags))
+    filters = []
+    for i in range(400):
+        tags = {('board', f'board{rng.randrange(60)}')}
+        if i % 4 == 0:
+            tags.add(('lab', f'lab{rng.randrange(3)}'))
+        filters.append(TagSet(f'res{i}', tags))
+
+    start = time.monotonic()
+    allocation = schedule(places, filters)
+    duration = time.monotonic() - start
+    start = time.monotonic()
+    reference = reference_schedule(places, filters)
+    reference_duration = time.monotonic() - start
+    print(f"scheduler: {len(allocation)} of {len(filters)} reservations allocated to"
+          f" {len(places)} places, indexed {duration:.3f}s, reference {reference_duration:.3f}s")
+
+    assert allocation == reference
+    assert duration < reference_duration
+
+
+def test_scheduler_matching():
+    rng = random.Random(0)
+    places = []
+    for i in range(3000):
+        tags = {('name', f'place{i}'), ('board', f'board{i % 100}'), ('rev', f'rev{i % 7}')}
+        places.append(TagSet(f'place{i}', tags))
+    filters = []
+    for i in range(2500):
+        tags = {('board', f'board{rng.randrange(100)}')}
+        if i % 3 == 0:
+            tags.add(('rev', f'rev{rng.randrange(7)}'))
+        filters.append(TagSet(f'res{i}', tags, prio=float(rng.randrange(2))))
+    filters.sort(key=lambda f: -f.prio)
+
+    start = time.monotonic()
+    greedy = schedule(places, filters)
+    greedy_duration = time.monotonic() - start
+    start = time.monotonic()
+    allocation = schedule(places, filters, mode='matching')
+    duration = time.monotonic() - start
+    print(f"scheduler: {len(filters)} reservations for {len(places)} places,"
+          f" greedy {len(greedy)} allocated in {greedy_duration:.3f}s,"
+          f" matching {len(allocation)} allocated in {duration:.3f}s")
+
+    assert len(allocation) >= len(greedy)
+    assert duration < 5.0
+
+
+def test_serializers():
+    from autobahn.wamp.message import Result
+    from labgrid.remote.common import get_serializers
+
+    # a get_resources() response with 20k resources
+    classes = ['NetworkSerialPort', 'NetworkPowerPort', 'NetworkUSBMassStorage', 'NetworkService']
+    response = {}
+    for i, (exporter, group, cls, name) in enumerate(make_resource_paths(20000)):
+        response.setdefault(exporter, {}).setdefault(group, {})[f'{name}-{cls}'] = {
+            'cls': cls,
+            'params': {'host': f'{exporter}.example.com', 'port': 4000 + i % 1000,
+                       'extra': {'proxy': 'proxy.example.com', 'proxy_required': False}},
+            'acquired': f'place{i // 4}' if i % 3 == 0 else None,
+            'avail': i % 5 != 0,
+        }
+    message = Result(1, args=[response])
+
+    sizes = {}
+    for serializer in get_serializers('msgpack,cbor'):
+        name = serializer.SERIALIZER_ID
+        start = time.monotonic()
+        payload, is_binary = serializer.serialize(message)
+        encode_duration = time.monotonic() - start
+        start = time.monotonic()
+        (decoded,) = serializer.unserialize(payload, is_binary)
+        decode_duration = time.monotonic() - start
+        sizes[name] = len(payload)
+        print(f"{name}: {len(payload)} bytes, encode {encode_duration:.3f}s,"
+              f" decode {decode_duration:.3f}s")
+        assert decoded.args == [response]
+
+    assert sizes['msgpack'] < sizes['json']
+    assert sizes['cbor'] < sizes['json']
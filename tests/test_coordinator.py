@@ -0,0 +1,921 @@
+import asyncio
+import io
+import itertools
+import logging
+import queue
+import random
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import labgrid.remote.coordinator
+from labgrid.remote.common import Place, ReservationState, ResourceMatch
+from labgrid.remote.coordinator import (CoordinatorComponent, ClientSession, ExporterSession,
+                                       MatchIndex)
+from labgrid.remote.journal import Journal
+from labgrid.remote.log import FieldFormatter, NonBlockingQueueHandler, RateLimitFilter
+from labgrid.remote.metrics import Metrics, MetricsServer
+
+
+@pytest.fixture(scope='function')
+def coordinator(tmpdir, monkeypatch, mocker):
+    monkeypatch.chdir(tmpdir)
+    monkeypatch.setattr('labgrid.remote.coordinator.enable_tcp_nodelay', lambda session: None)
+
+    def make():
+        coordinator = CoordinatorComponent()
+        mocker.patch.object(coordinator, 'join')
+        mocker.patch.object(coordinator, 'publish')
+        asyncio.run(coordinator.onConnect())
+        return coordinator
+
+    return make
+
+
+def add_exporter(coordinator, key, name, resources):
+    session = coordinator.sessions[key] = ExporterSession(coordinator, key, f'exporter/{name}')
+    for group_name, resource_name in resources:
+        session.set_resource(group_name, resource_name, {'cls': 'NetworkSerialPort', 'params': {}})
+    return session
+
+
+def add_client(coordinator, key, name):
+    coordinator.sessions[key] = ClientSession(coordinator, key, f'client/{name}')
+    return SimpleNamespace(caller=key)
+
+
+def test_journal_replay(tmpdir):
+    journal = Journal(str(tmpdir))
+    journal.set_place('foo', {'comment': 'first'})
+    journal.set_place('bar', {'comment': 'second'})
+    journal.set_resource('exporter', 'group', 'port', {'cls': 'NetworkSerialPort'})
+    journal.set_reservation('TOKEN1', {'owner': 'host/user'})
+    journal.set_reservation('TOKEN2', {'owner': 'host/user'})
+    journal.write(journal.take())
+    journal.set_place('foo', {})
+    journal.set_resource('exporter', 'group', 'port', {})
+    journal.set_reservation('TOKEN1', {})
+    journal.write(journal.take())
+
+    places, resources, reservations = journal.read()
+    assert places == {'bar': {'comment': 'second'}}
+    assert resources == {}
+    assert reservations == {'TOKEN2': {'owner': 'host/user'}}
+
+    journal.compact()
+    assert journal.size == 0
+    assert tmpdir.join('coordinator.journal').read() == ''
+    assert Journal(str(tmpdir)).read() == (places, resources, reservations)
+
+
+def test_journal_partial_record(tmpdir):
+    journal = Journal(str(tmpdir))
+    journal.set_place('foo', {'comment': 'first'})
+    journal.write(journal.take())
+    with open(journal.journal_file, 'ab') as f:
+        f.write(b'{"op":"place","name":"bar"')
+
+    places, _, _ = journal.read()
+    assert list(places) == ['foo']
+
+
+def test_coordinator_persistence(coordinator):
+    first = coordinator()
+
+    async def modify():
+        assert await first.add_place('test')
+        assert await first.set_place_comment('test', 'hello')
+        assert await first.add_place_match('test', 'exporter/group/cls')
+        assert await first.add_place('removed')
+        assert await first.del_place('removed')
+        await first.save()
+
+    asyncio.run(modify())
+
+    second = coordinator()
+    assert list(second.places) == ['test']
+    place = second.places['test']
+    assert place.comment == 'hello'
+    assert [repr(match) for match in place.matches] == ['exporter/group/cls']
+
+
+def test_poll_exporters_concurrently(coordinator, mocker):
+    first = coordinator()
+    for i, name in enumerate(['fast', 'slow', 'hung']):
+        first.sessions[i] = ExporterSession(first, i, f'exporter/{name}')
+
+    delays = {'fast': 0.0, 'slow': 0.1, 'hung': 10.0}
+    killed = []
+
+    async def call(procedure, *args, **kwargs):
+        if procedure == 'wamp.session.kill':
+            killed.append(args[0])
+            return None
+        await asyncio.sleep(delays[procedure.split('.')[3]])
+        return '1.0'
+
+    mocker.patch.object(first, 'call', side_effect=call)
+
+    async def poll():
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        await first._poll_exporters(timeout=0.5)
+        return loop.time() - start
+
+    assert asyncio.run(poll()) < 2.0
+    assert killed == [2]
+    assert sorted(session.name for session in first.sessions.values()) == ['fast', 'slow']
+    assert first.sessions[0].rtt < first.sessions[1].rtt
+    assert first.sessions[1].version == '1.0'
+
+
+def test_acquire_concurrently(coordinator, mocker):
+    first = coordinator()
+    details = add_client(first, 10, 'host/user')
+    calls = []
+
+    async def call(procedure, *args):
+        calls.append((procedure, args))
+        await asyncio.sleep(0.1)
+        if procedure == 'org.labgrid.exporter.exporter2.acquire' and args[1] == 'port3':
+            raise Exception("acquire failed")
+
+    mocker.patch.object(first, 'call', side_effect=call)
+
+    async def acquire(name, pattern):
+        for i in range(3):
+            if i not in first.sessions:
+                add_exporter(first, i, f'exporter{i}', [('board', f'port{j}') for j in range(4)])
+        assert await first.add_place(name)
+        assert await first.add_place_match(name, pattern)
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        result = await first.acquire_place(name, details=details)
+        return result, loop.time() - start
+
+    # the resources on all exporters are acquired in parallel
+    result, duration = asyncio.run(acquire('test', 'exporter[01]/board/*'))
+    assert result
+    assert duration < 0.5
+    assert len(first.places['test'].acquired_resources) == 8
+    assert len(calls) == 8
+
+    # a failure releases all other acquired resources
+    calls.clear()
+    result, _ = asyncio.run(acquire('failed', 'exporter2/board/*'))
+    assert result is False
+    assert first.places['failed'].acquired is None
+    assert first.places['failed'].acquired_resources == []
+    released = {args[1] for procedure, args in calls if procedure.endswith('.release')}
+    assert released == {'port0', 'port1', 'port2'}
+
+
+def test_match_index():
+    places = [
+        Place('literal', matches=[ResourceMatch('exporter1', 'board1', 'NetworkSerialPort')]),
+        Place('group', matches=[ResourceMatch('*', 'board2', '*')]),
+        Place('cls', matches=[ResourceMatch('exp*', 'board?', 'NetworkPowerPort')]),
+        Place('wildcard', matches=[ResourceMatch('*', '*', '*', 'port[12]')]),
+        Place('multiple', matches=[
+            ResourceMatch('exporter2', '*', '*'),
+            ResourceMatch('*', 'board1', '*'),
+        ]),
+    ]
+    index = MatchIndex()
+    for place in places:
+        index.add_place(place)
+
+    paths = itertools.product(
+        ['exporter1', 'exporter2', 'other'],
+        ['board1', 'board2', 'board3'],
+        ['NetworkSerialPort', 'NetworkPowerPort'],
+        ['port1', 'port3'],
+    )
+    for path in paths:
+        expected = {place.name for place in places if place.hasmatch(path)}
+        assert index.places(path) == expected
+
+    index.remove_place(places[4])
+    index.remove('wildcard', places[3].matches[0])
+    assert index.places(('exporter2', 'board3', 'NetworkSerialPort', 'port1')) == set()
+    assert index.places(('exporter1', 'board1', 'NetworkSerialPort', 'port1')) == {'literal'}
+
+
+def test_resource_changes_batched(coordinator):
+    first = coordinator()
+
+    async def change():
+        session = add_exporter(first, 1, 'exporter', [('board', 'port1'), ('board', 'port2')])
+        session.set_resource('board', 'port1', {'cls': 'NetworkSerialPort', 'params': {'port': 1}})
+        session.set_resource('board', 'port2', {})
+        await asyncio.sleep(0.2)
+
+    asyncio.run(change())
+
+    single = [c for c in first.publish.call_args_list
+              if c.args[0] == 'org.labgrid.coordinator.resource_changed']
+    batched = [c for c in first.publish.call_args_list
+               if c.args[0] == 'org.labgrid.coordinator.resources_changed']
+    assert len(single) == 4
+    assert len(batched) == 1
+    changes = batched[0].args[1]
+    assert [change[:3] for change in changes] == [
+        ['exporter', 'board', 'port1'],
+        ['exporter', 'board', 'port2'],
+    ]
+    assert changes[0][3]['params'] == {'port': 1}
+    assert changes[1][3] == {}
+
+
+def test_set_resources(coordinator, mocker):
+    first = coordinator()
+    session = ExporterSession(first, 1, 'exporter/exporter')
+    first.sessions[1] = session
+    details = add_client(first, 10, 'host/user')
+    mocker.patch.object(first, 'call', new_callable=mocker.AsyncMock)
+
+    async def run():
+        assert await first.add_place('test')
+        assert await first.add_place_match('test', 'exporter/board/*')
+        assert await first.acquire_place('test', details=details)
+        first.publish.reset_mock()
+        first.call.reset_mock()
+
+        resources = [
+            ('board', f'port{i}', {'cls': 'NetworkSerialPort', 'params': {}}) for i in range(3)
+        ]
+        resources.append(('23', 'power', {'cls': 'NetworkPowerPort', 'params': {}}))
+        await first.set_resources(resources, details=SimpleNamespace(caller=1))
+
+    asyncio.run(run())
+
+    assert len(session.groups['board']) == 3
+    assert '23' in first.places
+    acquired = {c.args[2] for c in first.call.call_args_list
+                if c.args[0] == 'org.labgrid.exporter.exporter.acquire'}
+    assert acquired == {'port0', 'port1', 'port2'}
+    assert len(first.places['test'].acquired_resources) == 3
+    published = [c.args[1] for c in first.publish.call_args_list
+                 if c.args[0] == 'org.labgrid.coordinator.place_changed']
+    assert published == ['23', 'test']
+
+
+def test_get_changes(coordinator):
+    first = coordinator()
+
+    async def run():
+        full = await first.get_changes(0)
+        assert full['full']
+        revision = full['revision']
+
+        session = add_exporter(first, 1, 'exporter', [('board', 'port1'), ('board', 'port2')])
+        session.set_resource('board', 'port2', {})
+        assert await first.add_place('test')
+        assert await first.set_place_comment('test', 'hello')
+
+        delta = await first.get_changes(revision, full['epoch'])
+        assert not delta['full']
+        assert delta['revision'] == first.revision
+        assert list(delta['places']) == ['test']
+        assert delta['places']['test']['comment'] == 'hello'
+        resources = {tuple(change[:3]): change[3] for change in delta['resources']}
+        assert list(resources) == [('exporter', 'board', 'port2'), ('exporter', 'board', 'port1')]
+        assert resources[('exporter', 'board', 'port2')] == {}
+
+        unchanged = await first.get_changes(delta['revision'], delta['epoch'])
+        assert unchanged['places'] == {} and unchanged['resources'] == []
+
+        # a restarted coordinator or a truncated change log needs a full sync
+        assert (await first.get_changes(revision, 'other'))['full']
+        first.changes.popleft()
+        assert (await first.get_changes(revision, full['epoch']))['full']
+
+    asyncio.run(run())
+
+
+def test_acquire_stalled_exporter(coordinator, mocker):
+    first = coordinator()
+    details = add_client(first, 10, 'host/user')
+    stalled = None
+
+    async def call(procedure, *args):
+        if procedure.startswith('org.labgrid.exporter.slow.'):
+            await stalled.wait()
+
+    mocker.patch.object(first, 'call', side_effect=call)
+
+    async def run():
+        nonlocal stalled
+        stalled = asyncio.Event()
+        add_exporter(first, 1, 'slow', [('board', 'port')])
+        add_exporter(first, 2, 'fast', [('board', 'port')])
+        for name in ['a', 'b', 'c']:
+            assert await first.add_place(name)
+        assert await first.add_place_match('a', 'slow/board/*')
+        assert await first.add_place_match('b', 'fast/board/*')
+
+        slow = asyncio.ensure_future(first.acquire_place('a', details=details))
+        await asyncio.sleep(0)
+
+        # other places and the read-only calls are not blocked by the
+        # stalled exporter
+        fast = first.acquire_place('b', details=details)
+        assert await asyncio.wait_for(fast, 1.0)
+        assert await asyncio.wait_for(first.set_place_comment('c', 'hello'), 1.0)
+        assert await asyncio.wait_for(first.create_reservation('name=c', details=details), 1.0)
+        places = await asyncio.wait_for(first.get_places(), 1.0)
+        assert places['a']['acquired'] is None
+        assert places['b']['acquired'] == 'host/user'
+        assert places['c']['reservation'] is not None
+
+        # a second acquire of the same place waits for the first one
+        again = asyncio.ensure_future(first.acquire_place('a', details=details))
+        await asyncio.sleep(0.1)
+        assert not slow.done() and not again.done()
+
+        stalled.set()
+        assert await slow
+        assert not await again
+        assert (await first.get_places())['a']['acquired'] == 'host/user'
+
+    asyncio.run(run())
+
+
+def test_schedule_incremental(coordinator, mocker):
+    first = coordinator()
+    details = add_client(first, 10, 'host/user')
+    mocker.patch.object(first, 'call', new_callable=mocker.AsyncMock)
+    schedule = mocker.patch('labgrid.remote.coordinator.schedule',
+                            wraps=labgrid.remote.coordinator.schedule)
+
+    async def run():
+        for name in ['a', 'b']:
+            assert await first.add_place(name)
+            assert await first.set_place_tags(name, {'board': 'foo'})
+        assert await first.acquire_place('a', details=details)
+
+        res1 = await first.create_reservation('board=foo', details=details)
+        res2 = await first.create_reservation('board=foo', details=details)
+        (token1, res1), = res1.items()
+        (token2, res2), = res2.items()
+        assert res1['allocations'] == {'main': ['b']}
+        assert res2['state'] == 'waiting'
+
+        # nothing changed, so the scheduler is not needed
+        schedule.reset_mock()
+        await first._schedule_reservations()
+        assert await first.set_place_comment('b', 'hello')
+        await first._schedule_reservations()
+        schedule.assert_not_called()
+
+        # releasing the place allows the waiting reservation to be allocated
+        assert await first.release_place('a', details=details)
+        await first._schedule_reservations()
+        reservations = await first.get_reservations()
+        assert reservations[token2]['allocations'] == {'main': ['a']}
+        assert first.places['a'].reservation == token2
+
+        # a new place matching the tags of a waiting reservation is allocated
+        res3 = await first.create_reservation('board=bar', details=details)
+        (token3, res3), = res3.items()
+        assert res3['state'] == 'waiting'
+        assert await first.add_place('c')
+        assert await first.set_place_tags('c', {'board': 'bar'})
+        await first._schedule_reservations()
+        assert (await first.poll_reservation(token3))['allocations'] == {'main': ['c']}
+
+        # cancelling frees the place for other reservations
+        res4 = await first.create_reservation('name=b', details=details)
+        (token4, res4), = res4.items()
+        assert res4['state'] == 'waiting'
+        assert await first.cancel_reservation(token1)
+        await first._schedule_reservations()
+        assert first.places['b'].reservation == token4
+
+    asyncio.run(run())
+
+
+def test_schedule_matching(coordinator, monkeypatch):
+    monkeypatch.setenv('LG_SCHEDULER', 'matching')
+    first = coordinator()
+    details = add_client(first, 10, 'host/user')
+
+    async def run():
+        places = {
+            'a': {'soc': 'mx6', 'board': 'foo'},
+            'b': {'soc': 'mx6', 'board': 'bar'},
+            'c': {'soc': 'mx8'},
+        }
+        for name, tags in places.items():
+            assert await first.add_place(name)
+            assert await first.set_place_tags(name, tags)
+        # schedule all reservations at once, the generic one is the oldest
+        async with first.lock:
+            tasks = [
+                asyncio.ensure_future(first.create_reservation(spec, details=details))
+                for spec in ['', 'soc=mx8', 'soc=mx6']
+            ]
+            await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+        reservations = await first.get_reservations()
+        return sorted(res['allocations']['main'][0] for res in reservations.values())
+
+    assert asyncio.run(run()) == ['a', 'b', 'c']
+
+
+def test_schedule_unknown(coordinator, monkeypatch):
+    monkeypatch.setenv('LG_SCHEDULER', 'unknown')
+    with pytest.raises(ValueError):
+        coordinator()
+
+
+def test_reservation_changed(coordinator, mocker):
+    first = coordinator()
+    details = add_client(first, 10, 'host/user')
+    mocker.patch.object(first, 'call', new_callable=mocker.AsyncMock)
+
+    def events():
+        result = [c.args[1:] for c in first.publish.call_args_list
+                  if c.args[0] == 'org.labgrid.coordinator.reservation_changed']
+        first.publish.reset_mock()
+        return result
+
+    async def run():
+        assert await first.add_place('a')
+        assert await first.acquire_place('a', details=details)
+        res = await first.create_reservation('name=a', details=details)
+        (token, _), = res.items()
+        assert events() == []
+
+        # refreshing does not change the state
+        res = await first.poll_reservation(token, timeout=300)
+        assert res['timeout'] > time.time() + 200
+        assert events() == []
+
+        assert await first.release_place('a', details=details)
+        await first._schedule_reservations()
+        (changed_token, changed), = events()
+        assert changed_token == token
+        assert changed['state'] == 'allocated'
+        assert changed['allocations'] == {'main': ['a']}
+
+        assert await first.cancel_reservation(token)
+        assert events() == [(token, {})]
+
+    asyncio.run(run())
+
+
+def test_gang_reservation(coordinator, mocker):
+    first = coordinator()
+    details = add_client(first, 10, 'host/user')
+    mocker.patch.object(first, 'call', new_callable=mocker.AsyncMock)
+
+    async def create(spec, counts=None):
+        res = await first.create_reservation(spec, counts=counts, details=details)
+        (token, config), = res.items()
+        return token, config
+
+    async def run():
+        places = {'dut': {'board': 'x'}, 'tgen1': {'role': 'tgen'}, 'tgen2': {'role': 'tgen'}}
+        for name, tags in places.items():
+            assert await first.add_place(name)
+            assert await first.set_place_tags(name, tags)
+        assert await first.acquire_place('tgen2', details=details)
+
+        assert await first.create_reservation('main:board=x', counts={'peer': 2},
+                                              details=details) is None
+        assert await first.create_reservation('main:board=x', counts={'main': 0},
+                                              details=details) is None
+
+        # only one traffic generator is available, so nothing is allocated
+        gang, config = await create('main:board=x peer:role=tgen', counts={'peer': 2})
+        assert config['filters'] == {'main': {'board': 'x'}, 'peer': {'role': 'tgen'}}
+        assert config['counts'] == {'peer': 2}
+        assert config['state'] == 'waiting'
+        assert first.places['dut'].reservation is None
+        assert first.places['tgen1'].reservation is None
+
+        # a gang with higher priority is allocated before other reservations
+        first.reservations[gang].prio = 1.0
+        async with first.lock:
+            single = asyncio.ensure_future(create('role=tgen'))
+            release = asyncio.ensure_future(first.release_place('tgen2', details=details))
+            await asyncio.sleep(0)
+        assert await release
+        single, config = await single
+        assert config['state'] == 'waiting'
+
+        config = await first.poll_reservation(gang)
+        assert config['state'] == 'allocated'
+        assert config['allocations'] == {'main': ['dut'], 'peer': ['tgen1', 'tgen2']}
+        assert {name for name, place in first.places.items() if place.reservation == gang} == \
+            {'dut', 'tgen1', 'tgen2'}
+
+        # all places are available again after cancelling the gang
+        assert await first.cancel_reservation(gang)
+        await first._schedule_reservations()
+        config = await first.poll_reservation(single)
+        assert config['state'] == 'allocated'
+        assert config['allocations'] == {'main': [config['allocations']['main'][0]]}
+
+    asyncio.run(run())
+
+
+def test_schedule_fair_share(coordinator, monkeypatch, tmpdir):
+    policy = tmpdir.join('policy.yaml')
+    policy.write('key: owner\ncaps:\n  "*/ci": 2\n')
+    monkeypatch.setenv('LG_SCHEDULER_POLICY', str(policy))
+    first = coordinator()
+    ci = add_client(first, 10, 'host/ci')
+    user = add_client(first, 11, 'host/user')
+
+    async def run():
+        for name in ['a', 'b', 'c']:
+            assert await first.add_place(name)
+            assert await first.set_place_tags(name, {'board': 'x'})
+        # the user's reservation is the newest one, but is allocated before
+        # the others of the CI owner
+        async with first.lock:
+            tasks = [
+                asyncio.ensure_future(first.create_reservation('board=x', details=details))
+                for details in [ci, ci, ci, ci, user]
+            ]
+            await asyncio.sleep(0)
+        tokens = [token for task in tasks for token in await task]
+        reservations = await first.get_reservations()
+        states = [reservations[token]['state'] for token in tokens]
+        assert states == ['allocated', 'allocated', 'waiting', 'waiting', 'allocated']
+        # the ranks of the waiting reservations are reported
+        assert [reservations[token].get('rank') for token in tokens] == [None, None, 1, 2, None]
+
+        # the CI owner is limited to two places, even if more are available
+        assert await first.cancel_reservation(tokens[4])
+        config = await first.poll_reservation(tokens[2])
+        assert config['state'] == 'waiting'
+        assert config['rank'] == 1
+
+        assert await first.cancel_reservation(tokens[0])
+        config = await first.poll_reservation(tokens[2])
+        assert config['state'] == 'allocated'
+        assert 'rank' not in config
+
+    asyncio.run(run())
+
+
+def test_schedule_no_rank(coordinator):
+    first = coordinator()
+    user = add_client(first, 10, 'host/user')
+
+    async def run():
+        tokens = [
+            token for _ in range(2)
+            for token in await first.create_reservation('board=x', details=user)
+        ]
+        reservations = await first.get_reservations()
+        assert [reservations[token]['state'] for token in tokens] == ['waiting', 'waiting']
+        # older clients would warn about the unknown attribute
+        assert not any('rank' in config for config in reservations.values())
+
+    asyncio.run(run())
+
+
+def test_metrics_render():
+    metrics = Metrics(prefix='test_')
+    metrics.describe('calls_total', 'Number of calls')
+    metrics.inc('calls_total', procedure='get_places')
+    metrics.inc('calls_total', procedure='get_places')
+    metrics.set('places', 3)
+    metrics.observe('duration_seconds', 0.003, procedure='get_places')
+    metrics.observe('duration_seconds', 20.0, procedure='get_places')
+
+    lines = metrics.render().splitlines()
+    assert '# HELP test_calls_total Number of calls' in lines
+    assert '# TYPE test_calls_total counter' in lines
+    assert 'test_calls_total{procedure="get_places"} 2' in lines
+    assert 'test_places 3' in lines
+    assert 'test_duration_seconds_bucket{procedure="get_places",le="0.001"} 0' in lines
+    assert 'test_duration_seconds_bucket{procedure="get_places",le="0.005"} 1' in lines
+    assert 'test_duration_seconds_bucket{procedure="get_places",le="10.0"} 1' in lines
+    assert 'test_duration_seconds_bucket{procedure="get_places",le="+Inf"} 2' in lines
+    assert 'test_duration_seconds_count{procedure="get_places"} 2' in lines
+
+    (sample,) = metrics.asdict()['duration_seconds']
+    assert sample['labels'] == {'procedure': 'get_places'}
+    assert sample['count'] == 2
+
+
+def test_coordinator_metrics(coordinator, mocker):
+    first = coordinator()
+    details = add_client(first, 10, 'host/user')
+    mocker.patch.object(first, 'call', new_callable=mocker.AsyncMock)
+    registered = {}
+
+    async def register(endpoint, procedure, options=None):
+        registered[procedure.rsplit('.', 1)[1]] = endpoint
+    mocker.patch.object(first, 'register', register)
+
+    async def run():
+        add_exporter(first, 20, 'exporter', [('1', 'a')])
+        await first._register(first.add_place, 'org.labgrid.coordinator.add_place')
+        await first._register(first.acquire_place, 'org.labgrid.coordinator.acquire_place')
+        assert await registered['add_place']('board')
+        with pytest.raises(KeyError):
+            await registered['acquire_place']('board', details=SimpleNamespace(caller=99))
+        await first.create_reservation('name=board', details=details)
+        await first._poll_step()
+        return await first.get_metrics()
+
+    metrics = asyncio.run(run())
+    calls = {(s['labels']['procedure'], s['labels']['status']): s['value']
+             for s in metrics['rpc_calls_total']}
+    assert calls == {('add_place', 'ok'): 1, ('acquire_place', 'error'): 1}
+    assert {s['labels']['lock'] for s in metrics['lock_wait_seconds']} == {'global', 'place'}
+    assert metrics['schedule_duration_seconds'][0]['count'] >= 1
+    assert metrics['save_duration_seconds'][0]['count'] == 1
+    assert metrics['exporter_probe_seconds'][0]['count'] == 1
+    assert metrics['places'] == [{'labels': {}, 'value': 1}]
+    assert metrics['resources'] == [{'labels': {}, 'value': 1}]
+    reservations = {s['labels']['state']: s['value'] for s in metrics['reservations']}
+    assert reservations['allocated'] == 1
+    assert reservations['waiting'] == 0
+    assert 'labgrid_coordinator_places 1' in first.render_metrics().splitlines()
+
+
+def test_metrics_server():
+    async def run():
+        server = MetricsServer(lambda: 'test_places 1\n', port=0)
+        await server.start()
+        port = server.server.sockets[0].getsockname()[1]
+        results = []
+        for path in ['/metrics', '/other']:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(f'GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n'.encode())
+            results.append(await reader.read())
+            writer.close()
+        await server.stop()
+        return results
+
+    metrics, other = asyncio.run(run())
+    assert metrics.startswith(b'HTTP/1.0 200 OK\r\n')
+    assert metrics.endswith(b'\r\n\r\ntest_places 1\n')
+    assert other.startswith(b'HTTP/1.0 404')
+
+
+def test_bench_sessions(coordinator, mocker):
+    from autobahn.wamp.types import ComponentConfig
+    from labgrid.remote.bench import Bench, SimClientSession, SimExporterSession, Stats
+
+    first = coordinator()
+    bench = Bench(url='ws://127.0.0.1:20408/ws', realm='realm1', resources=4)
+    stats = Stats()
+
+    def make(cls, key, authid, **extra):
+        extra.update(authid=authid, stats=stats)
+        session = cls(ComponentConfig('realm1', extra))
+        session.stats = stats
+        kind = ExporterSession if authid.startswith('exporter/') else ClientSession
+        first.sessions[key] = kind(first, key, authid)
+
+        async def call(procedure, *args, **kwargs):
+            name = procedure.rsplit('.', 1)[1]
+            return await getattr(first, name)(*args, **kwargs, details=SimpleNamespace(caller=key))
+        session.call = call
+        return session
+
+    exporter = make(SimExporterSession, 20, 'exporter/bench-0', groups=bench.make_groups())
+
+    async def call(procedure, *args):
+        assert procedure.startswith('org.labgrid.exporter.bench-0.')
+        return await getattr(exporter, procedure.rsplit('.', 1)[1])(*args)
+    mocker.patch.object(first, 'call', call)
+    client = make(SimClientSession, 10, 'client/bench/client-0')
+    other = make(SimClientSession, 11, 'client/bench/client-1')
+
+    def publish(topic, *args):
+        if topic == 'org.labgrid.coordinator.reservation_changed':
+            client.on_reservation_changed(*args)
+    first.publish.side_effect = publish
+
+    async def run():
+        for session in (client, other):
+            session.config.extra['joined'] = asyncio.get_running_loop().create_future()
+            session.subscribe = mocker.AsyncMock()
+            await session.onJoin(None)
+            assert session.reservation_events == {}
+
+        exporter.name = 'bench-0'
+        exporter.groups = exporter.config.extra['groups']
+        await exporter.timed_call('set_resources', [
+            (group_name, resource_name, data)
+            for group_name, group in exporter.groups.items()
+            for resource_name, data in group.items()
+        ])
+        places = await bench.setup_places(client, [exporter])
+        assert places == ['bench-0-group-0', 'bench-0-group-1']
+        assert len(first.places['bench-0-group-0'].matches) == 1
+
+        await client.run(places, {'acquire': 1, 'reserve': 1}, time.monotonic() + 0.2,
+                         random.Random(1))
+        assert stats.latencies['acquire_place']
+        assert len(stats.latencies['release_place']) == len(stats.latencies['acquire_place'])
+
+        # a waiting reservation is polled once after the event
+        stats.latencies.clear()
+        assert await other.timed_call('acquire_place', places[0])
+        client.places = places[:1]
+        start = time.monotonic()
+        task = asyncio.get_running_loop().create_task(client.op_reserve(random.Random(1)))
+        await asyncio.sleep(0.1)
+        assert not stats.latencies['poll_reservation']
+        assert await other.timed_call('release_place', places[0])
+        await task
+        assert time.monotonic() - start < 0.5
+        assert len(stats.latencies['poll_reservation']) == 1
+        assert len(stats.latencies['reservation_allocated']) == 1
+
+    asyncio.run(run())
+    assert stats.latencies['reservation_allocated']
+    assert not stats.errors
+    assert not any(place.acquired for place in first.places.values())
+    assert not first.reservations
+
+
+def test_log_rate_limit():
+    now = [0.0]
+    limit = RateLimitFilter(rate=1.0, burst=2, clock=lambda: now[0])
+
+    def make_record(msg, level, fields):
+        result = logging.LogRecord('Coordinator', level, __file__, 1, msg, None, None)
+        result.fields = fields
+        return result
+
+    results = [limit.filter(make_record('set resource', logging.DEBUG, {'source': 'exp1'}))
+               for _ in range(4)]
+    assert results == [True, True, False, False]
+    # other sources and warnings are not limited
+    assert limit.filter(make_record('set resource', logging.DEBUG, {'source': 'exp2'}))
+    assert limit.filter(make_record('kicking exporter', logging.WARNING, {'source': 'exp1'}))
+
+    now[0] = 1.0
+    passed = make_record('set resource', logging.DEBUG, {'source': 'exp1'})
+    assert limit.filter(passed)
+    assert passed.fields == {'source': 'exp1', 'suppressed': 2}
+    assert not limit.filter(make_record('set resource', logging.DEBUG, {'source': 'exp1'}))
+
+
+def test_log_queue_handler():
+    handler = NonBlockingQueueHandler(queue.Queue(1))
+    handler.setFormatter(FieldFormatter('%(levelname)s %(message)s'))
+    data = {'cls': 'NetworkSerialPort'}
+    record = logging.LogRecord('Coordinator', logging.INFO, __file__, 1, 'set %s', (data,), None)
+    record.fields = {'place': 'test'}
+    handler.handle(record)
+    handler.handle(logging.LogRecord('Coordinator', logging.INFO, __file__, 1, 'other', None, None))
+    assert handler.dropped == 1
+
+    # the arguments are merged immediately, but not formatted otherwise
+    data['cls'] = 'changed'
+    queued = handler.queue.get_nowait()
+    assert queued.msg == "set {'cls': 'NetworkSerialPort'}"
+    assert queued.args is None
+    assert FieldFormatter('%(levelname)s %(message)s').format(queued) == \
+        "INFO set {'cls': 'NetworkSerialPort'} place=test"
+
+    # the dropped records are reported once there is room again
+    handler.handle(logging.LogRecord('Coordinator', logging.INFO, __file__, 1, 'next', None, None))
+    report = handler.queue.get_nowait()
+    assert report.levelno == logging.WARNING
+    assert report.getMessage() == "dropped 1 log records"
+    # which took the place of the next record
+    assert handler.dropped == 1
+
+    handler.queue = queue.Queue(3)
+    handler.handle(logging.LogRecord('Coordinator', logging.INFO, __file__, 1, 'last', None, None))
+    assert handler.dropped == 0
+    assert handler.queue.get_nowait().getMessage() == "dropped 1 log records"
+    assert handler.queue.get_nowait().getMessage() == "last"
+
+
+def test_get_serializers(monkeypatch):
+    from labgrid.remote.common import get_serializers
+
+    monkeypatch.delenv('LG_CROSSBAR_SERIALIZER', raising=False)
+    # autobahn's default negotiation
+    assert get_serializers() is None
+    assert [s.SERIALIZER_ID for s in get_serializers('json')] == ['json']
+    monkeypatch.setenv('LG_CROSSBAR_SERIALIZER', 'msgpack')
+    # JSON is offered as a fallback for older routers
+    assert [s.SERIALIZER_ID for s in get_serializers()] == ['msgpack', 'json']
+    assert [s.SERIALIZER_ID for s in get_serializers('json, cbor')] == ['json', 'cbor']
+    with pytest.raises(ValueError):
+        get_serializers('xml')
+
+
+def test_coordinator_restore(coordinator, mocker):
+    first = coordinator()
+    details = add_client(first, 10, 'host/user')
+    mocker.patch.object(first, 'call', new_callable=mocker.AsyncMock)
+
+    async def modify():
+        for name in ['a', 'b']:
+            assert await first.add_place(name)
+            assert await first.add_place_match(name, f'exporter/{name}/*')
+        assert await first.acquire_place('a', details=details)
+        assert await first.allow_place('a', 'host/other', details=details)
+        waiting = await first.create_reservation('name=a', details=details)
+        allocated = await first.create_reservation('name=b', details=details)
+        cancelled = await first.create_reservation('name=b', details=details)
+        assert await first.cancel_reservation(next(iter(cancelled)))
+        await first.save()
+        return next(iter(waiting)), next(iter(allocated))
+
+    waiting, allocated = asyncio.run(modify())
+
+    second = coordinator()
+    assert second.places['a'].acquired == 'host/user'
+    assert second.places['a'].allowed == {'host/other'}
+    assert second.places['b'].reservation == allocated
+    assert set(second.reservations) == {waiting, allocated}
+    for token, res in second.reservations.items():
+        assert res.token == token
+    assert second.reservations[waiting].state is ReservationState.waiting
+    assert second.reservations[waiting].timeout > time.time() + 200
+    assert second.reservations[allocated].allocations == {'main': ['b']}
+    mocker.patch.object(second, 'call', new_callable=mocker.AsyncMock)
+    exporter = SimpleNamespace(caller=20)
+    second.sessions[20] = ExporterSession(second, 20, 'exporter/exporter')
+
+    async def reconnect():
+        await second.set_resources([
+            # still acquired by the exporter
+            ('a', 'serial', {'cls': 'NetworkSerialPort', 'params': {}, 'acquired': 'a'}),
+            # released by the exporter in the meantime
+            ('a', 'power', {'cls': 'NetworkPowerPort', 'params': {}}),
+            # acquired for a place which is no longer acquired
+            ('b', 'serial', {'cls': 'NetworkSerialPort', 'params': {}, 'acquired': 'b'}),
+            # marked as broken by the exporter
+            ('b', 'power', {'cls': 'NetworkPowerPort', 'params': {}, 'acquired': '<broken>'}),
+            # acquired for an unknown place
+            ('a', 'network', {'cls': 'NetworkService', 'params': {}, 'acquired': 'unknown'}),
+        ], details=exporter)
+        await second._schedule_reservations()
+
+    asyncio.run(reconnect())
+    assert sorted(r.path[3] for r in second.places['a'].acquired_resources) == ['power', 'serial']
+    assert sorted(c.args for c in second.call.call_args_list) == [
+        ('org.labgrid.exporter.exporter.acquire', 'a', 'power', 'a'),
+        ('org.labgrid.exporter.exporter.release', 'b', 'serial'),
+    ]
+    # the restored reservations are scheduled as before
+    assert second.reservations[waiting].state is ReservationState.waiting
+    assert second.reservations[allocated].state is ReservationState.allocated
+
+    async def release():
+        assert await second.release_place('a', details=details)
+        await second._schedule_reservations()
+
+    asyncio.run(release())
+    res = second.reservations[waiting]
+    assert res.state is ReservationState.allocated
+    assert res.allocations == {'main': ['a']}
+    assert second.places['a'].reservation == waiting
+
+
+def test_journal_coalesce(tmpdir):
+    journal = Journal(str(tmpdir))
+    journal.set_place('foo', {'comment': 'first'})
+    journal.set_place('bar', {'comment': 'other'})
+    journal.set_place('foo', {'comment': 'second'})
+
+    records = journal.take()
+    assert records == [
+        {'op': 'place', 'name': 'bar', 'data': {'comment': 'other'}},
+        {'op': 'place', 'name': 'foo', 'data': {'comment': 'second'}},
+    ]
+    assert journal.take() == []
+    journal.write(records)
+    assert journal.read()[0] == {'foo': {'comment': 'second'}, 'bar': {'comment': 'other'}}
+
+
+def test_save_coalesced(coordinator, monkeypatch, mocker):
+    monkeypatch.setenv('LG_COORDINATOR_SAVE_INTERVAL', '0.05')
+    first = coordinator()
+    write = mocker.spy(first.journal, 'write')
+
+    async def run():
+        assert await first.add_place('test')
+        for i in range(10):
+            assert await first.set_place_comment('test', f'comment {i}')
+        assert first.save_scheduled
+        assert write.call_count == 0
+        await asyncio.sleep(0.2)
+
+    asyncio.run(run())
+    assert not first.save_scheduled
+    (records,), _ = write.call_args
+    assert [record['data']['comment'] for record in records] == ['comment 9']
+    assert first.metrics.histograms['save_latency_seconds'][()].count == 1
+
+    second = coordinator()
+    assert second.places['test'].comment == 'comment 9'
@@ -423,3 +423,19 @@ def test_exporter_timeout(place, exporter):
         spawn.expect(pexpect.EOF)
         spawn.close()
         assert spawn.exitstatus == 0, spawn.before.strip()
+
+
+def test_coordinator_bench(crossbar):
+    with pexpect.spawn('python -m labgrid.remote.bench --exporters 2 --resources 4 --clients 2 '
+                       '--duration 2 --seed 1') as spawn:
+        spawn.expect('created 4 places')
+        spawn.expect('acquire_place')
+        spawn.expect(pexpect.EOF, timeout=30)
+        spawn.close()
+        assert spawn.exitstatus == 0, spawn.before.strip()
+
+    with pexpect.spawn('python -m labgrid.remote.client places') as spawn:
+        spawn.expect(pexpect.EOF)
+        spawn.close()
+        assert spawn.exitstatus == 0, spawn.before.strip()
+        assert b'bench-' not in spawn.before
@@ -0,0 +1,437 @@
+import asyncio
+import logging
+import os
+import time
+
+import attr
+import pytest
+from autobahn.wamp.types import ComponentConfig
+from serial.rfc2217 import IAC
+
+from labgrid.remote.exporter import (ExporterError, ExporterSession, ResourceExport,
+                                     SerialPortExport, SerialServerExport, get_ser2net_version)
+from labgrid.remote.serialserver import PortGate, SerialConnection, SerialServer
+from labgrid.resource import ManagedResource, Resource, ResourceManager
+
+
+@attr.s(eq=False)
+class EventManager(ResourceManager):
+    def register_events(self, loop, callback):
+        self.callback = callback
+        return True
+
+    def poll(self):
+        self.polls += 1
+
+
+@attr.s(eq=False)
+class EventResource(ManagedResource):
+    manager_cls = EventManager
+
+
+@attr.s(eq=False)
+class PolledManager(ResourceManager):
+    def poll(self):
+        self.polls += 1
+
+
+@attr.s(eq=False)
+class PolledResource(ManagedResource):
+    manager_cls = PolledManager
+
+
+@attr.s(eq=False)
+class LocalExport(ResourceExport):
+    def __attrs_post_init__(self):
+        super().__attrs_post_init__()
+        self.local = self.local_params.pop('local_cls')(target=None, name=None)
+
+
+def test_poll_event_driven(mocker):
+    async def run():
+        session = ExporterSession(ComponentConfig('realm1', extra={}))
+        session.loop = asyncio.get_running_loop()
+        session.sweep_interval = 10.0
+        session.checkpoint = time.monotonic()
+        session.polled = []
+        session.changed = set()
+        session.wakeup = asyncio.Event()
+        session.update_resources = mocker.AsyncMock()
+        session.groups = {
+            'group': {
+                'event': LocalExport({'cls': 'Event', 'params': {'local_cls': EventResource}}),
+                'polled': LocalExport({'cls': 'Polled', 'params': {'local_cls': PolledResource}}),
+                'plain': LocalExport({'cls': 'Plain', 'params': {'local_cls': Resource}}),
+            },
+        }
+        event_manager = EventManager.get()
+        polled_manager = PolledManager.get()
+        event_manager.polls = polled_manager.polls = 0
+
+        task = asyncio.get_running_loop().create_task(session.poll())
+        await asyncio.sleep(0.4)
+        # the initial sweep polls everything and publishes the availability
+        assert event_manager.polls == 1
+        session.update_resources.assert_awaited_once_with(
+            [('group', 'event'), ('group', 'polled'), ('group', 'plain')]
+        )
+        assert session.watched == {event_manager: [('group', 'event')]}
+        assert session.polled == [('group', 'polled')]
+
+        await asyncio.sleep(0.6)
+        # only the continuously polled resource
+        assert event_manager.polls == 1
+        assert polled_manager.polls > 2
+
+        event_manager.callback(event_manager)
+        await asyncio.sleep(0.4)
+        assert event_manager.polls == 2
+
+        task.cancel()
+        await asyncio.wait([task])
+
+    try:
+        asyncio.run(run())
+    finally:
+        ResourceManager.instances.pop(EventManager, None)
+        ResourceManager.instances.pop(PolledManager, None)
+
+
+@pytest.fixture
+def ser2net(tmpdir, monkeypatch):
+    script = tmpdir.join('ser2net')
+    script.write('#!/bin/sh\n[ "$1" = "-v" ] && echo "ser2net version 4.3.3" && exit 0\nexec sleep 30\n')
+    script.chmod(0o755)
+    monkeypatch.setenv('PATH', f'{tmpdir}:{os.environ["PATH"]}')
+    get_ser2net_version.cache_clear()
+    yield script
+    get_ser2net_version.cache_clear()
+
+
+def test_serial_port_start_concurrently(ser2net, mocker):
+    async def run():
+        session = ExporterSession(ComponentConfig('realm1', extra={}))
+        session.update_resource = mocker.AsyncMock()
+        session.groups = {
+            'group': {
+                f'port{i}': SerialPortExport({'cls': 'RawSerialPort', 'params': {'port': f'/dev/ttyS{i}'}})
+                for i in range(4)
+            },
+        }
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        ticker = asyncio.get_running_loop().create_task(tick())
+        start = time.monotonic()
+        await asyncio.gather(*(
+            session.acquire('group', name, 'place') for name in session.groups['group']
+        ))
+        assert time.monotonic() - start < 1.0
+        # the loop kept running while the ports were started
+        assert ticks > 10
+        for resource in session.groups['group'].values():
+            assert resource.child.poll() is None
+            assert resource.port
+            assert resource.settle_deadline is None
+
+        await asyncio.gather(*(
+            session.release('group', name) for name in session.groups['group']
+        ))
+        for resource in session.groups['group'].values():
+            assert resource.child is None
+            assert not resource.stopping
+        ticker.cancel()
+
+    asyncio.run(run())
+
+
+def test_serial_port_exits_immediately(ser2net, mocker):
+    ser2net.write('#!/bin/sh\n[ "$1" = "-v" ] && echo "ser2net version 4.3.3" && exit 0\nexit 1\n')
+
+    async def run():
+        session = ExporterSession(ComponentConfig('realm1', extra={}))
+        session.update_resource = mocker.AsyncMock()
+        resource = SerialPortExport({'cls': 'RawSerialPort', 'params': {'port': '/dev/ttyS0'}})
+        session.groups = {'group': {'port': resource}}
+        with pytest.raises(ExporterError):
+            await session.acquire('group', 'port', 'place')
+        assert resource.broken == "start failed"
+        assert resource.child is None
+        session.update_resource.assert_awaited_once_with('group', 'port')
+
+    asyncio.run(run())
+
+
+def test_serial_port_warm_stop(ser2net, caplog):
+    async def run():
+        resource = SerialPortExport({'cls': 'RawSerialPort', 'params': {'port': '/dev/ttyS0'}},
+                                    warm=True)
+        # started while available
+        assert resource.poll()
+        await resource.settle()
+        target_port = resource.gate.target_port
+        assert target_port != resource.port
+
+        resource.stop()
+        await resource.settle()
+        # the port of ser2net instead of the gate
+        assert f"stopped ser2net for /dev/ttyS0 on port {target_port}" in caplog.messages
+        resource.gate.close()
+
+    caplog.set_level(logging.INFO)
+    asyncio.run(run())
+
+
+def test_serial_server():
+    master, slave = os.openpty()
+    path = os.ttyname(slave)
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        server = SerialServer(path, 115200, protocol='raw')
+        port = server.open()
+        await server.start()
+
+        readers = [await asyncio.open_connection('127.0.0.1', port) for _ in range(2)]
+        await asyncio.sleep(0.1)
+        os.write(master, b'hello\n')
+        for reader, _ in readers:
+            assert await asyncio.wait_for(reader.readexactly(6), 1.0) == b'hello\n'
+
+        readers[0][1].write(b'world\n')
+        data = b''
+        while len(data) < 6:
+            data += await loop.run_in_executor(None, os.read, master, 100)
+        assert data == b'world\n'
+
+        stats = server.stats()
+        assert stats['rx_bytes'] == 6
+        assert stats['tx_bytes'] == 6
+        assert stats['connections'] == 2
+
+        for _, writer in readers:
+            writer.close()
+        server.close()
+
+    try:
+        asyncio.run(run())
+    finally:
+        os.close(master)
+        os.close(slave)
+
+
+def test_serial_server_rfc2217():
+    master, slave = os.openpty()
+    path = os.ttyname(slave)
+
+    async def run():
+        server = SerialServer(path, 115200)
+        port = server.open()
+        await server.start()
+
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        # the telnet negotiation
+        assert (await asyncio.wait_for(reader.read(100), 1.0)).startswith(IAC)
+        os.write(master, b'a\xffb')
+        assert await asyncio.wait_for(reader.readexactly(4), 1.0) == b'a\xff\xffb'
+        writer.write(b'c' + IAC + IAC + b'd')
+        await asyncio.sleep(0.1)
+        assert os.read(master, 100) == b'c\xffd'
+
+        writer.close()
+        server.close()
+
+    try:
+        asyncio.run(run())
+    finally:
+        os.close(master)
+        os.close(slave)
+
+
+def test_serial_server_eof(caplog):
+    master, slave = os.openpty()
+    path = os.ttyname(slave)
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        server = SerialServer(path, 115200, protocol='raw')
+        server.open()
+        await server.start()
+        assert server.reading
+
+        # the pty slave reads EOF once the master is closed
+        os.close(master)
+        for _ in range(10):
+            await asyncio.sleep(0.05)
+            if not server.reading:
+                break
+        assert not server.reading
+        assert f"end of file on {path}" in caplog.messages
+        # no longer called for the closed pty
+        assert not loop.remove_reader(server.serial.fileno())
+
+        # not resumed by a connection's flow control
+        connection = SerialConnection(server)
+        server.paused.add(connection)
+        server._update_reader()
+        connection.resume_writing()
+        assert not server.reading
+        assert not loop.remove_reader(server.serial.fileno())
+        server.close()
+
+    try:
+        asyncio.run(run())
+    finally:
+        os.close(slave)
+
+
+def test_serial_server_export(mocker):
+    master, slave = os.openpty()
+    path = os.ttyname(slave)
+
+    async def run():
+        session = ExporterSession(ComponentConfig('realm1', extra={}))
+        session.isolated = False
+        session.hostname = 'localhost'
+        session.serial_server = 'raw'
+        session.warm_serial = False
+        session.groups = {}
+        session.update_resource = mocker.AsyncMock()
+        session.add_resource('group', 'port', 'RawSerialPort', {'port': path})
+        resource = session.groups['group']['port']
+        assert isinstance(resource, SerialServerExport)
+
+        await session.acquire('group', 'port', 'place')
+        assert resource.data['params']['protocol'] == 'raw'
+        reader, writer = await asyncio.open_connection('127.0.0.1', resource.data['params']['port'])
+        await asyncio.sleep(0.1)
+        os.write(master, b'test')
+        assert await asyncio.wait_for(reader.readexactly(4), 1.0) == b'test'
+
+        await session.release('group', 'port')
+        assert resource.server is None
+        assert await asyncio.wait_for(reader.read(), 1.0) == b''
+        writer.close()
+
+    try:
+        asyncio.run(run())
+    finally:
+        os.close(master)
+        os.close(slave)
+
+
+def test_port_gate():
+    async def run():
+        async def echo(reader, writer):
+            writer.write(await reader.read(100))
+            await writer.drain()
+            writer.close()
+
+        target = await asyncio.start_server(echo, '127.0.0.1', 0)
+        gate = PortGate()
+        port = gate.open()
+        await gate.start()
+        gate.target_port = target.sockets[0].getsockname()[1]
+
+        # refused until allowed
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        assert await asyncio.wait_for(reader.read(), 1.0) == b''
+        writer.close()
+
+        gate.allow(True)
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(b'ping')
+        assert await asyncio.wait_for(reader.read(), 1.0) == b'ping'
+        writer.close()
+
+        gate.close()
+        target.close()
+
+    asyncio.run(run())
+
+
+def test_serial_server_export_warm(mocker):
+    master, slave = os.openpty()
+    path = os.ttyname(slave)
+
+    async def run():
+        session = ExporterSession(ComponentConfig('realm1', extra={}))
+        session.isolated = False
+        session.hostname = 'localhost'
+        session.serial_server = 'raw'
+        session.warm_serial = True
+        session.groups = {}
+        session.update_resource = mocker.AsyncMock()
+        session.add_resource('group', 'port', 'RawSerialPort', {'port': path})
+        resource = session.groups['group']['port']
+        assert resource.warm
+
+        # started while available, but refusing connections
+        assert resource.poll()
+        await resource.settle()
+        port = resource.data['params']['port']
+        assert port
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        assert await asyncio.wait_for(reader.read(), 1.0) == b''
+        writer.close()
+
+        server = resource.server
+        await session.acquire('group', 'port', 'place')
+        assert resource.server is server
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        await asyncio.sleep(0.1)
+        os.write(master, b'test')
+        assert await asyncio.wait_for(reader.readexactly(4), 1.0) == b'test'
+
+        # still running on the same port, but the connection is closed
+        await session.release('group', 'port')
+        assert resource.server is server
+        assert resource.data['params']['port'] == port
+        assert await asyncio.wait_for(reader.read(), 1.0) == b''
+        writer.close()
+        server.close()
+
+    try:
+        asyncio.run(run())
+    finally:
+        os.close(master)
+        os.close(slave)
+
+
+def test_update_resources(mocker):
+    async def run():
+        session = ExporterSession(ComponentConfig('realm1', extra={}))
+        session.groups = {
+            'group': {
+                f'res{i}': LocalExport({'cls': 'Plain', 'params': {'local_cls': Resource}})
+                for i in range(10)
+            },
+        }
+        keys = [('group', name) for name in session.groups['group']]
+
+        async def call(*args):
+            await asyncio.sleep(0.1)
+
+        session.call = mocker.AsyncMock(side_effect=call)
+        session.features = {'set_resources'}
+        await session._poll_step()
+        # a single call for all changed resources
+        session.call.assert_awaited_once()
+        procedure, data = session.call.await_args.args
+        assert procedure == 'org.labgrid.coordinator.set_resources'
+        assert [(group_name, resource_name) for group_name, resource_name, _ in data] == keys
+
+        # old coordinators get concurrent calls for each resource
+        session.call.reset_mock()
+        session.features = set()
+        start = time.monotonic()
+        await session.update_resources(keys)
+        assert time.monotonic() - start < 0.5
+        assert session.call.await_count == 10
+
+    asyncio.run(run())
@@ -18,3 +18,63 @@ def test_exporter_help():
         spawn.close()
         assert spawn.exitstatus == 0
         assert spawn.signalstatus is None
+
+def test_coordinator_bench_help():
+    with pexpect.spawn('python -m labgrid.remote.bench --help') as spawn:
+        spawn.expect('usage')
+        spawn.expect(pexpect.EOF)
+        spawn.close()
+        assert spawn.exitstatus == 0
+        assert spawn.signalstatus is None
+
+def test_client_reservation_places(monkeypatch, mocker):
+    import asyncio
+    from argparse import Namespace
+    from autobahn.wamp.types import ComponentConfig
+    from labgrid.remote.client import ClientSession, UserError
+    from labgrid.remote.common import Place
+
+    monkeypatch.setenv('LG_TOKEN', 'TOKEN')
+    session = ClientSession(ComponentConfig('realm1', extra={}))
+    session.places = {
+        name: Place(name, reservation='TOKEN') for name in ['board-1', 'peer-1', 'peer-2']
+    }
+    session.places['other'] = Place('other')
+    session.reservations = {
+        'TOKEN': {'allocations': {'main': ['board-1'], 'peer': ['peer-1', 'peer-2']}},
+    }
+    session.call = mocker.AsyncMock(return_value=True)
+    session.check_matches = mocker.Mock()
+
+    # a single group of a gang reservation
+    assert session.get_place('+TOKEN:main').name == 'board-1'
+    assert session.get_place('+:main').name == 'board-1'
+    with pytest.raises(UserError, match='multiple places'):
+        session.get_place('+TOKEN:peer')
+    with pytest.raises(UserError, match='no places for group'):
+        session.get_place('+TOKEN:other')
+    with pytest.raises(UserError, match='multiple places'):
+        session.get_place('+TOKEN')
+
+    # acquire and release all places of the reservation
+    session.args = Namespace(place='+TOKEN', allow_unmatched=False, kick=False)
+    asyncio.run(session.acquire())
+    assert [c.args for c in session.call.await_args_list] == [
+        ('org.labgrid.coordinator.acquire_place', name) for name in ['board-1', 'peer-1', 'peer-2']
+    ]
+    session.call.reset_mock()
+    for place in session.places.values():
+        if place.reservation:
+            place.acquired = f'{session.gethostname()}/{session.getuser()}'
+    asyncio.run(session.release())
+    assert [c.args for c in session.call.await_args_list] == [
+        ('org.labgrid.coordinator.release_place', name) for name in ['board-1', 'peer-1', 'peer-2']
+    ]
+
+    # or only those of one group
+    session.call.reset_mock()
+    session.args.place = '+TOKEN:peer'
+    asyncio.run(session.release())
+    assert [c.args for c in session.call.await_args_list] == [
+        ('org.labgrid.coordinator.release_place', name) for name in ['peer-1', 'peer-2']
+    ]
@@ -1,3 +1,9 @@
+import random
+from collections import defaultdict
+
+import pytest
+
+from labgrid.remote.common import Reservation
 from labgrid.remote.scheduler import *
 
 def test_simple():
@@ -79,3 +85,248 @@ def test_conflict():
     assert schedule(places, filters[::-1]) == {'res-2': 'place-1'}
     assert schedule(places[::-1], filters) == {'res-1': 'place-1'}
     assert schedule(places[::-1], filters[::-1]) == {'res-2': 'place-1'}
+
+
+def reference_schedule(places, filters):
+    "The original scheduler, which checks all places for each filter in each step."
+    def schedule_step(places, filters):
+        interest = defaultdict(list)
+        for f in filters:
+            for place in places:
+                if f.tags.issubset(place.tags):
+                    interest[place].append(f)
+
+        if not interest:
+            return {}
+
+        limit = min(map(len, interest.values()))
+        allocation = {}
+        for interest_place, interest_filters in interest.items():
+            if len(interest_filters) == limit:
+                allocation[interest_filters.pop(0)] = interest_place
+
+        return allocation
+
+    places = places[:]
+    filters = filters[:]
+    allocation = {}
+    while True:
+        new = schedule_step(places, filters)
+        if not new:
+            break
+        for f, place in new.items():
+            places.remove(place)
+            filters.remove(f)
+            allocation[f.name] = place.name
+    return allocation
+
+
+def make_tagsets(count_places, count_filters, rng):
+    places = []
+    for i in range(count_places):
+        tags = {f'name=place-{i}', f'board={rng.randrange(8)}', f'arch={rng.randrange(3)}'}
+        if rng.random() < 0.3:
+            tags.add('usb=yes')
+        places.append(TagSet(f'place-{i}', tags))
+    filters = []
+    for i in range(count_filters):
+        tags = rng.choice([
+            {f'board={rng.randrange(8)}'},
+            {f'arch={rng.randrange(3)}'},
+            {f'arch={rng.randrange(3)}', 'usb=yes'},
+            {f'name=place-{rng.randrange(count_places)}'},
+            set(),
+        ])
+        filters.append(TagSet(f'res-{i}', tags))
+    return places, filters
+
+
+def test_reference():
+    rng = random.Random(42)
+    for _ in range(200):
+        places, filters = make_tagsets(rng.randrange(1, 30), rng.randrange(1, 30), rng)
+        assert schedule(places, filters) == reference_schedule(places, filters)
+
+
+def test_tag_index():
+    index = TagIndex()
+    index.add('place-1', {'board=foo', 'soc=mx6'})
+    index.add('place-2', {'board=foo', 'soc=mx8'})
+    assert index.match({'board=foo'}) == {'place-1', 'place-2'}
+    assert index.match({'board=foo', 'soc=mx8'}) == {'place-2'}
+    assert index.match({'board=bar'}) == set()
+    assert index.match(set()) == {'place-1', 'place-2'}
+
+    index.add('place-2', {'board=bar'})
+    assert index.match({'board=foo'}) == {'place-1'}
+    index.remove('place-1')
+    assert index.match({'board=foo'}) == set()
+    assert index.keys == {'board=bar': {'place-2'}}
+
+
+def maximum_matching_size(places, filters):
+    "Size of a maximum matching, found with simple augmenting paths."
+    match = {}
+
+    def augment(f, visited):
+        for place in places:
+            if place.name in visited or not f.tags.issubset(place.tags):
+                continue
+            visited.add(place.name)
+            if place.name not in match or augment(match[place.name], visited):
+                match[place.name] = f
+                return True
+        return False
+
+    return sum(augment(f, set()) for f in filters)
+
+
+def test_matching():
+    places = [
+        TagSet('place-1', {'name=place-1', 'soc=mx6', 'board=foo'}),
+        TagSet('place-2', {'name=place-2', 'soc=mx6', 'board=bar'}),
+        TagSet('place-3', {'name=place-3', 'soc=mx8', 'rev=b'}),
+    ]
+    filters = [
+        TagSet('res-1', set()),
+        TagSet('res-2', {'soc=mx8', 'rev=b'}),
+        TagSet('res-3', {'soc=mx6'}),
+    ]
+
+    # the generic reservation takes the only place usable for res-2
+    assert len(schedule(places, filters)) == 2
+    allocation = schedule(places, filters, mode='matching')
+    assert allocation.keys() == {'res-1', 'res-2', 'res-3'}
+    assert allocation['res-2'] == 'place-3'
+    assert allocation == schedule(places[::-1], filters, mode='matching')
+
+
+def test_matching_prio():
+    places = [
+        TagSet('place-1', {'name=place-1', 'board=foo'}),
+        TagSet('place-2', {'name=place-2', 'board=bar'}),
+    ]
+    filters = [
+        TagSet('res-1', {'board=foo'}, prio=1.0),
+        TagSet('res-2', {'board=bar'}, prio=1.0),
+        TagSet('res-3', set(), prio=0.0),
+    ]
+
+    # the more flexible filter with lower prio doesn't displace the others
+    assert schedule(places, filters, mode='matching') == {'res-1': 'place-1', 'res-2': 'place-2'}
+    assert schedule(places, filters[::-1], mode='matching') == {'res-1': 'place-1', 'res-2': 'place-2'}
+    assert schedule(places[:1], filters, mode='matching') == {'res-1': 'place-1'}
+
+    # the earlier of two equivalent filters is preferred
+    filters = [TagSet('res-1', {'board=foo'}), TagSet('res-2', {'board=foo'})]
+    assert schedule(places, filters, mode='matching') == {'res-1': 'place-1'}
+    assert schedule(places, filters[::-1], mode='matching') == {'res-2': 'place-1'}
+
+
+def test_matching_properties():
+    rng = random.Random(23)
+    for _ in range(500):
+        places, filters = make_tagsets(rng.randrange(1, 30), rng.randrange(1, 30), rng)
+        for f in filters:
+            f.prio = float(rng.randrange(3))
+        filters.sort(key=lambda f: -f.prio)
+
+        allocation = schedule(places, filters, mode='matching')
+        greedy = schedule(places, filters)
+        assert len(allocation) >= len(greedy)
+        assert len(allocation) == maximum_matching_size(places, filters)
+
+        # each place is allocated once, to a matching filter
+        assert len(set(allocation.values())) == len(allocation)
+        place_tags = {p.name: p.tags for p in places}
+        for f in filters:
+            if f.name in allocation:
+                assert f.tags.issubset(place_tags[allocation[f.name]])
+
+        # filters with higher prio are allocated as if the others didn't exist
+        for prio in {f.prio for f in filters}:
+            higher = [f for f in filters if f.prio >= prio]
+            allocated = [f for f in higher if f.name in allocation]
+            assert len(allocated) == maximum_matching_size(places, higher)
+
+
+def test_schedule_all():
+    places = [
+        TagSet('place-1', {'name=place-1', 'board=foo'}),
+        TagSet('place-2', {'name=place-2', 'role=tgen'}),
+        TagSet('place-3', {'name=place-3', 'board=foo'}),
+    ]
+    filters = [
+        TagSet('main/0', {'board=foo'}),
+        TagSet('peer/0', {'role=tgen'}),
+        TagSet('peer/1', {'role=tgen'}),
+    ]
+
+    assert schedule_all(places, filters) == {}
+    assert schedule_all(places, filters[:2]) == {'main/0': 'place-1', 'peer/0': 'place-2'}
+    assert schedule_all(places, filters[1:]) == {}
+    assert schedule_all(places + [TagSet('place-4', {'role=tgen'})], filters).keys() == \
+        {'main/0', 'peer/0', 'peer/1'}
+
+
+def test_fair_share_order():
+    policy = FairShare(weights={'*/ci-*': 2})
+    ci = [Reservation('host/ci-1', created=float(i)) for i in range(6)]
+    user = [Reservation('host/user', created=10.0 + i) for i in range(3)]
+
+    def owners(ordered):
+        return [res.owner for res in ordered]
+
+    # the user waits behind every second reservation of ci-1 instead of
+    # behind all of them
+    assert owners(policy.order(ci + user, [], 20.0)) == [
+        'host/ci-1', 'host/ci-1', 'host/user',
+        'host/ci-1', 'host/ci-1', 'host/user',
+        'host/ci-1', 'host/ci-1', 'host/user',
+    ]
+    # active reservations count against the share
+    active = [Reservation('host/ci-1', state='acquired') for _ in range(4)]
+    assert owners(policy.order(ci + user, active, 20.0))[:3] == [
+        'host/user', 'host/user', 'host/ci-1',
+    ]
+    # prio is still respected
+    user[2].prio = 1.0
+    assert policy.order(ci + user, active, 20.0)[0] is user[2]
+
+
+def test_fair_share_tag():
+    policy = FairShare(key='tag:board')
+    first = Reservation('host/a', filters={'main': {'board': 'foo'}}, created=0.0)
+    second = Reservation('host/b', filters={'main': {'board': 'foo'}}, created=1.0)
+    third = Reservation('host/c', filters={'main': {'board': 'bar'}}, created=2.0)
+
+    assert policy.share(first) == 'foo'
+    assert policy.order([first, second, third], [], 3.0) == [first, third, second]
+
+
+def test_fair_share_caps():
+    policy = FairShare(caps={'host/ci': 2})
+    ci = [Reservation('host/ci', created=float(i)) for i in range(3)]
+    user = Reservation('host/user', created=5.0)
+    active = [Reservation('host/ci', state='allocated')]
+
+    allowed, capped = policy.limit(ci + [user], active)
+    assert allowed == [ci[0], user]
+    assert capped == ci[1:]
+
+
+def test_fair_share_aging():
+    policy = FairShare(aging=60)
+    old = Reservation('host/a', created=0.0)
+    new = Reservation('host/b', prio=1.0, created=30.0)
+
+    assert policy.level(old, 130.0) == 2.0
+    assert policy.order([new, old], [], 130.0) == [old, new]
+    assert policy.order([new, old], [], 50.0) == [new, old]
+
+
+def test_fair_share_invalid():
+    with pytest.raises(ValueError):
+        FairShare(key='group')
+    with pytest.raises(ValueError):
+        FairShare(weights={'*': 0})